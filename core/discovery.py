@@ -0,0 +1,209 @@
+"""
+Index of the ND2 files and output folders below the configured data roots (settings.DATA_ROOTS).
+
+A background thread walks the roots with os.scandir and records every directory, ND2 file and
+XY* position folder in the DatasetEntry table. The file browser lists and searches the index
+instead of walking network shares on every click. Paths outside the roots, or roots not scanned
+yet, are listed live.
+"""
+import os
+import re
+import threading
+import time
+import traceback
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.db.models.functions import Substr
+from django.utils import timezone
+
+POSITION_FOLDER = re.compile(r'XY\d+$')
+# Entries written per database round trip while scanning
+BATCH_SIZE = 1000
+
+_scanner = None
+_scanner_lock = threading.Lock()
+
+
+def data_roots():
+    return [os.path.abspath(root) for root in settings.DATA_ROOTS]
+
+
+def root_of(path):
+    """The data root containing path, None if it is outside all roots"""
+    path = os.path.abspath(path)
+    for root in data_roots():
+        if path == root or path.startswith(root.rstrip(os.sep) + os.sep):
+            return root
+    return None
+
+
+def scan_root(root):
+    """
+    Walk a data root and bring its index up to date, entries no longer found are removed
+
+    Parameters:
+    root (str): Data root
+
+    Returns:
+    int: Number of entries recorded
+    """
+    from .models import DatasetEntry
+
+    root = os.path.abspath(root)
+    started = timezone.now()
+    batch = []
+    count = 0
+
+    def flush():
+        DatasetEntry.objects.bulk_create(
+            batch, update_conflicts=True, unique_fields=['path'],
+            update_fields=['parent', 'name', 'root', 'kind', 'size', 'mtime', 'has_positions', 'scanned'])
+        batch.clear()
+
+    def entry(path, kind, stat, has_positions=False):
+        return DatasetEntry(path=path, parent=os.path.dirname(path), name=os.path.basename(path), root=root,
+                            kind=kind, size=stat.st_size, mtime=stat.st_mtime, has_positions=has_positions,
+                            scanned=started)
+
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as it:
+                children = list(it)
+            stat = os.stat(directory)
+        except OSError:
+            continue
+
+        has_positions = False
+        for child in children:
+            if child.name.startswith('.'):
+                continue
+            try:
+                if child.is_dir(follow_symlinks=False):
+                    if POSITION_FOLDER.match(child.name):
+                        # Contents of position folders are not browsed
+                        has_positions = True
+                        batch.append(entry(child.path, DatasetEntry.POSITION, child.stat(follow_symlinks=False)))
+                    else:
+                        pending.append(child.path)
+                elif child.name.lower().endswith('.nd2') and child.is_file():
+                    batch.append(entry(child.path, DatasetEntry.ND2, child.stat()))
+            except OSError:
+                continue
+        batch.append(entry(directory, DatasetEntry.DIRECTORY, stat, has_positions))
+
+        if len(batch) >= BATCH_SIZE:
+            count += len(batch)
+            flush()
+    count += len(batch)
+    flush()
+
+    DatasetEntry.objects.filter(root=root, scanned__lt=started).delete()
+    return count
+
+
+def scan_all():
+    """Scan every data root, returns entries recorded per root"""
+    return {root: scan_root(root) for root in data_roots()}
+
+
+def ensure_scanner():
+    """Start the background scanner of this process if data roots are configured"""
+    global _scanner
+    if not settings.DATA_ROOTS:
+        return
+    with _scanner_lock:
+        if _scanner is not None and _scanner.is_alive():
+            return
+        _scanner = threading.Thread(target=scan_loop, name='dataset-scanner', daemon=True)
+        _scanner.start()
+
+
+def scan_loop():
+    while True:
+        try:
+            scan_all()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            close_old_connections()
+        time.sleep(settings.DISCOVERY_RESCAN_INTERVAL)
+
+
+def list_entries(path, query='', kind='', page=1, page_size=None):
+    """
+    Page of the entries of a directory, or of the entries below it whose name contains query
+
+    Parameters:
+    path (str): Directory
+    query (str): Case-insensitive name filter, searches the whole tree below path if given
+    kind (str): Only 'nd2' files or 'directory' entries, all if empty
+    page (int): Page number, starting at 1
+    page_size (int): Entries per page, settings.DISCOVERY_PAGE_SIZE by default
+
+    Returns:
+    dict: path, items, total, page, pages and whether the index was used
+
+    Raises:
+    OSError: path is outside the index and cannot be listed (missing, not a directory, no permission)
+    """
+    from .models import DatasetEntry
+
+    path = os.path.abspath(path)
+    page_size = page_size or settings.DISCOVERY_PAGE_SIZE
+    root = root_of(path)
+    indexed = root is not None and DatasetEntry.objects.filter(path=root).exists()
+
+    if indexed:
+        if query:
+            prefix = path.rstrip(os.sep) + os.sep
+            # startswith is a case-insensitive LIKE on SQLite, the exact prefix keeps /data/a out of /data/A
+            entries = DatasetEntry.objects.filter(path__startswith=prefix, name__icontains=query) \
+                .annotate(path_prefix=Substr('path', 1, len(prefix))).filter(path_prefix=prefix)
+        else:
+            entries = DatasetEntry.objects.filter(parent=path)
+        entries = entries.exclude(path=path)
+        if kind == DatasetEntry.ND2:
+            entries = entries.filter(kind=DatasetEntry.ND2)
+        elif kind == DatasetEntry.DIRECTORY:
+            entries = entries.exclude(kind=DatasetEntry.ND2)
+        # Directories first, then by name
+        entries = entries.annotate(is_file=Q(kind=DatasetEntry.ND2)).order_by('is_file', 'name')
+        total = entries.count()
+        start = (page - 1) * page_size
+        items = [entry.as_dict() for entry in entries[start:start + page_size]]
+    else:
+        items = live_entries(path, query, kind)
+        total = len(items)
+        start = (page - 1) * page_size
+        items = items[start:start + page_size]
+
+    return {
+        'path': path,
+        'items': items,
+        'total': total,
+        'page': page,
+        'pages': max(1, -(-total // page_size)),
+        'indexed': indexed,
+    }
+
+
+def live_entries(path, query='', kind=''):
+    """Entries of a directory outside the index, directories first"""
+    items = []
+    with os.scandir(path) as it:
+        for child in it:
+            if query and query.lower() not in child.name.lower():
+                continue
+            try:
+                is_dir = child.is_dir()
+            except OSError:
+                continue
+            if (kind == 'nd2' and (is_dir or not child.name.lower().endswith('.nd2'))) or (kind == 'directory' and not is_dir):
+                continue
+            items.append({'name': child.name, 'path': child.path, 'isDirectory': is_dir})
+    items.sort(key=lambda item: (not item['isDirectory'], item['name']))
+    return items
@@ -0,0 +1,321 @@
+"""
+Local job queue for the pipeline stages, persisted in the Job table of the project database.
+
+Every job runs in its own worker process (manage.py run_job), so a stage can take hours without
+holding a web worker, and can be cancelled by terminating the process. A dispatcher thread in
+the web process starts queued jobs up to settings.JOB_WORKERS and notices workers that exited.
+Jobs writing the same output folder run one after another.
+Several web processes may each run a dispatcher, a job is claimed with a conditional update.
+"""
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+OLD_DIR = os.path.join(os.path.dirname(__file__), '..', 'old')
+
+# Seconds between dispatcher checks when not woken up by a submit or cancel
+POLL_INTERVAL = 2.0
+# Seconds between log and progress writes of a worker
+LOG_FLUSH_INTERVAL = 1.0
+# Characters of worker output kept per job
+LOG_LIMIT = 100_000
+
+# Worker processes started by this process, job id -> Popen
+_processes = {}
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+_wakeup = threading.Event()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def submit(kind, params):
+    """
+    Queue a pipeline stage
+
+    Parameters:
+    kind (str): Stage, one of STAGES or BATCH_STAGES
+    params (dict): Keyword arguments of the stage, with 'positions' to process
+
+    Returns:
+    Job: The queued job
+    """
+    from .models import Job
+
+    if kind not in STAGES and kind not in BATCH_STAGES:
+        raise ValueError(f'Unknown job kind: {kind}')
+    job = Job.objects.create(kind=kind, params=params)
+    ensure_dispatcher()
+    _wakeup.set()
+    return job
+
+
+def cancel(job):
+    """
+    Cancel a queued job, or terminate the worker of a running one
+
+    Parameters:
+    job (Job): The job
+    """
+    from .models import Job
+
+    Job.objects.filter(pk=job.pk).update(cancel_requested=True)
+    Job.objects.filter(pk=job.pk, status=Job.QUEUED).update(status=Job.CANCELLED, finished=timezone.now())
+    job.refresh_from_db()
+    # Terminated workers are recorded as cancelled by their dispatcher, which
+    # may be the one of another web process. Workers lead their own process group
+    # (start_new_session), so processes they started are terminated with them.
+    if job.status == Job.RUNNING and job.pid:
+        try:
+            os.killpg(job.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    _wakeup.set()
+
+
+def ensure_dispatcher():
+    """Start the dispatcher thread of this process if it is not running"""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is not None and _dispatcher.is_alive():
+            return
+        _dispatcher = threading.Thread(target=dispatch_loop, name='job-dispatcher', daemon=True)
+        _dispatcher.start()
+
+
+def recover_interrupted():
+    """
+    Finish running jobs whose worker is gone without recording an outcome, e.g. workers
+    started before a server restart that were killed afterwards
+    """
+    from .models import Job
+
+    for job in Job.objects.filter(status=Job.RUNNING):
+        if job.pk in _processes:
+            continue
+        if job.pid is None:
+            # Claimed by a dispatcher that has not stored the pid yet
+            if timezone.now() - job.started < timedelta(minutes=1):
+                continue
+        elif pid_alive(job.pid):
+            continue
+        now = timezone.now()
+        Job.objects.filter(pk=job.pk, status=Job.RUNNING, cancel_requested=True).update(
+            status=Job.CANCELLED, finished=now)
+        Job.objects.filter(pk=job.pk, status=Job.RUNNING).update(
+            status=Job.FAILED, message='Interrupted', finished=now)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def dispatch_loop():
+    while True:
+        _wakeup.wait(POLL_INTERVAL)
+        _wakeup.clear()
+        try:
+            reap_workers()
+            recover_interrupted()
+            start_queued()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            close_old_connections()
+
+
+def reap_workers():
+    from .models import Job
+
+    for job_id, process in list(_processes.items()):
+        if process.poll() is None:
+            continue
+        del _processes[job_id]
+        # Workers record their own outcome, unless they were killed or crashed
+        now = timezone.now()
+        Job.objects.filter(pk=job_id, status=Job.RUNNING, cancel_requested=True).update(
+            status=Job.CANCELLED, finished=now)
+        Job.objects.filter(pk=job_id, status=Job.RUNNING).update(
+            status=Job.FAILED, message=f'Worker exited with code {process.returncode}', finished=now)
+
+
+def start_queued():
+    from .models import Job
+
+    # Counted over all web processes, concurrent dispatchers may briefly exceed it by one
+    running = list(Job.objects.filter(status=Job.RUNNING))
+    # Stages of one output folder build on each other, they run one at a time in submission order
+    busy = {job.params.get('out_dir') for job in running}
+    for job in Job.objects.filter(status=Job.QUEUED).order_by('created'):
+        if len(running) >= settings.JOB_WORKERS:
+            return
+        out_dir = job.params.get('out_dir')
+        if out_dir in busy:
+            continue
+        busy.add(out_dir)
+        if not Job.objects.filter(pk=job.pk, status=Job.QUEUED).update(status=Job.RUNNING, started=timezone.now()):
+            # Claimed by another dispatcher
+            continue
+        # A fresh interpreter running manage.py run_job, it may start processes of its own
+        # and keeps running if the web server is restarted
+        process = subprocess.Popen([sys.executable, str(settings.BASE_DIR / 'manage.py'), 'run_job', str(job.pk)],
+                                   start_new_session=True)
+        Job.objects.filter(pk=job.pk).update(pid=process.pid)
+        _processes[job.pk] = process
+        running.append(job)
+
+
+class JobLog:
+    """Text stream collecting the output of a worker into its Job row"""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.text = ''
+        self.progress = 0.0
+        self.last_flush = 0.0
+
+    def write(self, text):
+        self.text = (self.text + text)[-LOG_LIMIT:]
+        if time.monotonic() - self.last_flush > LOG_FLUSH_INTERVAL:
+            self.flush()
+        return len(text)
+
+    def set_progress(self, progress):
+        self.progress = progress
+        self.flush()
+
+    def flush(self):
+        from .models import Job
+
+        self.last_flush = time.monotonic()
+        Job.objects.filter(pk=self.job_id).update(log=self.text, progress=self.progress)
+
+
+def cancel_requested(job_id):
+    from .models import Job
+
+    return Job.objects.filter(pk=job_id, cancel_requested=True).exists()
+
+
+def run_job(job_id):
+    """
+    Entry point of a worker process (manage.py run_job), runs the stage position by position.
+    Cancellation is checked between positions, a terminated worker just ends.
+    """
+    sys.path.append(OLD_DIR)
+    from contextlib import redirect_stderr, redirect_stdout
+    from .models import Job
+    from pipeline_metrics import add_progress_listener
+
+    job = Job.objects.get(pk=job_id)
+    log = JobLog(job_id)
+    positions = job.params['positions']
+    status, message = Job.SUCCEEDED, ''
+    position_number = 0
+
+    def frame_progress(event):
+        # Progress within the current position, written out with the log
+        if event['total']:
+            log.progress = (position_number + event['done'] / event['total']) / len(positions)
+
+    with redirect_stdout(log), redirect_stderr(log):
+        try:
+            if job.kind in BATCH_STAGES:
+                BATCH_STAGES[job.kind](job_id, log, **job.params)
+                if cancel_requested(job_id):
+                    raise JobCancelled()
+            else:
+                add_progress_listener(frame_progress)
+                for position_number, pos in enumerate(positions):
+                    if cancel_requested(job_id):
+                        raise JobCancelled()
+                    print(f'Position {pos} ({position_number + 1}/{len(positions)})')
+                    STAGES[job.kind](pos, **{k: v for k, v in job.params.items() if k != 'positions'})
+                    log.set_progress((position_number + 1) / len(positions))
+        except JobCancelled:
+            status = Job.CANCELLED
+        except Exception as e:
+            traceback.print_exc()
+            status, message = Job.FAILED, str(e)
+    log.flush()
+    Job.objects.filter(pk=job_id).update(status=status, message=message, finished=timezone.now())
+
+
+def segmentation_stage(pos, nd2_path, out_dir, segmentation_channel, fluorescence_channels, frame_min, frame_max, chunk_size,
+                       force=False, tile_size=None):
+    import pyama_util
+    pyama_util.segment_positions(nd2_path, out_dir, [pos], segmentation_channel, fluorescence_channels,
+                                 frame_min=frame_min, frame_max=frame_max, chunk_size=chunk_size, force=force,
+                                 tile_size=tile_size)
+
+
+def tracking_stage(pos, out_dir, expand_labels, force=False):
+    import pyama_util
+    pyama_util.tracking_pyama(out_dir, [pos], expand=expand_labels, force=force)
+
+
+def square_rois_stage(pos, out_dir, square_size, force=False):
+    import pyama_util
+    pyama_util.square_roi(out_dir, [pos], square_size, force=force)
+
+
+def export_stage(pos, out_dir, minutes, force=False):
+    import pyama_util
+    pyama_util.csv_output(out_dir, [pos], minutes, force=force)
+
+
+STAGES = {
+    'segmentation': segmentation_stage,
+    'tracking': tracking_stage,
+    'square_rois': square_rois_stage,
+    'export': export_stage,
+}
+
+
+def pipeline_stage(job_id, log, positions, nd2_path, out_dir, segmentation_channel, fluorescence_channels,
+                   frame_min, frame_max, chunk_size, expand_labels, square_size, minutes, force=False, tile_size=None):
+    """All steps with the positions flowing through them, see old/pipeline.py"""
+    from pipeline import PIPELINE_STEPS, run_pipeline
+    from pipeline_metrics import add_progress_listener
+
+    steps = [step for step in PIPELINE_STEPS if step != 'square_rois' or square_size is not None]
+    # Fraction done of every (step, position)
+    done = {}
+
+    def step_progress(event):
+        if event['total']:
+            done[(event['step'], event['position'])] = event['done'] / event['total']
+            log.progress = sum(done.values()) / (len(steps) * len(positions))
+
+    add_progress_listener(step_progress)
+    completed = run_pipeline(nd2_path, out_dir, positions, segmentation_channel, fluorescence_channels,
+                             frame_min=frame_min, frame_max=frame_max, chunk_size=chunk_size,
+                             expand=expand_labels, micron_size=square_size, mins=minutes, force=force,
+                             tile_size=tile_size, should_stop=lambda: cancel_requested(job_id))
+    failed = [pos for pos in positions if pos not in completed[steps[-1]]]
+    if failed and not cancel_requested(job_id):
+        raise RuntimeError(f'Positions not completed: {failed}')
+    log.set_progress(1.0)
+
+
+# Stages that take all positions at once
+BATCH_STAGES = {
+    'pipeline': pipeline_stage,
+}
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import pathlib
+import re
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.jobs import OLD_DIR, STAGES
+
+
+class Command(BaseCommand):
+    help = ('Run segmentation, tracking, square ROIs and export over ND2 files without the web interface. '
+            'Processes started with the same --out on machines sharing the filesystem split the positions between them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('inputs', nargs='+', help='ND2 files, or directories searched for ND2 files')
+        parser.add_argument('--out', required=True,
+                            help='Output root, every ND2 file gets a folder named after its path below the input')
+        parser.add_argument('--segmentation-channel', type=int, required=True)
+        parser.add_argument('--fluorescence-channels', type=int, nargs='*', default=[])
+        parser.add_argument('--positions', type=int, nargs='*', help='Positions to process, all by default')
+        parser.add_argument('--frame-min', type=int)
+        parser.add_argument('--frame-max', type=int)
+        parser.add_argument('--chunk-size', type=int, default=256)
+        parser.add_argument('--tile-size', type=int,
+                            help='Segment frames in tiles of this side length in parallel, for very large frames')
+        parser.add_argument('--expand-labels', type=int, default=0)
+        parser.add_argument('--square-size', type=float, help='Square ROI size in microns, skipped if not given')
+        parser.add_argument('--minutes', type=float, default=1.0, help='Minutes per frame for the export')
+        parser.add_argument('--force', action='store_true', help='Also run steps whose inputs and parameters are unchanged')
+        parser.add_argument('--queue', help='Queue directory shared by the workers, <out>/.batch_queue by default')
+        parser.add_argument('--stale-after', type=float, default=600,
+                            help='Seconds without a heartbeat after which the claim of a crashed worker is taken over')
+        parser.add_argument('--retry-failed', action='store_true', help='Run positions that failed in an earlier run again')
+        parser.add_argument('--no-wait', action='store_true',
+                            help='Exit when nothing is left to claim instead of waiting for the other workers')
+        parser.add_argument('--status', action='store_true', help='Only print the state of every position')
+
+    def handle(self, *args, **options):
+        sys.path.append(OLD_DIR)
+        from nd2reader import ND2Reader
+        from nd2_metadata import metadata_cache
+        from work_queue import WorkQueue
+        # Metadata parsed by the web interface or an earlier run is not read from the files again
+        metadata_cache.path = settings.ND2_METADATA_CACHE
+
+        def read_metadata(nd2_path):
+            nd2 = ND2Reader(nd2_path)
+            try:
+                return nd2.metadata
+            finally:
+                nd2.close()
+
+        files = find_nd2_files(options['inputs'])
+        if not files:
+            raise CommandError('No ND2 files found')
+        out_root = pathlib.Path(options['out']).resolve()
+        queue = WorkQueue(options['queue'] or str(out_root / '.batch_queue'), stale_after=options['stale_after'])
+
+        # task name -> (nd2 path, output folder, position)
+        tasks = {}
+        for nd2_path, name in files:
+            metadata = metadata_cache.get(str(nd2_path), lambda: read_metadata(str(nd2_path)))
+            positions = list(metadata['fields_of_view'])
+            if options['positions'] is not None:
+                positions = [pos for pos in positions if pos in options['positions']]
+            for pos in positions:
+                tasks[task_name(nd2_path, name, pos)] = (str(nd2_path), str(out_root / name), pos)
+
+        if options['status']:
+            counts = {}
+            for task in tasks:
+                state = queue.state(task)
+                counts[state] = counts.get(state, 0) + 1
+                self.stdout.write(f'{task}: {state}')
+            self.stdout.write(', '.join(f'{count} {state}' for state, count in sorted(counts.items())))
+            return
+
+        self.stdout.write(f'{len(tasks)} positions in {len(files)} ND2 files, worker {queue.owner}')
+
+        def run_position(task):
+            nd2_path, out_dir, pos = tasks[task]
+            os.makedirs(out_dir, exist_ok=True)
+            self.stdout.write(f'{task}: {nd2_path} position {pos} -> {out_dir}')
+            force = options['force']
+            STAGES['segmentation'](pos, nd2_path=nd2_path, out_dir=out_dir,
+                                   segmentation_channel=options['segmentation_channel'],
+                                   fluorescence_channels=options['fluorescence_channels'],
+                                   frame_min=options['frame_min'], frame_max=options['frame_max'],
+                                   chunk_size=options['chunk_size'], force=force,
+                                   tile_size=options['tile_size'])
+            STAGES['tracking'](pos, out_dir=out_dir, expand_labels=options['expand_labels'], force=force)
+            if options['square_size'] is not None:
+                STAGES['square_rois'](pos, out_dir=out_dir, square_size=options['square_size'], force=force)
+            STAGES['export'](pos, out_dir=out_dir, minutes=options['minutes'], force=force)
+            return {'nd2_path': nd2_path, 'out_dir': out_dir, 'position': pos}
+
+        outcomes = queue.run(list(tasks), run_position, retry_failed=options['retry_failed'],
+                             wait=not options['no_wait'])
+        failed = [task for task, outcome in outcomes.items() if outcome == 'failed']
+        self.stdout.write(f'This worker processed {len(outcomes)} positions, {len(failed)} failed')
+        for task in failed:
+            self.stderr.write(f'Failed: {task}, see {queue.path(task, ".failed")}')
+
+
+def find_nd2_files(inputs):
+    """
+    ND2 files among the inputs and below the input directories
+
+    Returns:
+    list: (path, name) pairs, the name being the path below the input directory without suffix
+    """
+    files = []
+    for item in inputs:
+        path = pathlib.Path(item).resolve()
+        if path.is_dir():
+            for nd2_path in sorted(path.rglob('*')):
+                if nd2_path.suffix.lower() == '.nd2' and nd2_path.is_file():
+                    files.append((nd2_path, str(nd2_path.relative_to(path).with_suffix(''))))
+        elif path.is_file():
+            files.append((path, path.stem))
+    return files
+
+
+def task_name(nd2_path, name, pos):
+    # Readable, and unique for ND2 files with the same name in different folders
+    digest = hashlib.sha1(str(nd2_path).encode()).hexdigest()[:8]
+    return f'{re.sub(r"[^A-Za-z0-9_.-]+", "_", name)}-{digest}-XY{pos}'
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.discovery import scan_root
+
+
+class Command(BaseCommand):
+    help = 'Scan the data roots into the file browser index now, instead of waiting for the background scanner'
+
+    def add_arguments(self, parser):
+        parser.add_argument('roots', nargs='*', help='Roots to scan, all of settings.DATA_ROOTS by default')
+
+    def handle(self, *args, **options):
+        roots = options['roots'] or settings.DATA_ROOTS
+        if not roots:
+            raise CommandError('No roots given and settings.DATA_ROOTS is empty')
+        for root in roots:
+            count = scan_root(root)
+            self.stdout.write(f'{root}: {count} entries')
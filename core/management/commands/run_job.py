@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from core.jobs import run_job
+
+
+class Command(BaseCommand):
+    help = 'Run a queued pipeline job, started by the job dispatcher (core/jobs.py)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('job_id', type=int)
+
+    def handle(self, *args, **options):
+        run_job(options['job_id'])
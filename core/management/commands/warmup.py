@@ -0,0 +1,23 @@
+import os
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.jobs import OLD_DIR
+
+
+class Command(BaseCommand):
+    help = 'Import the analysis code and compile its numba kernels into the on-disk cache, run after install or update'
+
+    def handle(self, *args, **options):
+        sys.path.append(OLD_DIR)
+        start = time.perf_counter()
+        import gui  # noqa: F401
+        import pyama_util
+        self.stdout.write(f'Imported the analysis code in {time.perf_counter() - start:.1f} s')
+
+        start = time.perf_counter()
+        pyama_util.compile_kernels()
+        self.stdout.write(f'Compiled the segmentation kernels in {time.perf_counter() - start:.1f} s '
+                          f'(cached in {os.path.join(os.path.abspath(OLD_DIR), "__pycache__")})')
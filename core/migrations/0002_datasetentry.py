@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatasetEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=1024, unique=True)),
+                ('parent', models.CharField(db_index=True, max_length=1024)),
+                ('name', models.CharField(max_length=255)),
+                ('root', models.CharField(max_length=1024)),
+                ('kind', models.CharField(choices=[('directory', 'Directory'), ('nd2', 'ND2 file'), ('position', 'Position folder')], max_length=16)),
+                ('size', models.BigIntegerField(default=0)),
+                ('mtime', models.FloatField(default=0.0)),
+                ('has_positions', models.BooleanField(default=False)),
+                ('scanned', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['parent', 'kind', 'name'], name='core_datase_parent_10fcb6_idx')],
+            },
+        ),
+    ]
@@ -1,3 +1,95 @@
 from django.db import models
 
-# Create your models here.
+
+class Job(models.Model):
+    """Pipeline stage run in a worker process, see core/jobs.py"""
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    ]
+    FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+    kind = models.CharField(max_length=32)
+    params = models.JSONField(default=dict)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    progress = models.FloatField(default=0.0)
+    message = models.TextField(blank=True, default='')
+    log = models.TextField(blank=True, default='')
+    pid = models.IntegerField(null=True, blank=True)
+    cancel_requested = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created']
+
+    def __str__(self):
+        return f'{self.kind} #{self.pk} ({self.status})'
+
+    def as_dict(self, log=True):
+        data = {
+            'id': self.pk,
+            'kind': self.kind,
+            'params': self.params,
+            'status': self.status,
+            'progress': self.progress,
+            'message': self.message,
+            'cancel_requested': self.cancel_requested,
+            'created': self.created.isoformat(),
+            'started': self.started.isoformat() if self.started else None,
+            'finished': self.finished.isoformat() if self.finished else None,
+        }
+        if log:
+            data['log'] = self.log
+        return data
+
+
+class DatasetEntry(models.Model):
+    """Directory, ND2 file or XY* position folder below a data root, see core/discovery.py"""
+
+    DIRECTORY = 'directory'
+    ND2 = 'nd2'
+    POSITION = 'position'
+    KIND_CHOICES = [
+        (DIRECTORY, 'Directory'),
+        (ND2, 'ND2 file'),
+        (POSITION, 'Position folder'),
+    ]
+
+    path = models.CharField(max_length=1024, unique=True)
+    parent = models.CharField(max_length=1024, db_index=True)
+    name = models.CharField(max_length=255)
+    root = models.CharField(max_length=1024)
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    size = models.BigIntegerField(default=0)
+    mtime = models.FloatField(default=0.0)
+    # Directories holding XY* folders, i.e. pipeline output folders
+    has_positions = models.BooleanField(default=False)
+    scanned = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=['parent', 'kind', 'name'])]
+
+    def __str__(self):
+        return self.path
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'path': self.path,
+            'isDirectory': self.kind != self.ND2,
+            'kind': self.kind,
+            'size': self.size,
+            'mtime': self.mtime,
+            'hasPositions': self.has_positions,
+        }
@@ -0,0 +1,279 @@
+"""
+WebSocket channel of the viewer, served by liscator/asgi.py without extra dependencies.
+It needs an ASGI server (e.g. `uvicorn liscator.asgi:application`), under `manage.py runserver`
+the browser falls back to the HTTP endpoints.
+
+Client -> server, JSON text messages:
+    {"type": "navigate", "id": 12, "position": 0, "channel": 1, "frame": 5, "particle": 3,
+     "lower": 0, "upper": 40000, "overlay": 0, "format": "jpeg", "cached": false}
+        Move the viewer. "cached": the client already has the frame, only the state is updated.
+    {"type": "cancel", "id": 12}
+        The frame of that navigation is no longer wanted.
+
+Server -> client:
+    text {"type": "state", "id": 12, "image_params": {...}, "particle_enabled": true, "all_particles_len": 80}
+    text {"type": "plot", "id": 12, "brightness_plot": "<plotly json>"}       after a position change
+    text {"type": "plot_style", "id": 12, "colors": [...], "opacities": [...], "highlight": 3}
+        after a particle change, the traces stay the same and only need restyling
+    text {"type": "error", "id": 12, "message": "..."}
+    binary: 4 byte big-endian header length, JSON header, image bytes. The header is
+        {"type": "frame" | "prefetch", "id": 12, "params": {...}, "overlay": 0, "content_type": "image/jpeg"}
+
+Only the newest navigation is rendered, navigations arriving while a frame renders replace each other.
+While nothing is pending, the frames around the current one are rendered and pushed as prefetch,
+any new message stops that.
+"""
+import asyncio
+import json
+import struct
+from http.cookies import SimpleCookie
+from importlib import import_module
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import views
+
+VIEWER_SOCKET_PATH = '/ws/viewer/'
+
+# Frames after and before the current one pushed while the user is idle
+PREFETCH_AHEAD = 3
+PREFETCH_BEHIND = 1
+
+
+def in_worker_thread(func):
+    """
+    func run by sync_to_async in a thread of the executor, not the one Django's sync code shares.
+    Like around a request, connections of the thread that are broken or past CONN_MAX_AGE are
+    closed before and after, as the executor threads live on between calls.
+    """
+    def run(*args):
+        close_old_connections()
+        try:
+            return func(*args)
+        finally:
+            close_old_connections()
+    return sync_to_async(run, thread_sensitive=False)
+
+
+def load_session(scope):
+    """Django session of the connection from its session cookie, None if there is none"""
+    headers = dict(scope['headers'])
+    cookie = SimpleCookie()
+    cookie.load(headers.get(b'cookie', b'').decode('latin-1'))
+    if settings.SESSION_COOKIE_NAME not in cookie:
+        return None
+    session_key = cookie[settings.SESSION_COOKIE_NAME].value
+    session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    if not session.exists(session_key):
+        return None
+    return session
+
+
+def same_origin(scope):
+    """Browsers send an Origin header with WebSocket requests, reject other sites using the session cookie"""
+    headers = dict(scope['headers'])
+    origin = headers.get(b'origin')
+    if origin is None:
+        return True
+    return urlsplit(origin.decode('latin-1')).netloc == headers.get(b'host', b'').decode('latin-1')
+
+
+class ViewerSocket:
+
+    def __init__(self, scope, receive, send):
+        self.scope = scope
+        self.receive = receive
+        self.send = send
+        self.session = None
+        self.cell_viewer = None
+
+        # Newest navigation not rendered yet, replaced by newer ones
+        self.pending = None
+        # Cancelled navigations newer than the last one served, older IDs are dropped
+        self.cancelled = set()
+        self.last_served = -1
+        self.wakeup = asyncio.Event()
+        # Keys of the frames pushed since the last selection change
+        self.pushed = set()
+        self.last = None
+
+    async def run(self):
+        message = await self.receive()
+        if message['type'] != 'websocket.connect':
+            return
+        if same_origin(self.scope):
+            self.session = await sync_to_async(load_session)(self.scope)
+        if self.session is not None:
+            self.cell_viewer = await sync_to_async(views.session_cell_viewer)(self.session)
+        if self.cell_viewer is None or self.cell_viewer.position is None:
+            await self.send({'type': 'websocket.close', 'code': 4003})
+            return
+        await self.send({'type': 'websocket.accept'})
+
+        worker = asyncio.create_task(self.work())
+        try:
+            while True:
+                message = await self.receive()
+                if message['type'] == 'websocket.disconnect':
+                    break
+                if message['type'] == 'websocket.receive' and message.get('text'):
+                    try:
+                        message = json.loads(message['text'])
+                    except ValueError as e:
+                        await self.send_json({'type': 'error', 'id': None, 'message': f'Invalid message: {e}'})
+                        continue
+                    if isinstance(message, dict):
+                        self.handle(message)
+        finally:
+            worker.cancel()
+
+    def handle(self, message):
+        if message.get('type') == 'navigate':
+            self.pending = message
+        elif message.get('type') == 'cancel':
+            message_id = message.get('id')
+            if self.pending is not None and self.pending.get('id') == message_id:
+                self.pending = None
+            elif isinstance(message_id, int) and message_id > self.last_served:
+                # The navigation may be rendering right now
+                self.cancelled.add(message_id)
+        self.wakeup.set()
+
+    async def work(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.pending is not None:
+                message, self.pending = self.pending, None
+                await self.serve(message)
+            if self.last is not None:
+                await self.prefetch()
+
+    def superseded(self, message_id):
+        return self.pending is not None or message_id in self.cancelled
+
+    async def serve(self, message):
+        message_id = message.get('id')
+        try:
+            try:
+                result = await in_worker_thread(self.navigate)(message)
+            except Exception as e:
+                # Bad parameters or a failed render, the connection keeps serving later navigations
+                await self.send_json({'type': 'error', 'id': message_id, 'message': str(e) or type(e).__name__})
+                return
+            if self.superseded(message_id):
+                return
+
+            changed, texts, image = result
+            if changed:
+                self.pushed.clear()
+            for text in texts:
+                await self.send_json(text)
+            if image is not None:
+                await self.send_frame('frame', message_id, image)
+        finally:
+            # IDs only grow, cancels of this navigation and older ones are not needed anymore
+            if isinstance(message_id, int):
+                self.last_served = max(self.last_served, message_id)
+                self.cancelled = {i for i in self.cancelled if i > self.last_served}
+
+    def navigate(self, message):
+        cell_viewer = self.cell_viewer
+        fmt = message.get('format', 'jpeg')
+        if fmt not in views.IMAGE_FORMATS:
+            raise ValueError(f'Unsupported format: {fmt}')
+        overlay = bool(message.get('overlay', 0))
+        channel = int(message['channel'])
+
+        # Fresh copy of the session, HTTP requests of the same browser may have saved it meanwhile
+        session = self.session.__class__(self.session.session_key)
+        with views.viewer_lock(session, cell_viewer):
+            query = {'particle': message['particle']} if 'particle' in message else {}
+            changed = views.navigate(cell_viewer, query, int(message['position']), int(message['frame']))
+            if channel != cell_viewer.channel:
+                changed.add('channel')
+            cell_viewer.channel = channel
+            if 'lower' in message and 'upper' in message:
+                cell_viewer.set_contrast(channel, int(message['lower']), int(message['upper']))
+            views.save_viewer_state(session, cell_viewer)
+
+            message_id = message.get('id')
+            texts = [{
+                'type': 'state',
+                'id': message_id,
+                'image_params': cell_viewer.image_params(),
+                'particle_enabled': bool(cell_viewer.particle_enabled),
+                'all_particles_len': cell_viewer.all_particles_len,
+            }]
+            if 'position' in changed:
+                texts.append({'type': 'plot', 'id': message_id, 'brightness_plot': cell_viewer.brightness_plot})
+            elif 'particle' in changed:
+                texts.append({'type': 'plot_style', 'id': message_id, **cell_viewer.plot_style})
+
+            image = None
+            if not message.get('cached'):
+                image = (cell_viewer.image_params(), overlay, fmt, cell_viewer.render_image(fmt, overlay))
+            self.last = (overlay, fmt)
+            self.pushed.add(self.frame_key(cell_viewer.image_params(), overlay))
+
+        if session.modified:
+            session.save()
+        return changed, texts, image
+
+    async def prefetch(self):
+        overlay, fmt = self.last
+        frames = [self.cell_viewer.frame + i for i in range(1, PREFETCH_AHEAD + 1)] + \
+                 [self.cell_viewer.frame - i for i in range(1, PREFETCH_BEHIND + 1)]
+        for frame in frames:
+            if self.pending is not None or self.wakeup.is_set():
+                return
+            try:
+                image = await in_worker_thread(self.render_frame)(frame, overlay, fmt)
+            except Exception:
+                # Prefetching is optional, the next navigation renders the frame or reports the error
+                return
+            if image is not None and self.pending is None:
+                await self.send_frame('prefetch', None, image)
+
+    def render_frame(self, frame, overlay, fmt):
+        # Render another frame of the current selection without moving the viewer
+        cell_viewer = self.cell_viewer
+        with cell_viewer.lock:
+            if frame < cell_viewer.frame_min or frame > cell_viewer.frame_max:
+                return None
+            params = dict(cell_viewer.image_params(), frame=frame)
+            key = self.frame_key(params, overlay)
+            if key in self.pushed:
+                return None
+            self.pushed.add(key)
+            view = dict(cell_viewer.view(), frame=frame)
+        return params, overlay, fmt, cell_viewer.render_view(view, fmt, overlay)
+
+    @staticmethod
+    def frame_key(params, overlay):
+        key = (params['position'], params['channel'], params['frame'], params['x'], params['y'],
+               tuple(params['contrast'][params['channel']]), overlay)
+        if overlay:
+            key += (params['particle'], params['rev'])
+        return key
+
+    async def send_json(self, data):
+        await self.send({'type': 'websocket.send', 'text': json.dumps(data)})
+
+    async def send_frame(self, kind, message_id, image):
+        params, overlay, fmt, data = image
+        header = json.dumps({
+            'type': kind,
+            'id': message_id,
+            'params': params,
+            'overlay': int(overlay),
+            'content_type': views.IMAGE_FORMATS[fmt][1],
+        }).encode()
+        await self.send({'type': 'websocket.send', 'bytes': struct.pack('>I', len(header)) + header + data})
+
+
+async def viewer_socket(scope, receive, send):
+    await ViewerSocket(scope, receive, send).run()
@@ -1,3 +1,362 @@
-from django.test import TestCase
+import multiprocessing
+import os
+import pathlib
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import h5py
+import numpy as np
+import pandas as pd
+from django.test import SimpleTestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'old'))
+import pyama_util
+from label_index import LabelIndex, LabelIndexWriter, label_runs, runs_mask
+from stage_manifest import STEP_OUTPUTS, read_manifest, record_step, step_is_current
+from tiled_segmentation import segment_frame_tiled
+from work_queue import WorkQueue
+
+
+def hold_tracks_lock(pos_path, locked, seconds):
+    # Child process: take the lock, signal, keep it for a while
+    with pyama_util.tracks_lock(pathlib.Path(pos_path)):
+        locked.set()
+        time.sleep(seconds)
+
+
+class TracksJournalTests(SimpleTestCase):
+    """Enable edits go to a journal that is folded into tracks.csv under the per-position tracks lock"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.pos_path = pathlib.Path(self.tmp.name)
+        tracks = pd.DataFrame({'particle': [0, 0, 1, 1, 2], 'frame': [0, 1, 0, 1, 0], 'enabled': [True] * 5})
+        pyama_util.write_tracks(self.pos_path, tracks)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def enabled(self):
+        tracks = pd.read_csv(self.pos_path.joinpath('tracks.csv'), index_col=0)
+        return dict(zip(tracks['particle'], pyama_util.enabled_mask(tracks['enabled'])))
+
+    def test_compaction_folds_the_journal(self):
+        pyama_util.append_tracks_journal(self.pos_path, 1, 0)
+        pyama_util.append_tracks_journal(self.pos_path, 2, 0)
+        pyama_util.append_tracks_journal(self.pos_path, 2, 1)
+        pyama_util.compact_tracks_journal(self.pos_path)
+
+        self.assertEqual(self.enabled(), {0: True, 1: False, 2: True})
+        self.assertFalse(self.pos_path.joinpath(pyama_util.TRACKS_JOURNAL).exists())
+        self.assertFalse(self.pos_path.joinpath(pyama_util.TRACKS_JOURNAL_COMPACTING).exists())
+
+    def test_read_tracks_applies_pending_edits(self):
+        pyama_util.append_tracks_journal(self.pos_path, 0, 0)
+        tracks = pyama_util.read_tracks(self.pos_path)
+        enabled = pyama_util.enabled_mask(tracks['enabled'])
+        self.assertEqual(list(enabled), [False, False, True, True, True])
+
+    def test_concurrent_compactions_and_writes(self):
+        errors = []
+
+        def run(func):
+            try:
+                for _ in range(20):
+                    func()
+            except Exception as e:
+                errors.append(e)
+
+        def edit_and_compact():
+            pyama_util.append_tracks_journal(self.pos_path, 1, 0)
+            pyama_util.compact_tracks_journal(self.pos_path)
+
+        def rewrite():
+            with pyama_util.tracks_lock(self.pos_path):
+                pyama_util.write_tracks(self.pos_path, pyama_util.read_tracks(self.pos_path))
+
+        threads = [threading.Thread(target=run, args=(func,)) for func in (edit_and_compact, edit_and_compact, rewrite)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.enabled(), {0: True, 1: False, 2: True})
+        self.assertEqual(list(self.pos_path.glob('*.tmp')), [])
+
+    def test_edits_compacted_during_a_long_rewrite_are_kept(self):
+        # A step rewriting tracks.csv (e.g. square ROIs) holds the lock from read to write, a
+        # compaction started meanwhile waits and folds the edit into the rewritten file
+        pyama_util.append_tracks_journal(self.pos_path, 0, 0)
+        compacted = threading.Event()
+
+        with pyama_util.tracks_lock(self.pos_path):
+            tracks = pyama_util.read_tracks(self.pos_path)
+            pyama_util.append_tracks_journal(self.pos_path, 2, 0)
+            compaction = threading.Thread(
+                target=lambda: (pyama_util.compact_tracks_journal(self.pos_path), compacted.set()))
+            compaction.start()
+            self.assertFalse(compacted.wait(0.2))
+            tracks['square_area'] = 1
+            pyama_util.write_tracks(self.pos_path, tracks)
+        compaction.join()
+
+        self.assertEqual(self.enabled(), {0: False, 1: True, 2: False})
+        self.assertIn('square_area', pd.read_csv(self.pos_path.joinpath('tracks.csv'), index_col=0).columns)
+
+    def test_lock_excludes_other_processes(self):
+        context = multiprocessing.get_context('fork')
+        locked = context.Event()
+        process = context.Process(target=hold_tracks_lock, args=(str(self.pos_path), locked, 0.5))
+        process.start()
+        self.assertTrue(locked.wait(10))
+        start = time.monotonic()
+        with pyama_util.tracks_lock(self.pos_path):
+            waited = time.monotonic() - start
+        process.join()
+        self.assertGreater(waited, 0.2)
+
+
+def label_frames():
+    # Cells touching each other and the borders, one with a hole, a U shape with runs split per row
+    labels = np.zeros((2, 40, 50), dtype=np.uint16)
+    labels[0, 0:10, 0:12] = 1
+    labels[0, 5:25, 12:30] = 2
+    labels[0, 10:15, 18:22] = 0
+    labels[0, 30:40, 35:50] = 7
+    labels[0, 30:40, 40:45] = 0
+    labels[0, 35:40, 40:45] = 7
+    labels[1, 20:30, 0:50] = 3
+    labels[1, 22:28, 10:20] = 4
+    return labels
+
+
+class LabelIndexTests(SimpleTestCase):
+    """Cell runs in data.h5 give back the label masks, and single cells are read without whole frames"""
+
+    def setUp(self):
+        self.labels = label_frames()
+        self.file = h5py.File(tempfile.mktemp(suffix='.h5'), 'w', driver='core', backing_store=False)
+
+    def tearDown(self):
+        self.file.close()
+
+    def test_runs_round_trip(self):
+        height, width = self.labels.shape[1:]
+        for labels in self.labels:
+            index, runs = label_runs(labels)
+            self.assertEqual(list(index['label']), sorted(set(np.unique(labels)) - {0}))
+            for entry in index:
+                cell_runs = runs[entry['run_offset']:entry['run_offset'] + entry['run_count']]
+                np.testing.assert_array_equal(runs_mask(cell_runs, 0, height, 0, width), labels == entry['label'])
+                box = labels[entry['row0']:entry['row1'], entry['col0']:entry['col1']] == entry['label']
+                np.testing.assert_array_equal(
+                    runs_mask(cell_runs, entry['row0'], entry['row1'], entry['col0'], entry['col1']), box)
+
+    def test_index_reads_cells_from_the_file(self):
+        writer = LabelIndexWriter(self.file, len(self.labels))
+        for frame_index, labels in enumerate(self.labels):
+            writer.append(frame_index, labels)
+        self.file.create_dataset('labels', data=self.labels)
+        index = LabelIndex(self.file)
+        self.assertTrue(index.available)
+
+        height, width = self.labels.shape[1:]
+        for frame_index, labels in enumerate(self.labels):
+            for label in (1, 2, 3, 4, 7):
+                mask = runs_mask(index.cell_runs(frame_index, label), 0, height, 0, width)
+                np.testing.assert_array_equal(mask, labels == label)
+            for row, col in [(0, 0), (12, 20), (7, 15), (32, 42), (37, 42), (25, 15), (25, 30), (39, 49)]:
+                self.assertEqual(index.label_at(frame_index, row, col), labels[row, col])
+        # The cached frame holds the index only, runs stay in the file
+        self.assertIsNone(index.frame(0)[1])
+
+    def test_files_without_index(self):
+        self.file.create_dataset('labels', data=self.labels)
+        index = LabelIndex(self.file)
+        self.assertFalse(index.available)
+        height, width = self.labels.shape[1:]
+        np.testing.assert_array_equal(runs_mask(index.cell_runs(0, 7), 0, height, 0, width), self.labels[0] == 7)
+        self.assertEqual(len(index.cell_runs(0, 3)), 0)
+        self.assertEqual(index.label_at(1, 25, 15), 4)
+
+
+def phase_contrast_frame():
+    # Flat background with textured cells; two rings whose holes cross the tile seams at 97 and
+    # 194, cells across seams and at the border, and small objects that are removed
+    rng = np.random.default_rng(0)
+    rows, cols = np.mgrid[:300, :260]
+    img = 1000 + rng.normal(0, 2, rows.shape)
+
+    def disk(row, col, radius):
+        return (rows - row) ** 2 + (cols - col) ** 2 < radius ** 2
+
+    cells = disk(97, 97, 30) | disk(40, 200, 25) | disk(250, 60, 28) | disk(200, 194, 22) | disk(150, 5, 24)
+    cells |= disk(200, 100, 45) & ~disk(200, 100, 30)
+    cells |= disk(97, 194, 24) & ~disk(97, 194, 12)
+    cells |= disk(10, 97, 8) | disk(280, 250, 6)
+    img[cells] += rng.normal(0, 60, rows.shape)[cells]
+    return img.astype(np.uint16)
+
+
+class TiledSegmentationTests(SimpleTestCase):
+    """Segmenting in tiles gives the labels of pyama_segmentation"""
+
+    def test_tiled_labels_equal_whole_frame(self):
+        img = phase_contrast_frame()
+        labels = pyama_util.pyama_segmentation(img)
+        self.assertGreater(labels.max(), 5)
+        # Holes are filled across the seams
+        self.assertTrue(labels[200, 100] and labels[97, 194])
+        # 97 does not divide 300 or 260, the last row and column of tiles are smaller
+        np.testing.assert_array_equal(segment_frame_tiled(img, tile_size=97, workers=2), labels)
+
+
+class StageManifestTests(SimpleTestCase):
+    """Steps whose parameters, code and inputs match their record are skipped, the others run again"""
+
+    steps = ['segmentation', 'tracking', 'square_rois', 'export']
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.pos_path = pathlib.Path(self.tmp.name)
+        self.nd2_path = self.pos_path.joinpath('input.nd2')
+        self.nd2_path.write_text('frames')
+        self.params = {step: {'value': 1} for step in self.steps}
+        self.runs = 0
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_pipeline(self):
+        # Steps that ran, each rewrites its outputs like a real run. The size changes too, fingerprints
+        # (size, mtime) of files written within one timestamp tick would be equal otherwise
+        ran = []
+        for step in self.steps:
+            extra_inputs = [self.nd2_path] if step == 'segmentation' else []
+            if step_is_current(self.pos_path, step, self.params[step], extra_inputs):
+                continue
+            self.runs += 1
+            for name in STEP_OUTPUTS[step]:
+                self.pos_path.joinpath(name).write_text(f'{step}\n' * self.runs)
+            record_step(self.pos_path, step, self.params[step], extra_inputs)
+            ran.append(step)
+        return ran
+
+    def test_matching_records_skip_steps(self):
+        self.assertEqual(self.run_pipeline(), self.steps)
+        self.assertEqual(self.run_pipeline(), [])
+
+    def test_changed_input_runs_the_downstream_steps(self):
+        self.run_pipeline()
+        # features.csv is an input of tracking, only tracking and the steps after it run again
+        self.pos_path.joinpath('features.csv').write_text('edited features')
+        self.assertEqual(self.run_pipeline(), ['tracking', 'square_rois', 'export'])
+        self.params['export'] = {'value': 2}
+        self.assertEqual(self.run_pipeline(), ['export'])
+        self.nd2_path.write_text('other frames')
+        self.assertEqual(self.run_pipeline(), self.steps)
+
+    def test_concurrent_records_are_kept(self):
+        for step in self.steps:
+            for name in STEP_OUTPUTS[step]:
+                self.pos_path.joinpath(name).write_text(step)
+
+        def record(step):
+            for _ in range(20):
+                record_step(self.pos_path, step, self.params[step])
+
+        threads = [threading.Thread(target=record, args=(step,)) for step in self.steps]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(read_manifest(self.pos_path)), sorted(self.steps))
+        self.assertEqual(list(self.pos_path.glob('*.tmp')), [])
+
+
+class WorkQueueTests(SimpleTestCase):
+    """Workers sharing a queue directory claim every task once and take over the claims of crashed workers"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.first = WorkQueue(self.tmp.name, stale_after=1.0, owner='first')
+        self.second = WorkQueue(self.tmp.name, stale_after=1.0, owner='second')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def crash(self, claim):
+        # The worker stops beating and its claim file ages past stale_after
+        claim.stopped.set()
+        claim.heartbeat.join()
+        old = time.time() - 10
+        os.utime(claim.path, (old, old))
+
+    def test_concurrent_claims(self):
+        tasks = [f'task{i}' for i in range(20)]
+        claims = {queue.owner: [] for queue in (self.first, self.second)}
+        barrier = threading.Barrier(4)
+
+        def claim_all(queue):
+            barrier.wait()
+            for task in tasks:
+                claim = queue.claim(task)
+                if claim is not None:
+                    claims[queue.owner].append(claim)
+
+        threads = [threading.Thread(target=claim_all, args=(queue,)) for queue in (self.first, self.second) * 2]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        claimed = [claim.task for owner_claims in claims.values() for claim in owner_claims]
+        self.assertEqual(sorted(claimed), sorted(tasks))
+        for claim in claims['first'] + claims['second']:
+            claim.complete()
+        self.assertEqual({self.first.state(task) for task in tasks}, {'done'})
+
+    def test_stale_claim_is_taken_over(self):
+        crashed = self.first.claim('task')
+        self.crash(crashed)
+        claim = self.second.claim('task')
+        self.assertIsNotNone(claim)
+        self.assertFalse(crashed.owned())
+        # The stalled worker finishing late leaves the new claim alone
+        crashed.release()
+        self.assertTrue(claim.owned())
+        claim.complete('result')
+        self.assertEqual(self.first.read('task', '.done')['result'], 'result')
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ['task.done'])
+
+    def test_live_claim_is_kept(self):
+        claim = self.first.claim('task')
+        # Longer than stale_after, the heartbeat keeps the claim fresh
+        time.sleep(1.5)
+        self.assertIsNone(self.second.claim('task'))
+        self.assertTrue(claim.owned())
+        claim.complete()
+        self.assertIsNone(self.second.claim('task'))
+
+    def test_retry_failed(self):
+        self.first.claim('task').fail('error')
+        self.assertEqual(self.second.state('task'), 'failed')
+        self.assertIsNone(self.second.claim('task'))
+        claim = self.second.claim('task', retry_failed=True)
+        self.assertIsNotNone(claim)
+        self.assertEqual(self.second.state('task'), 'claimed')
+        claim.complete()
+        self.assertEqual(self.first.state('task'), 'done')
+
+    def test_heartbeat_survives_errors(self):
+        queue = WorkQueue(self.tmp.name, stale_after=0.2)
+        with mock.patch('work_queue.os.utime', side_effect=OSError('Stale file handle')):
+            claim = queue.claim('task')
+            time.sleep(0.2)
+        self.assertTrue(claim.heartbeat.is_alive())
+        claim.complete()
@@ -16,10 +16,25 @@ urlpatterns = [
     # API URLs
     path('api/update_image/', views.update_image, name='update_image'),
     path('api/update_particle_enabled/', views.update_particle_enabled, name='update_particle_enabled'),
+    path('api/update_contrast/', views.update_contrast, name='update_contrast'),
+    path('api/image/<int:position>/<int:channel>/<int:frame>/', views.image, name='image'),
+    path('api/outlines/<int:position>/<int:frame>/', views.outlines, name='outlines'),
+    path('api/particles/', views.particles, name='particles'),
+    path('api/particles/next/', views.next_particle, name='next_particle'),
+    path('api/particles/at/<int:position>/<int:frame>/', views.particle_at, name='particle_at'),
     path('api/do_segmentation/', views.do_segmentation, name='do_segmentation'),
     path('api/do_tracking/', views.do_tracking, name='do_tracking'),
     path('api/do_square_rois/', views.do_square_rois, name='do_square_rois'),
     path('api/do_export/', views.do_export, name='do_export'),
+    path('api/do_pipeline/', views.do_pipeline, name='do_pipeline'),
+    path('api/jobs/', views.job_list, name='job_list'),
+    path('api/jobs/<int:job_id>/', views.job_detail, name='job_detail'),
+    path('api/jobs/<int:job_id>/cancel/', views.job_cancel, name='job_cancel'),
+    path('api/metrics/', views.metrics, name='metrics'),
+    path('api/segmentation/preview/', views.segmentation_preview, name='segmentation_preview'),
+    path('api/segmentation/sweep/', views.segmentation_sweep, name='segmentation_sweep'),
+    path('api/curation/preview/', views.curation_preview, name='curation_preview'),
+    path('api/curation/apply/', views.curation_apply, name='curation_apply'),
     path('api/list_directory/', views.list_directory, name='list_directory'),
     path('api/select_folder/', views.select_folder, name='select_folder'),
 ]
\ No newline at end of file
@@ -1,23 +1,93 @@
+from django.conf import settings
 from django.shortcuts import render, redirect
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse, HttpResponseNotModified
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET
+from django.urls import reverse
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, urlencode
+import hashlib
 import json
 import os
 import sys
+import threading
+from contextlib import contextmanager
+from importlib import import_module
+
+from . import discovery, jobs
+from .models import Job
 
 # Add old directory to path to import Flask utilities
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'old'))
 
-try:
-    from gui import CellViewer
-    import pyama_util
-except ImportError:
-    CellViewer = None
-    pyama_util = None
-
-# HashMap to store CellViewer instances by user session
+from dataset_cache import shared_cache
+from nd2_metadata import metadata_cache
+from pipeline_metrics import read_metrics
+shared_cache.max_bytes = settings.DATASET_CACHE_MAX_BYTES
+shared_cache.max_entries = settings.DATASET_CACHE_MAX_ENTRIES
+metadata_cache.path = settings.ND2_METADATA_CACHE
+
+
+class LazyImport:
+    """
+    Module, or attribute of a module, imported on first use. Falsy if the import fails.
+
+    gui and pyama_util pull in plotly, h5py, cv2, pandas, scipy, skimage and numba, which would
+    otherwise be loaded by every process importing the views before serving anything.
+    """
+
+    def __init__(self, module, attribute=None):
+        self._module = module
+        self._attribute = attribute
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    try:
+                        value = import_module(self._module)
+                        if self._attribute is not None:
+                            value = getattr(value, self._attribute)
+                    except ImportError:
+                        value = None
+                    self._value = value
+                    self._loaded = True
+        return self._value
+
+    def __bool__(self):
+        return self._load() is not None
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __contains__(self, item):
+        value = self._load()
+        return value is not None and item in value
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+
+CellViewer = LazyImport('gui', 'CellViewer')
+IMAGE_FORMATS = LazyImport('gui', 'IMAGE_FORMATS')
+pyama_util = LazyImport('pyama_util')
+preview_cache = LazyImport('segmentation_preview', 'preview_cache')
+
+# Image URLs carry the tracks revision, so browsers may keep them for a while
+IMAGE_MAX_AGE = 24 * 60 * 60
+
+# HashMap to store CellViewer instances by user session. This is only a per-process cache,
+# the navigation state lives in the session so that any worker process can rebuild the viewer.
 user_cell_viewers = {}
+user_cell_viewers_lock = threading.Lock()
+VIEWER_STATE_KEY = 'viewer_state'
 
 def cleanup_expired_viewers():
     """Remove CellViewer instances for expired sessions"""
@@ -47,9 +117,58 @@ def get_user_id(request):
     return request.session.session_key
 
 def get_cell_viewer(request):
-    """Get CellViewer instance for current user"""
-    user_id = get_user_id(request)
-    return user_cell_viewers.get(user_id)
+    """
+    Get CellViewer instance for current user. It is rebuilt from the session state if this
+    process has none, see viewer_lock for keeping it in line with the session.
+    """
+    get_user_id(request)
+    return session_cell_viewer(request.session)
+
+def session_cell_viewer(session):
+    """Get CellViewer instance of a session, also used by the viewer WebSocket"""
+    user_id = session.session_key
+    state = session.get(VIEWER_STATE_KEY)
+    if state is None or not CellViewer:
+        return user_cell_viewers.get(user_id)
+
+    with user_cell_viewers_lock:
+        cell_viewer = user_cell_viewers.get(user_id)
+        paths = (state['nd2_path'], state['output_path'], state['init_type'])
+        if cell_viewer is None or (cell_viewer.nd2_path, cell_viewer.output_path, cell_viewer.init_type) != paths:
+            if cell_viewer is not None:
+                cell_viewer.cleanup()
+            cell_viewer = CellViewer.from_state(state)
+            cell_viewer.state_seq = state['seq']
+            user_cell_viewers[user_id] = cell_viewer
+            return cell_viewer
+
+    return cell_viewer
+
+@contextmanager
+def viewer_lock(session, cell_viewer):
+    """
+    Hold the viewer for a request. While holding it, the viewer is moved to the session state
+    if another process saved a newer one, and picks up enable edits made elsewhere.
+    """
+    with cell_viewer.lock:
+        state = session.get(VIEWER_STATE_KEY)
+        # Requests that loaded the session before a newer save must not move the viewer back
+        if state is not None and state['seq'] > cell_viewer.state_seq:
+            cell_viewer.restore_state(state)
+            cell_viewer.state_seq = state['seq']
+        else:
+            cell_viewer.refresh_tracks()
+        yield
+
+def save_viewer_state(session, cell_viewer):
+    """Store the navigation state of the viewer in the session, only written if it changed"""
+    state = cell_viewer.state()
+    saved = session.get(VIEWER_STATE_KEY)
+    if saved is not None and {k: v for k, v in saved.items() if k != 'seq'} == state:
+        return
+    cell_viewer.state_seq = max(cell_viewer.state_seq, saved['seq'] if saved else 0) + 1
+    state['seq'] = cell_viewer.state_seq
+    session[VIEWER_STATE_KEY] = state
 
 def create_cell_viewer(request, nd2_path, output_path, init_type):
     """Create a new CellViewer instance for current user"""
@@ -57,13 +176,60 @@ def create_cell_viewer(request, nd2_path, output_path, init_type):
         return None
     
     user_id = get_user_id(request)
+    # Give the shared datasets of a previous viewer back
+    previous = user_cell_viewers.get(user_id)
+    if previous is not None and hasattr(previous, 'cleanup'):
+        previous.cleanup()
     user_cell_viewers[user_id] = CellViewer(
         nd2_path=nd2_path,
         output_path=output_path,
         init_type=init_type
     )
+    save_viewer_state(request.session, user_cell_viewers[user_id])
     return user_cell_viewers[user_id]
 
+def image_url(cell_viewer, overlay=True):
+    """URL of the binary image endpoint for the viewer's current state"""
+    params = cell_viewer.image_params()
+    url = reverse('core:image', args=[params['position'], params['channel'], params['frame']])
+    lower, upper = params['contrast'][params['channel']]
+    query = {
+        'x': params['x'],
+        'y': params['y'],
+        'lower': lower,
+        'upper': upper,
+    }
+    # Raw images do not depend on selection or tracks, so they stay cached across edits
+    if overlay:
+        query['particle'] = params['particle']
+        query['rev'] = params['rev']
+    query['overlay'] = int(overlay)
+    return f'{url}?{urlencode(query)}'
+
+def navigate(cell_viewer, query, position, frame):
+    """
+    Move the viewer to the position, frame, particle and crop addressed by query parameters.
+    Returns the set of what changed besides frame and crop ('position', 'particle').
+    """
+    changed = set()
+    if position != cell_viewer.position_index():
+        cell_viewer.position = cell_viewer.position_options[position]
+        cell_viewer.position_changed()
+        changed.add('position')
+
+    if 'particle' in query:
+        particle = int(query['particle'])
+        if particle != cell_viewer.particle_index():
+            cell_viewer.particle = cell_viewer.all_particles[particle]
+            cell_viewer.particle_changed()
+            changed.add('particle')
+
+    cell_viewer.frame = frame
+    if 'x' in query and 'y' in query:
+        cell_viewer.x = int(query['x'])
+        cell_viewer.y = int(query['y'])
+    return changed
+
 def index(request):
     return render(request, 'pages/index.html')
 
@@ -97,19 +263,24 @@ def view(request):
     if cell_viewer is None:
         return redirect('core:index')
     
-    cell_viewer.position_changed()
-    current_particle_index = cell_viewer.particle_index()
+    with viewer_lock(request.session, cell_viewer):
+        cell_viewer.position_changed()
+        current_particle_index = cell_viewer.particle_index()
+        save_viewer_state(request.session, cell_viewer)
     
-    context = {
-        'channel_image': cell_viewer.return_image(),
-        'n_positions': len(cell_viewer.positions),
-        'n_channels': cell_viewer.channel_max,
-        'n_frames': cell_viewer.frame_max,
-        'all_particles_len': cell_viewer.all_particles_len,
-        'current_particle_index': current_particle_index,
-        'brightness_plot': cell_viewer.brightness_plot,
-        'disabled_particles': cell_viewer.disabled_particles
-    }
+        context = {
+            'image_url': image_url(cell_viewer, overlay=False),
+            'image_params': cell_viewer.image_params(),
+            'n_positions': len(cell_viewer.positions),
+            'n_channels': cell_viewer.channel_max,
+            'n_frames': cell_viewer.frame_max,
+            'all_particles_len': cell_viewer.all_particles_len,
+            'current_particle_index': current_particle_index,
+            'brightness_plot': cell_viewer.brightness_plot,
+            'disabled_particles': cell_viewer.disabled_particles,
+            'contrast_lower': cell_viewer.get_contrast(cell_viewer.channel)[0],
+            'contrast_upper': cell_viewer.get_contrast(cell_viewer.channel)[1]
+        }
     return render(request, 'pages/view.html', context)
 
 def preprocess(request):
@@ -130,28 +301,252 @@ def update_image(request):
         new_frame = int(request.POST['frame'])
         new_particle = int(request.POST['particle'])
 
-        if new_position != cell_viewer.position:
-            cell_viewer.position = cell_viewer.position_options[new_position]
-            cell_viewer.position_changed()
+        ticket = cell_viewer.render_ticket('update')
+        with viewer_lock(request.session, cell_viewer):
+            # A newer update of this session is waiting, the browser will discard this one
+            if not cell_viewer.is_latest('update', ticket):
+                return JsonResponse({'superseded': True})
+
+            if new_position != cell_viewer.position_index():
+                cell_viewer.position = cell_viewer.position_options[new_position]
+                cell_viewer.position_changed()
+
+            if new_particle != cell_viewer.particle_index():
+                cell_viewer.particle = cell_viewer.all_particles[new_particle]
+                cell_viewer.particle_changed()
+
+            cell_viewer.channel = new_channel
+            cell_viewer.frame = new_frame
+            save_viewer_state(request.session, cell_viewer)
+
+            # The image itself is fetched by the browser from image_url
+            return JsonResponse({
+                'image_url': image_url(cell_viewer),
+                'image_params': cell_viewer.image_params(),
+                'brightness_plot': cell_viewer.brightness_plot,
+                'all_particles_len': cell_viewer.all_particles_len,
+                'particle_enabled': cell_viewer.particle_enabled,
+                'current_particle': cell_viewer.particle,
+                'disabled_particles': cell_viewer.disabled_particles,
+                'contrast': cell_viewer.get_contrast(cell_viewer.channel)
+            })
+
+def superseded():
+    """Response for a render request overtaken by a newer one of the same session, the browser has moved on"""
+    response = HttpResponse(status=204)
+    response['Cache-Control'] = 'no-store'
+    return response
+
+def url_etag(cell_viewer, request, position=None):
+    """
+    ETag of a GET whose response only depends on its URL and the viewer's files, and for overlay
+    images and outlines on the tracks of position. The 'rev' of their URLs only busts the browser
+    cache, the ETag takes the version of the rendered position from its files, whatever 'rev' says.
+    """
+    key = (cell_viewer.nd2_path, cell_viewer.output_path, request.get_full_path())
+    if position is not None:
+        key += (cell_viewer.position_version(position),)
+    return '"' + hashlib.sha1(repr(key).encode()).hexdigest() + '"'
+
+def view_params(cell_viewer, query, position, frame, channel=0):
+    """
+    Position index, channel, frame, crop and contrast addressed by an image URL, see CellViewer.render_view.
+    Raises IndexError if the position, channel, frame or particle is out of range, ValueError (or
+    KeyError for a missing parameter) if the query is malformed.
+    """
+    if not (0 <= position < len(cell_viewer.position_options) and 0 <= channel <= cell_viewer.channel_max
+            and 0 <= frame < cell_viewer.metadata['num_frames']):
+        raise IndexError(position)
+    view = {
+        'position': position,
+        'channel': channel,
+        'frame': frame,
+        'x': int(query.get('x', 0)),
+        'y': int(query.get('y', 0)),
+        'lower': int(query['lower']) if 'lower' in query else cell_viewer.get_contrast(channel)[0],
+        'upper': int(query['upper']) if 'upper' in query else cell_viewer.get_contrast(channel)[1],
+        'particle': int(query['particle']) if 'particle' in query else None,
+    }
+    if not (0 <= view['lower'] < view['upper'] <= 65535):
+        raise ValueError('Contrast limits must satisfy 0 <= lower < upper <= 65535')
+    if not (0 <= view['x'] <= cell_viewer.metadata['height'] and 0 <= view['y'] <= cell_viewer.metadata['width']):
+        raise IndexError(view['x'], view['y'])
+    return view
+
+@require_GET
+def image(request, position, channel, frame):
+    """
+    Raw image bytes for (position, channel, frame, crop, contrast, overlay state), all taken from the
+    URL. Neither the viewer nor the session is changed, so prefetches and cached responses cannot
+    move the viewer. Responses carry a strong ETag and Cache-Control so revisited frames come from
+    the browser cache. Requests wait for the one being rendered, only the newest waiting request is rendered.
+    """
+    cell_viewer = get_cell_viewer(request)
+    if not cell_viewer or cell_viewer.position is None:
+        return JsonResponse({'error': 'Cell viewer not initialized'}, status=400)
 
-        if new_particle != cell_viewer.particle:
-            cell_viewer.particle = cell_viewer.all_particles[new_particle]
-            cell_viewer.particle_changed()
+    fmt = request.GET.get('format', 'jpeg')
+    if fmt not in IMAGE_FORMATS:
+        return JsonResponse({'error': f'Unsupported format: {fmt}'}, status=400)
+    overlay = request.GET.get('overlay', '1') != '0'
+    try:
+        view = view_params(cell_viewer, request.GET, position, frame, channel)
+    except IndexError:
+        return JsonResponse({'error': 'Position, channel, frame or crop out of range'}, status=404)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
-        cell_viewer.channel = new_channel
-        cell_viewer.frame = new_frame
+    etag = url_etag(cell_viewer, request, position if overlay else None)
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        ticket = cell_viewer.render_ticket('image')
+        with viewer_lock(request.session, cell_viewer):
+            if not cell_viewer.is_latest('image', ticket):
+                return superseded()
+            response = HttpResponse(cell_viewer.render_view(view, fmt, overlay), content_type=IMAGE_FORMATS[fmt][1])
+
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, max_age=IMAGE_MAX_AGE)
+    return response
+
+@require_GET
+def outlines(request, position, frame):
+    """
+    Cell contours of a frame's crop as polygons keyed by label, with particle index and enabled flag.
+    The browser draws them over a raw cached image, so selection and enable changes need no image rendering.
+    """
+    cell_viewer = get_cell_viewer(request)
+    if not cell_viewer or cell_viewer.position is None:
+        return JsonResponse({'error': 'Cell viewer not initialized'}, status=400)
 
-        cell_viewer.get_channel_image()
-        cell_viewer.draw_outlines()
-        
-        return JsonResponse({
-            'channel_image': cell_viewer.return_image(),
-            'brightness_plot': cell_viewer.brightness_plot,
-            'all_particles_len': cell_viewer.all_particles_len,
-            'particle_enabled': cell_viewer.particle_enabled,
-            'current_particle': cell_viewer.particle,
-            'disabled_particles': cell_viewer.disabled_particles
-        })
+    try:
+        view = view_params(cell_viewer, request.GET, position, frame)
+    except IndexError:
+        return JsonResponse({'error': 'Position, frame or crop out of range'}, status=404)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    # Like image, the viewer and the session are left alone
+    etag = url_etag(cell_viewer, request, position)
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        ticket = cell_viewer.render_ticket('outlines')
+        with viewer_lock(request.session, cell_viewer):
+            if not cell_viewer.is_latest('outlines', ticket):
+                return superseded()
+            response = JsonResponse({
+                'x': view['x'],
+                'y': view['y'],
+                'width': 2 * cell_viewer.image_size,
+                'height': 2 * cell_viewer.image_size,
+                'cells': cell_viewer.outline_polygons(position, frame, view['x'], view['y']),
+            })
+
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, max_age=IMAGE_MAX_AGE)
+    return response
+
+def query_limit(request, default):
+    """?limit= of a list request, a positive integer, raises ValueError otherwise"""
+    try:
+        limit = int(request.GET.get('limit', default))
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        raise ValueError('limit must be a positive integer')
+    return limit
+
+def particle_query(request):
+    """Sort statistic, direction and enabled filter of a particle navigation request"""
+    sort = request.GET.get('sort') or None
+    descending = request.GET.get('order') == 'desc'
+    enabled = request.GET.get('enabled')
+    enabled = None if enabled in (None, '') else enabled == '1'
+    return sort, descending, enabled
+
+@require_GET
+def particles(request):
+    """
+    Particles of the current position from the cached track summary, sorted by a statistic
+    and filtered by enabled state, e.g. ?sort=brightness_0_max&order=desc&limit=50
+    """
+    cell_viewer = get_cell_viewer(request)
+    if not cell_viewer or cell_viewer.position is None:
+        return JsonResponse({'error': 'Cell viewer not initialized'}, status=400)
+
+    sort, descending, enabled = particle_query(request)
+    try:
+        limit = query_limit(request, 50)
+        with viewer_lock(request.session, cell_viewer):
+            rows = cell_viewer.particle_list(sort, descending, enabled, limit)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    columns = [c for c in cell_viewer.track_summary.columns if c != 'enabled']
+    return JsonResponse({
+        'columns': columns,
+        'particles': [{
+            'index': int(row['index']),
+            'enabled': bool(row['enabled']),
+            'value': None if sort is None else float(row[sort]),
+        } for _, row in rows.iterrows()],
+    })
+
+@require_GET
+def next_particle(request):
+    """Index of the next (step=1) or previous (step=-1) particle in the requested order"""
+    cell_viewer = get_cell_viewer(request)
+    if not cell_viewer or cell_viewer.position is None:
+        return JsonResponse({'error': 'Cell viewer not initialized'}, status=400)
+
+    sort, descending, enabled = particle_query(request)
+    try:
+        step = int(request.GET.get('step', 1))
+        current = int(request.GET['particle']) if 'particle' in request.GET else None
+        with viewer_lock(request.session, cell_viewer):
+            index = cell_viewer.next_particle(sort, descending, enabled, step, current)
+    except (ValueError, IndexError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'index': index})
+
+@require_GET
+def particle_at(request, position, frame):
+    """Index of the particle under a pixel of a frame, ?row=&col= in frame coordinates"""
+    cell_viewer = get_cell_viewer(request)
+    if not cell_viewer or cell_viewer.position is None:
+        return JsonResponse({'error': 'Cell viewer not initialized'}, status=400)
+    try:
+        row = int(request.GET['row'])
+        col = int(request.GET['col'])
+    except (KeyError, ValueError) as e:
+        return JsonResponse({'error': f'Invalid parameter: {e}'}, status=400)
+    if not 0 <= position < len(cell_viewer.position_options):
+        return JsonResponse({'error': 'Position out of range'}, status=404)
+    return JsonResponse({'index': cell_viewer.particle_at(position, frame, row, col)})
+
+@csrf_exempt
+def update_contrast(request):
+    if request.method == 'POST':
+        cell_viewer = get_cell_viewer(request)
+        if not cell_viewer:
+            return JsonResponse({'error': 'Cell viewer not initialized'}, status=400)
+        data = json.loads(request.body)
+        channel = int(data['channel'])
+        with viewer_lock(request.session, cell_viewer):
+            try:
+                cell_viewer.set_contrast(channel, int(data['lower']), int(data['upper']))
+            except ValueError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+            save_viewer_state(request.session, cell_viewer)
+
+            return JsonResponse({
+                'image_url': image_url(cell_viewer),
+                'image_params': cell_viewer.image_params(),
+                'contrast': cell_viewer.get_contrast(channel)
+            })
+    return JsonResponse({'error': 'Cell viewer not initialized'}, status=400)
 
 @csrf_exempt
 def update_particle_enabled(request):
@@ -161,17 +556,25 @@ def update_particle_enabled(request):
             return JsonResponse({'error': 'Cell viewer not initialized'}, status=400)
         data = json.loads(request.body)
         enabled = data['enabled']
-        cell_viewer.particle_enabled = enabled
-        cell_viewer.particle_enabled_changed()
-        
-        return JsonResponse({
-            'channel_image': cell_viewer.return_image(),
-            'brightness_plot': cell_viewer.brightness_plot,
-            'all_particles_len': cell_viewer.all_particles_len,
-            'disabled_particles': cell_viewer.disabled_particles
-        })
+        with viewer_lock(request.session, cell_viewer):
+            cell_viewer.particle_enabled = enabled
+            cell_viewer.particle_enabled_changed()
+
+            # Only the toggled trace changes, the browser restyles it instead of redrawing the plot
+            return JsonResponse({
+                'image_url': image_url(cell_viewer),
+                'image_params': cell_viewer.image_params(),
+                'plot_style': cell_viewer.plot_style,
+                'all_particles_len': cell_viewer.all_particles_len,
+                'disabled_particles': cell_viewer.disabled_particles
+            })
     return JsonResponse({'error': 'Cell viewer not initialized'}, status=400)
 
+def submit_job(kind, params):
+    """Queue a pipeline stage, the browser follows it through the job endpoints"""
+    job = jobs.submit(kind, params)
+    return JsonResponse({'status': 'queued', 'job_id': job.pk})
+
 @csrf_exempt
 def do_segmentation(request):
     if request.method == 'POST':
@@ -196,8 +599,20 @@ def do_segmentation(request):
 
         segmentation_channel = segmentation_channel[0] if len(segmentation_channel) == 1 else segmentation_channel
 
-        pyama_util.segment_positions(nd2_path, out_dir, positions, segmentation_channel, fluorescence_channels, frame_min=frame_min, frame_max=frame_max)
-        return JsonResponse({'status': 'success'})
+        chunk_size = data.get('chunk_size', 256)
+
+        return submit_job('segmentation', {
+            'positions': positions,
+            'nd2_path': nd2_path,
+            'out_dir': out_dir,
+            'segmentation_channel': segmentation_channel,
+            'fluorescence_channels': fluorescence_channels,
+            'frame_min': frame_min,
+            'frame_max': frame_max,
+            'chunk_size': chunk_size,
+            'tile_size': data.get('tile_size'),
+            'force': bool(data.get('force', False)),
+        })
 
 @csrf_exempt
 def do_tracking(request):
@@ -210,8 +625,8 @@ def do_tracking(request):
         positions = list(range(data['position_min'], data['position_max'] + 1))
         expand_labels = data['expand_labels']
 
-        pyama_util.tracking_pyama(out_dir, positions, expand=expand_labels)
-        return JsonResponse({'status': 'success'})
+        return submit_job('tracking', {'positions': positions, 'out_dir': out_dir, 'expand_labels': expand_labels,
+                                       'force': bool(data.get('force', False))})
 
 @csrf_exempt
 def do_square_rois(request):
@@ -224,8 +639,8 @@ def do_square_rois(request):
         positions = list(range(data['position_min'], data['position_max'] + 1))
         square_um_size = data['square_size']
 
-        pyama_util.square_roi(out_dir, positions, square_um_size)
-        return JsonResponse({'status': 'success'})
+        return submit_job('square_rois', {'positions': positions, 'out_dir': out_dir, 'square_size': square_um_size,
+                                          'force': bool(data.get('force', False))})
 
 @csrf_exempt
 def do_export(request):
@@ -238,18 +653,214 @@ def do_export(request):
         positions = list(range(data['position_min'], data['position_max'] + 1))
         minutes = data['minutes']
 
+        return submit_job('export', {'positions': positions, 'out_dir': out_dir, 'minutes': minutes,
+                                     'force': bool(data.get('force', False))})
+
+@csrf_exempt
+def do_pipeline(request):
+    """Segmentation, tracking, square ROIs and export as one job, the positions flow through the steps"""
+    if request.method == 'POST':
+        cell_viewer = get_cell_viewer(request)
+        if not cell_viewer or not pyama_util:
+            return JsonResponse({'error': 'Cell viewer not initialized'}, status=400)
+        data = json.loads(request.body)
+        positions = list(range(data['position_min'], data['position_max'] + 1))
+
+        segmentation_channel = []
+        fluorescence_channels = []
+        for i in range(cell_viewer.channel_max + 1):
+            channel_type = data[f'channel_{i}']
+            if channel_type == 'Brightfield':
+                segmentation_channel.append(i)
+            elif channel_type == 'Fluorescent':
+                fluorescence_channels.append(i)
+        if len(segmentation_channel) != 1:
+            return JsonResponse({'status': 'error', 'message': 'Select exactly one Brightfield channel'}, status=400)
+
+        return submit_job('pipeline', {
+            'positions': positions,
+            'nd2_path': cell_viewer.nd2_path,
+            'out_dir': cell_viewer.output_path,
+            'segmentation_channel': segmentation_channel[0],
+            'fluorescence_channels': fluorescence_channels,
+            'frame_min': data['frame_min'],
+            'frame_max': data['frame_max'],
+            'chunk_size': data.get('chunk_size', 256),
+            'tile_size': data.get('tile_size'),
+            'expand_labels': data['expand_labels'],
+            'square_size': data.get('square_size'),
+            'minutes': data['minutes'],
+            'force': bool(data.get('force', False)),
+        })
+
+@require_GET
+def job_list(request):
+    """Recent jobs, ?active=1 for queued and running ones only"""
+    jobs.ensure_dispatcher()
+    queryset = Job.objects.all()
+    if request.GET.get('active') == '1':
+        queryset = queryset.exclude(status__in=Job.FINISHED)
+    try:
+        limit = query_limit(request, 20)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'jobs': [job.as_dict(log=False) for job in queryset[:limit]]})
+
+@require_GET
+def job_detail(request, job_id):
+    try:
+        job = Job.objects.get(pk=job_id)
+    except Job.DoesNotExist:
+        return JsonResponse({'error': 'Job not found'}, status=404)
+    return JsonResponse(job.as_dict())
+
+@csrf_exempt
+def job_cancel(request, job_id):
+    if request.method == 'POST':
         try:
-            pyama_util.csv_output(out_dir, positions, minutes)
-            return JsonResponse({'status': 'success'})
-        except Exception as e:
+            job = Job.objects.get(pk=job_id)
+        except Job.DoesNotExist:
+            return JsonResponse({'error': 'Job not found'}, status=404)
+        jobs.cancel(job)
+        return JsonResponse(job.as_dict(log=False))
+
+@require_GET
+def metrics(request):
+    """Timings of the pipeline steps per position, from the metrics.json files of the output folder"""
+    cell_viewer = get_cell_viewer(request)
+    if not cell_viewer or not pyama_util:
+        return JsonResponse({'error': 'Cell viewer not initialized'}, status=400)
+    try:
+        positions = range(int(request.GET['position_min']), int(request.GET['position_max']) + 1)
+    except (KeyError, ValueError) as e:
+        return JsonResponse({'status': 'error', 'message': f'Invalid parameter: {e}'}, status=400)
+    result = []
+    for pos in positions:
+        pos_path = pyama_util.position_path(cell_viewer.output_path, pos)
+        if pos_path is None:
+            continue
+        result.append({'position': pos, 'metrics': read_metrics(pos_path)})
+    return JsonResponse({'positions': result})
+
+@require_GET
+def segmentation_preview(request):
+    """Segment one frame of a position, ?scale=2 or more downsamples it first, see old/segmentation_preview.py"""
+    cell_viewer = get_cell_viewer(request)
+    if not cell_viewer or not preview_cache:
+        return JsonResponse({'error': 'Cell viewer not initialized'}, status=400)
+    try:
+        position = int(request.GET['position'])
+        frame = int(request.GET['frame'])
+        channel = int(request.GET['channel'])
+        scale = int(request.GET.get('scale', 1))
+        parameters = {'mask_size': int(request.GET.get('mask_size', 3)),
+                      'threshold': float(request.GET.get('threshold', 3)),
+                      'min_size': int(request.GET.get('min_size', 1000))}
+    except (KeyError, ValueError) as e:
+        return JsonResponse({'status': 'error', 'message': f'Invalid parameter: {e}'}, status=400)
+    metadata = cell_viewer.metadata
+    if (position not in metadata['fields_of_view'] or frame not in metadata['frames']
+            or not 0 <= channel < len(metadata['channels']) or scale not in (1, 2, 4, 8)):
+        return JsonResponse({'status': 'error', 'message': 'Position, frame, channel or scale out of range'}, status=400)
+    if not valid_segmentation_parameters([parameters['mask_size']], [parameters['threshold']], [parameters['min_size']]):
+        return JsonResponse({'status': 'error', 'message': 'Invalid segmentation parameters'}, status=400)
+
+    result = preview_cache.preview(frame_reader(cell_viewer, position, frame, channel),
+                                   (cell_viewer.nd2_path, position, frame, channel), scale, **parameters)
+    return JsonResponse(dict(result, status='success', position=position, frame=frame, channel=channel, scale=scale,
+                             **parameters))
+
+def frame_reader(cell_viewer, position, frame, channel):
+    """Function reading one frame of the open ND2 file, for preview_cache"""
+    def read_frame():
+        nd2 = cell_viewer.nd2
+        with shared_cache.dataset_lock(nd2):
+            return nd2.get_frame_2D(t=frame, c=channel, v=position)
+    return read_frame
+
+def valid_segmentation_parameters(mask_sizes, thresholds, min_sizes):
+    # The std filter window needs an odd side length of at least 3
+    return (all(size >= 3 and size % 2 == 1 for size in mask_sizes) and all(t > 0 for t in thresholds)
+            and all(size >= 1 for size in min_sizes))
+
+@csrf_exempt
+def segmentation_sweep(request):
+    """Cell counts and areas of frames segmented with every combination of the given parameters"""
+    if request.method == 'POST':
+        cell_viewer = get_cell_viewer(request)
+        if not cell_viewer or not preview_cache:
+            return JsonResponse({'error': 'Cell viewer not initialized'}, status=400)
+        try:
+            data = json.loads(request.body)
+            position = int(data['position'])
+            frames = [int(frame) for frame in data['frames']]
+            channel = int(data['channel'])
+            scale = int(data.get('scale', 1))
+            mask_sizes = [int(size) for size in data.get('mask_sizes', [3])]
+            thresholds = [float(t) for t in data.get('thresholds', [3])]
+            min_sizes = [int(size) for size in data.get('min_sizes', [1000])]
+        except (KeyError, TypeError, ValueError) as e:
+            return JsonResponse({'status': 'error', 'message': f'Invalid parameter: {e}'}, status=400)
+        metadata = cell_viewer.metadata
+        if (position not in metadata['fields_of_view'] or not frames
+                or any(frame not in metadata['frames'] for frame in frames)
+                or not 0 <= channel < len(metadata['channels']) or scale not in (1, 2, 4, 8)):
+            return JsonResponse({'status': 'error', 'message': 'Position, frames, channel or scale out of range'}, status=400)
+        if (not mask_sizes or not thresholds or not min_sizes
+                or not valid_segmentation_parameters(mask_sizes, thresholds, min_sizes)):
+            return JsonResponse({'status': 'error', 'message': 'Invalid segmentation parameters'}, status=400)
+
+        read_frames = {(cell_viewer.nd2_path, position, frame, channel): frame_reader(cell_viewer, position, frame, channel)
+                       for frame in dict.fromkeys(frames)}
+        result = preview_cache.sweep(read_frames, scale, mask_sizes, thresholds, min_sizes)
+        return JsonResponse(dict(result, status='success', position=position, frames=list(dict.fromkeys(frames)),
+                                 channel=channel, scale=scale))
+
+def curation_request(request):
+    """Parse the positions, rules and target flag of a curation request"""
+    data = json.loads(request.body)
+    positions = list(range(data['position_min'], data['position_max'] + 1))
+    rules = data['rules']
+    enabled = bool(data.get('enabled', False))
+    return positions, rules, enabled
+
+@csrf_exempt
+def curation_preview(request):
+    if request.method == 'POST':
+        cell_viewer = get_cell_viewer(request)
+        if not cell_viewer or not pyama_util:
+            return JsonResponse({'error': 'Cell viewer not initialized'}, status=400)
+        positions, rules, enabled = curation_request(request)
+        try:
+            counts = pyama_util.curate_positions(cell_viewer.output_path, positions, rules, enabled)
+        except (KeyError, ValueError) as e:
             return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+        return JsonResponse({'status': 'success', 'positions': counts})
+
+@csrf_exempt
+def curation_apply(request):
+    if request.method == 'POST':
+        cell_viewer = get_cell_viewer(request)
+        if not cell_viewer or not pyama_util:
+            return JsonResponse({'error': 'Cell viewer not initialized'}, status=400)
+        positions, rules, enabled = curation_request(request)
+        try:
+            counts = pyama_util.curate_positions(cell_viewer.output_path, positions, rules, enabled, apply=True)
+        except (KeyError, ValueError) as e:
+            return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+        # The open position may have been rewritten
+        if cell_viewer.position is not None and cell_viewer.position[1][0] in positions:
+            with viewer_lock(request.session, cell_viewer):
+                cell_viewer.reload_tracks()
+        return JsonResponse({'status': 'success', 'positions': counts})
 
 def analysis(request):
     cell_viewer = get_cell_viewer(request)
     if cell_viewer is None:
         return redirect('core:index')
     
-    n_positions = len(cell_viewer.nd2.metadata['fields_of_view'])+1
+    n_positions = len(cell_viewer.metadata['fields_of_view'])+1
     context = {
         'n_positions': n_positions,
         'n_channels': cell_viewer.channel_max,
@@ -260,13 +871,17 @@ def analysis(request):
 def list_directory(request):
     path = request.GET.get('path', '/')
     try:
-        items = os.listdir(path)
-        return JsonResponse({
-            'path': path,
-            'items': [{'name': item, 'isDirectory': os.path.isdir(os.path.join(path, item))} for item in items]
-        })
-    except Exception as e:
-        return JsonResponse({'error': str(e)}, status=400)
+        page = max(1, int(request.GET.get('page', 1)))
+        page_size = min(1000, max(1, int(request.GET.get('page_size', settings.DISCOVERY_PAGE_SIZE))))
+    except ValueError as e:
+        return JsonResponse({'error': f'Invalid parameter: {e}'}, status=400)
+    discovery.ensure_scanner()
+    try:
+        return JsonResponse(discovery.list_entries(path, query=request.GET.get('q', '').strip(),
+                                                   kind=request.GET.get('kind', ''), page=page, page_size=page_size))
+    except OSError as e:
+        # Unindexed paths are listed live
+        return JsonResponse({'error': f'Cannot list {path}: {e.strerror or e}'}, status=404)
 
 @csrf_exempt
 def select_folder(request):
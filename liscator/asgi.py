@@ -2,6 +2,7 @@
 ASGI config for liscator project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Besides the Django application it serves the viewer WebSocket, see core/stream.py.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -13,4 +14,18 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'liscator.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after Django is set up
+from core.stream import VIEWER_SOCKET_PATH, viewer_socket  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        if scope['path'] == VIEWER_SOCKET_PATH:
+            await viewer_socket(scope, receive, send)
+        else:
+            await receive()
+            await send({'type': 'websocket.close', 'code': 4004})
+        return
+    await django_application(scope, receive, send)
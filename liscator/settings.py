@@ -124,3 +124,24 @@ STATICFILES_DIRS = [
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Ceiling for the process-wide cache of ND2 readers and loaded positions shared by all
+# viewer sessions (old/dataset_cache.py). Least recently used datasets nobody is viewing
+# are closed above it.
+DATASET_CACHE_MAX_BYTES = 2 * 1024**3
+# Most datasets kept open, ND2 readers are only accounted with an estimated size
+DATASET_CACHE_MAX_ENTRIES = 64
+
+# SQLite file caching the metadata of opened ND2 files (old/nd2_metadata.py), so sessions
+# start without parsing the file again
+ND2_METADATA_CACHE = BASE_DIR / 'nd2_metadata.sqlite3'
+
+# Pipeline stages run as background jobs (core/jobs.py), at most this many at a time
+JOB_WORKERS = 2
+
+# Folders indexed for the file browser (core/discovery.py), rescanned in the background
+# every DISCOVERY_RESCAN_INTERVAL seconds. Other paths are listed live.
+DATA_ROOTS = []
+DISCOVERY_RESCAN_INTERVAL = 600
+# Entries per page of a file browser listing
+DISCOVERY_PAGE_SIZE = 200
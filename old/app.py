@@ -82,8 +82,6 @@ class App:
             self.cell_viewer.channel = new_channel
             self.cell_viewer.frame = new_frame
 
-            self.cell_viewer.get_channel_image()
-            self.cell_viewer.draw_outlines()
             return jsonify({
                 'channel_image': self.cell_viewer.return_image(),
                 'brightness_plot': self.cell_viewer.brightness_plot,
@@ -168,7 +166,7 @@ class App:
         def analysis():
             if self.cell_viewer is None:
                 return redirect(url_for('index'))
-            n_positions = len(self.cell_viewer.nd2.metadata['fields_of_view'])+1
+            n_positions = len(self.cell_viewer.metadata['fields_of_view'])+1
             return render_template('analysis.html',
                                    n_positions=n_positions,
                                    n_channels=self.cell_viewer.channel_max,
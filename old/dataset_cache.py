@@ -0,0 +1,164 @@
+import threading
+from collections import OrderedDict
+
+# Accounted size of datasets that cannot tell their own, e.g. ND2 readers: parsed metadata,
+# chunk map and buffers of an open file, a few MB for long time lapses
+DEFAULT_NBYTES = 8 * 1024**2
+
+
+class DatasetCache:
+    """
+    Process-wide cache of heavy read-only dataset objects (ND2 readers, loaded positions),
+    shared by all viewer sessions that open the same files.
+
+    Users acquire a dataset and release it when done. Resident bytes are tracked per entry and
+    the least recently used datasets nobody holds are closed when the total exceeds max_bytes or
+    more than max_entries are open, the latter bounds open files whatever their estimated size.
+    Datasets in use are never closed, so the total may exceed the ceiling while they are held.
+    """
+
+    def __init__(self, max_bytes=2 * 1024**3, max_entries=64):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        # id(value) -> entry, also holds entries replaced in the cache while still in use
+        self.held = {}
+        self.resident_bytes = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, key, loader, is_current=None):
+        """
+        Get the dataset stored under key, loading it with loader() if missing or no longer current.
+
+        Parameters:
+        key (hashable): Dataset key, e.g. ('nd2', path)
+        loader (callable): Creates the dataset
+        is_current (callable): Called with the cached dataset, False forces a reload
+
+        Returns:
+        The dataset, to be given back with release()
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and is_current is not None and not is_current(entry.value):
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                entry.refs += 1
+                return entry.value
+
+        # Load outside the lock, other datasets stay available meanwhile
+        value = loader()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                # Someone else loaded it first
+                self._close_value(value)
+            else:
+                entry = _Entry(key, value, dataset_nbytes(value))
+                self.entries[key] = entry
+                self.held[id(value)] = entry
+                self.resident_bytes += entry.nbytes
+            entry.refs += 1
+            self._evict()
+            return entry.value
+
+    def release(self, value):
+        """
+        Give back a dataset obtained from acquire()
+
+        Parameters:
+        value: The dataset
+        """
+        with self.lock:
+            entry = self.held.get(id(value))
+            if entry is None:
+                return
+            entry.refs -= 1
+            if entry.refs <= 0 and self.entries.get(entry.key) is not entry:
+                # Replaced or evicted while in use
+                self._close_entry(entry)
+            self._evict()
+
+    def dataset_lock(self, value):
+        """
+        Lock serializing access to a dataset whose reader is not thread-safe (e.g. ND2 file seeks)
+
+        Parameters:
+        value: The dataset
+
+        Returns:
+        threading.RLock: Lock of the dataset
+        """
+        return self.held[id(value)].lock
+
+    def resize(self, value):
+        """
+        Update the accounted size of a dataset after it was reloaded in place
+
+        Parameters:
+        value: The dataset
+        """
+        with self.lock:
+            entry = self.held.get(id(value))
+            if entry is None or self.entries.get(entry.key) is not entry:
+                return
+            nbytes = dataset_nbytes(value)
+            self.resident_bytes += nbytes - entry.nbytes
+            entry.nbytes = nbytes
+            self._evict()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'datasets': len(self.entries),
+                'resident_bytes': self.resident_bytes,
+                'max_bytes': self.max_bytes,
+                'max_entries': self.max_entries,
+                'in_use': sum(1 for entry in self.entries.values() if entry.refs > 0),
+            }
+
+    def _evict(self):
+        for key in list(self.entries.keys()):
+            if self.resident_bytes <= self.max_bytes and len(self.entries) <= self.max_entries:
+                break
+            if self.entries[key].refs == 0:
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.resident_bytes -= entry.nbytes
+        if entry.refs == 0:
+            self._close_entry(entry)
+
+    def _close_entry(self, entry):
+        self.held.pop(id(entry.value), None)
+        self._close_value(entry.value)
+
+    @staticmethod
+    def _close_value(value):
+        if hasattr(value, 'close'):
+            value.close()
+
+
+class _Entry:
+
+    def __init__(self, key, value, nbytes):
+        self.key = key
+        self.value = value
+        self.nbytes = nbytes
+        self.refs = 0
+        self.lock = threading.RLock()
+
+
+def dataset_nbytes(value):
+    """
+    Resident size of a dataset, from its nbytes() method if it has one, DEFAULT_NBYTES otherwise
+    """
+    if hasattr(value, 'nbytes') and callable(value.nbytes):
+        return int(value.nbytes())
+    return DEFAULT_NBYTES
+
+
+shared_cache = DatasetCache()
@@ -15,7 +15,17 @@ import base64
 from PIL import Image
 
 import pathlib
+import threading
 import warnings
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from pyama_util import label_outlines, read_tracks, append_tracks_journal, compact_tracks_journal, load_track_summary, \
+    read_tracks_journal_tail, apply_tracks_journal, enabled_mask, TRACKS_JOURNAL
+from utils import uint16_to_uint8_lut
+from dataset_cache import shared_cache
+from nd2_metadata import metadata_cache
+from label_index import LabelIndex, runs_mask
 warnings.filterwarnings("ignore", category=np.VisibleDeprecationWarning)
 
 
@@ -26,6 +36,24 @@ def are_all_enabled(group):
     """
     return (group == 1).all()
 
+# format name -> (cv2 encoder extension, content type)
+IMAGE_FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg'),
+    'webp': ('.webp', 'image/webp'),
+    'png': ('.png', 'image/png'),
+}
+
+def file_signature(path):
+    """
+    Cheap change marker of a file built from its mtime and size.
+    Returns an empty string if the file does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return ''
+    return f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+
 def numpy_to_b64_string(image):
     rawBytes = BytesIO()
     im = Image.fromarray(image)
@@ -35,14 +63,203 @@ def numpy_to_b64_string(image):
     img_str = image.decode('utf-8')
     return img_str
 
+class PositionData:
+    """
+    State of a position loaded from data.h5 and tracks.csv: the open HDF5 file, tracks,
+    per-particle plot arrays and the track summary. Kept while the files are unchanged.
+
+    The tracks are reloaded in place when tracks.csv or the journal change, which bumps
+    generation. A rewritten data.h5 is never reopened in place, viewers load a new PositionData.
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.data_signature = file_signature(os.path.join(data_dir, 'data.h5'))
+        self.file = h5py.File(os.path.join(data_dir, 'data.h5'), "r")
+        self.label_index = LabelIndex(self.file)
+        # Incremented whenever the tracks change, viewers compare it with the generation they use
+        self.generation = 0
+        self.load_tracks()
+
+    @staticmethod
+    def files_signature(data_dir):
+        return file_signature(os.path.join(data_dir, 'tracks.csv')) + '.' + \
+            file_signature(os.path.join(data_dir, 'data.h5'))
+
+    def journal_state(self):
+        # (inode, size) of the journal, a new inode means it was rotated by a compaction
+        try:
+            stat = os.stat(os.path.join(self.data_dir, TRACKS_JOURNAL))
+        except FileNotFoundError:
+            return None, 0
+        return stat.st_ino, stat.st_size
+
+    def load_tracks(self):
+        self.generation += 1
+        self.signature = PositionData.files_signature(self.data_dir)
+        # Taken before reading, edits appended meanwhile are applied again by refresh() which is harmless
+        self.journal_id, self.journal_offset = self.journal_state()
+        self.tracks = read_tracks(pathlib.Path(self.data_dir))
+        # Fresh tracking writes a boolean column, enable edits store 1/0
+        self.tracks['enabled'] = self.tracks['enabled'].astype(object)
+        self.particles = list(self.tracks['particle'].unique())
+        self.particle_indices = {p: i for i, p in enumerate(self.particles)}
+
+        # Rows of each particle from one groupby instead of one filter per particle
+        rows = self.tracks.groupby('particle', sort=False).indices
+        frames = self.tracks['frame'].values
+        brightness = self.tracks['brightness_0'].values
+        area = self.tracks['area'].values
+        self.brightness_x = [frames[rows[p]] for p in self.particles]
+        self.brightness_y = [brightness[rows[p]] for p in self.particles]
+        self.area_x = [frames[rows[p]] for p in self.particles]
+        self.area_y = [area[rows[p]] for p in self.particles]
+
+        self.track_summary = load_track_summary(pathlib.Path(self.data_dir), self.tracks,
+                                                self.file.attrs['width'], self.file.attrs['height'])
+        self.summary_particle_index = np.array([self.particle_indices[p] for p in self.track_summary.index], dtype=int)
+        self.summary_orders = {}
+
+    def is_current(self):
+        return self.data_is_current() and self.signature == PositionData.files_signature(self.data_dir)
+
+    def data_is_current(self):
+        # False once data.h5 was rewritten (e.g. re-segmentation), the open file and label index are stale
+        return self.data_signature == file_signature(os.path.join(self.data_dir, 'data.h5'))
+
+    def refresh(self):
+        # Catch up with edits made elsewhere (other sessions or worker processes), bumps generation
+        # if the tracks changed. Callers check data_is_current() first.
+        if self.signature != PositionData.files_signature(self.data_dir):
+            self.load_tracks()
+            return
+
+        journal_id, size = self.journal_state()
+        if journal_id is None:
+            # Being compacted, the edits read so far stay valid until tracks.csv is replaced
+            self.journal_id, self.journal_offset = None, 0
+            return
+        if self.journal_id is not None and journal_id != self.journal_id:
+            # Rotated, edits appended before the rotation are only in the compacting file
+            self.load_tracks()
+            return
+        if journal_id == self.journal_id and size <= self.journal_offset:
+            return
+
+        # Only read the journal lines appended since the last look
+        offset = self.journal_offset if journal_id == self.journal_id else 0
+        edits, self.journal_offset = read_tracks_journal_tail(pathlib.Path(self.data_dir), offset)
+        self.journal_id = journal_id
+        if len(edits) == 0:
+            return
+        apply_tracks_journal(self.tracks, edits)
+        last = edits.drop_duplicates('particle', keep='last')
+        for particle, enabled in zip(last['particle'].values, last['enabled'].values):
+            self.track_summary.loc[self.track_summary.index == particle, 'enabled'] = bool(enabled)
+        self.generation += 1
+
+    def nbytes(self):
+        # Resident size for the shared dataset cache, HDF5 keeps a 1 MiB chunk cache per open dataset
+        arrays = self.brightness_x + self.brightness_y + self.area_x + self.area_y
+        return int(self.tracks.memory_usage(deep=True).sum() +
+                   self.track_summary.memory_usage(deep=True).sum() +
+                   sum(a.nbytes for a in arrays) +
+                   len(self.file.keys()) * 1024**2)
+
+    def close(self):
+        self.file.close()
+        # Nobody holds the tracks in memory anymore, fold pending edits into tracks.csv
+        threading.Thread(target=compact_tracks_journal, args=(pathlib.Path(self.data_dir),), daemon=True).start()
+
+# Rows of a particle that is not in the frame
+NO_ROWS = np.zeros(0, dtype=np.intp)
+
+class OutlineLut:
+    """
+    label -> RGBA table colouring the outlines of one frame of a position: tracked (red), enabled
+    (green), the selected particle in blue, alpha marks drawn labels. Built once per frame, selection
+    and enable changes only rewrite the rows of the labels concerned.
+
+    Parameters:
+    tracks (pd.DataFrame): Tracks of the position
+    frame (int): Frame number
+    colors (tuple): RGBA of tracked, enabled, selected and selected but disabled labels
+    """
+
+    def __init__(self, tracks, frame, colors):
+        self.tracks = tracks
+        self.colors = colors
+        # Rows of the frame in the tracks, their labels and particles
+        self.rows = np.flatnonzero(tracks['frame'].values == frame)
+        self.labels = tracks['label'].values[self.rows].astype(np.intp)
+        self.particles = tracks['particle'].values[self.rows]
+        self.enabled = np.array(enabled_mask(tracks['enabled'].iloc[self.rows]))
+        self.particle_rows = pd.Series(np.arange(len(self.rows))).groupby(self.particles, sort=False).indices
+        self.generation = None
+        self.selected = None
+        self.table = np.zeros((np.iinfo(np.uint16).max + 1, 4), dtype=np.uint8)
+        self.table[self.labels] = colors[0]
+        self.table[self.labels[self.enabled]] = colors[1]
+
+    def _paint(self, rows):
+        for i in rows:
+            if self.particles[i] == self.selected:
+                self.table[self.labels[i]] = self.colors[2] if self.enabled[i] else self.colors[3]
+            else:
+                self.table[self.labels[i]] = self.colors[1] if self.enabled[i] else self.colors[0]
+
+    def select(self, particle):
+        """Highlight a particle (None for no selection) instead of the previous one"""
+        if particle == self.selected:
+            return
+        previous, self.selected = self.selected, particle
+        self._paint(self.particle_rows.get(previous, NO_ROWS))
+        self._paint(self.particle_rows.get(particle, NO_ROWS))
+
+    def set_enabled(self, particle, enabled):
+        """Recolour a particle after its enabled state changed"""
+        rows = self.particle_rows.get(particle, NO_ROWS)
+        self.enabled[rows] = enabled
+        self._paint(rows)
+
+    def sync(self, generation):
+        """Take over enable edits applied to the tracks (e.g. by other sessions), only changed rows are repainted"""
+        if generation == self.generation:
+            return
+        enabled = np.array(enabled_mask(self.tracks['enabled'].iloc[self.rows]))
+        changed = np.flatnonzero(enabled != self.enabled)
+        self.enabled = enabled
+        self._paint(changed)
+        self.generation = generation
+
 class CellViewer:
 
     def __init__(self, nd2_path, output_path, init_type='view'):
         self.output_path = pathlib.Path(output_path)
 
         self.output_path = output_path
-        self.nd2 = ND2Reader(nd2_path)
+        self.nd2_path = nd2_path
+        self.init_type = init_type
+
+        # Held while a request moves or renders the viewer, it may serve several requests at once
+        self.lock = threading.RLock()
+        # Newest request number per render kind ('image', 'outlines'), older waiting requests are dropped
+        self.render_tickets = {}
+        self.tickets_lock = threading.Lock()
+        # Version of the navigation state last saved to or restored from the session
+        self.state_seq = 0
+        # Shared with all sessions viewing the same file, see dataset_cache. Opened on the first
+        # frame read, the pages only need the cached metadata
+        self._nd2 = None
+        self.nd2_lock = threading.Lock()
+        self.metadata = metadata_cache.get(nd2_path, lambda: self.nd2.metadata)
         self.file = None
+        self.data_dir = None
+        self.position_data = None
+
+        # Enable edits go to a per-position journal, compacted into tracks.csv after this many edits
+        self.journal_edits = 0
+        self.journal_compact_edits = 200
 
         self.COLOR_GRAY = '#808080'
         self.COLOR_RED = 'Red'
@@ -65,18 +282,32 @@ class CellViewer:
             #print(self.positions)
 
         self.frame_min = 0
-        self.frame_max = self.nd2.metadata['num_frames']-1
+        self.frame_max = self.metadata['num_frames']-1
         self.frame = self.frame_min
 
         self.channel = 0
         self.channel_min = 0
-        self.channel_max = len(self.nd2.metadata['channels'])-1
+        self.channel_max = len(self.metadata['channels'])-1
 
         #self.max_pixel_value = np.iinfo(np.uint16).max
         self.max_pixel_value = 10000
+        # (lower, upper) contrast limits per channel set through the API
+        self.contrast_limits = {}
 
         self.image_size = 400
-        self.outline_kernel = np.array([[0,0,1,0,0],[0,1,1,1,0],[1,1,0,1,1],[0,1,1,1,0],[0,0,1,0,0]])
+
+        # RGBA rows of the label lookup table used to colour outlines
+        self.OUTLINE_TRACKED = (255, 0, 0, 255)
+        self.OUTLINE_ENABLED = (0, 255, 0, 255)
+        self.OUTLINE_SELECTED = (0, 0, 255, 255)
+        self.OUTLINE_SELECTED_DISABLED = (0, 140, 255, 255)
+
+        self.outline_cache = OrderedDict()
+        self.outline_cache_size = 64
+        # (data_dir, frame) -> OutlineLut of the frames looked at last
+        self.outline_luts = OrderedDict()
+        self.outline_luts_size = 16
+        self.outline_luts_lock = threading.Lock()
 
         # Replacing widgets from the show() method:
 
@@ -114,6 +345,13 @@ class CellViewer:
 
         self.brightness_plot = self.plotly_to_json(self.brightness_figure)
 
+    @property
+    def nd2(self):
+        with self.nd2_lock:
+            if self._nd2 is None:
+                self._nd2 = shared_cache.acquire(('nd2', self.nd2_path), lambda: ND2Reader(self.nd2_path))
+            return self._nd2
+
     def plotly_to_json(self, fig):
         return pio.to_json(fig)
 
@@ -155,27 +393,11 @@ class CellViewer:
         # sleep(0.150)
         particle_index = self.particle_index()
 
-        def is_enabled(value):
-                enabled_values = {1, '1', '1.0', 1.0, True, 'True'}
-                value_str = str(value).lower()
-                enabled_values_str = {str(v).lower() for v in enabled_values}
-                return value_str in enabled_values_str
-
-        particle_states = []
-        ix=0
-        for particle in self.all_particles:
-            # Get just the first frame's enabled value for this particle
-            particle_data = self.all_tracks[self.all_tracks['particle'] == particle]
-            enabled_value = particle_data['enabled'].iloc[0]  # Get first value
-            particle_states.append(1 if is_enabled(enabled_value) else 0)
-            if particle_index == particle:
-                if particle_states[-1] == 1:
-                    self.particle_enabled = True
-                else:
-                    self.particle_enabled = False
-            if particle_states[-1] == 0:
-                self.disabled_particles.append(float(ix))
-            ix+=1
+        # Enabled states by particle index from the track summary, not one tracks filter per particle
+        particle_states = self.particle_states()
+        self.particle_enabled = bool(particle_states[particle_index])
+        self.disabled_particles = [float(i) for i in np.flatnonzero(particle_states == 0)]
+        particle_states = particle_states.tolist()
 
         # Initialize empty lists for area data
         area_x = []
@@ -244,12 +466,62 @@ class CellViewer:
 
         self.brightness_plot = self.plotly_to_json(self.brightness_figure)
 
+        # Styles of the brightness traces, enough for clients to restyle when only the selection changed.
+        # The last trace repeats the data of the highlighted particle.
+        self.plot_style = {
+            'colors': colors,
+            'opacities': [float(o) for o in opacities],
+            'highlight': particle_index,
+        }
+
+
+    def particle_states(self):
+        # 1 for enabled, 0 for disabled particles, by particle index
+        states = np.zeros(self.all_particles_len, dtype=int)
+        states[self.summary_particle_index] = self.track_summary['enabled'].values.astype(bool)
+        return states
+
+    def trace_style(self, index, enabled):
+        # (colour, opacity) of the brightness trace of a particle index
+        if index == self.particle_index():
+            return (self.COLOR_RED if enabled else self.COLOR_ORANGE), self.OPACITY_SELECTED
+        return self.COLOR_GRAY, float(enabled)
+
+    def restyle_particle(self, index, enabled):
+        """
+        Restyle the brightness trace of one particle after its enabled state changed, the figure is not
+        rebuilt. plot_style, disabled_particles and the figure are updated, its JSON is made again on demand.
+        """
+        color, opacity = self.trace_style(index, enabled)
+        self.plot_style['colors'][index] = color
+        self.plot_style['opacities'][index] = opacity
+        traces = [self.brightness_figure.data[index]]
+        if index == self.plot_style['highlight']:
+            traces.append(self.brightness_figure.data[-1])
+        for trace in traces:
+            trace.line.color = color
+            trace.opacity = opacity
+        if enabled:
+            self.disabled_particles = [i for i in self.disabled_particles if i != float(index)]
+        elif float(index) not in self.disabled_particles:
+            self.disabled_particles.append(float(index))
+        self._brightness_plot = None
+
+    @property
+    def brightness_plot(self):
+        # Plotly JSON of the brightness figure, made when first needed after a restyle
+        if self._brightness_plot is None:
+            self._brightness_plot = self.plotly_to_json(self.brightness_figure)
+        return self._brightness_plot
+
+    @brightness_plot.setter
+    def brightness_plot(self, value):
+        self._brightness_plot = value
 
     def position_changed(self):
         self.data_dir = os.path.join(self.output_path,self.position[1][1])
-        if self.file is not None:
-            self.file.close()
-        self.file = h5py.File(os.path.join(self.data_dir,'data.h5'), "r")
+        self.position_data = self.load_position(self.position[1][1])
+        self.file = self.position_data.file
         self.frame_min = self.file.attrs['frame_min']
         self.frame_max = self.file.attrs['frame_max']
         self.frame = self.frame_min
@@ -268,24 +540,7 @@ class CellViewer:
 
         # set Brightnesses names for plots file_handle.attrs['fl_channel_names']
 
-        self.all_tracks = pd.read_csv(os.path.join(self.data_dir,'tracks.csv'))
-        self.all_particles = list(self.all_tracks['particle'].unique())
-        self.all_particles_len = len(self.all_particles)
-
-        self.brightness_x = []
-        self.brightness_y = []
-        for p in self.all_particles:
-            x,y = self.get_track_data(p, 'brightness_0')
-            self.brightness_x.append(x)
-            self.brightness_y.append(y)
-
-        # print("brightness_x length:", (len(self.brightness_x)))
-        self.area_x = []
-        self.area_y = []
-        for p in self.all_particles:
-            x,y = self.get_track_data(p, 'area')
-            self.area_x.append(x)
-            self.area_y.append(y)
+        self.use_tracks()
 
         # print("area_x length:", (len(self.area_x)))
 
@@ -338,16 +593,222 @@ class CellViewer:
         else:
             index_csv = 0
         # self.all_tracks.loc[self.all_tracks['particle'] == self.particle, 'enabled'] = self.particle_enabled
-        self.all_tracks.loc[self.all_tracks['particle'] == self.particle, 'enabled'] = index_csv
-        self.all_tracks.to_csv(self.data_dir + '/tracks.csv')
-        self.update_plots()
-        self.draw_outlines()
-        self.update_image()
+        # The tracks are shared with other sessions viewing this position
+        with shared_cache.dataset_lock(self.position_data):
+            self.all_tracks.loc[self.all_tracks['particle'] == self.particle, 'enabled'] = index_csv
+            append_tracks_journal(pathlib.Path(self.data_dir), self.particle, index_csv)
+            self.track_summary.loc[self.particle, 'enabled'] = bool(index_csv)
+        self.journal_edits += 1
+        if self.journal_edits >= self.journal_compact_edits:
+            self.compact_journal_async()
+        self.update_tracks_version()
+        # Only the toggled particle's trace changes style
+        self.restyle_particle(self.particle_index(), bool(index_csv))
+        with self.outline_luts_lock:
+            for (data_dir, _), lut in self.outline_luts.items():
+                if data_dir == self.data_dir and lut.tracks is self.all_tracks:
+                    lut.set_enabled(self.particle, bool(index_csv))
+
+    def position_version(self, position):
+        """
+        Version of the tracks and segmentation of a position index as stored on disk, like
+        tracks_version but for any position and independent of what the viewer has loaded
+        """
+        data_dir = os.path.join(self.output_path, self.position_options[position][1][1])
+        return '.'.join(file_signature(os.path.join(data_dir, name)) for name in ('tracks.csv', TRACKS_JOURNAL, 'data.h5'))
+
+    def update_tracks_version(self):
+        # Part of image URLs and ETags, changes whenever the tracks of the position change
+        self.tracks_version = file_signature(os.path.join(self.data_dir, 'tracks.csv')) + '.' + \
+            file_signature(os.path.join(self.data_dir, TRACKS_JOURNAL)) + '.' + self.position_data.data_signature
+
+    def compact_journal_async(self, data_dir=None):
+        # Fold the enable edits into tracks.csv without blocking the request
+        if data_dir is None:
+            data_dir = self.data_dir
+            self.journal_edits = 0
+        threading.Thread(target=compact_tracks_journal, args=(pathlib.Path(data_dir),), daemon=True).start()
+
+    def reload_tracks(self):
+        # Pick up enabled flags written by someone else (e.g. bulk curation), particles are unchanged
+        with shared_cache.dataset_lock(self.position_data):
+            self.position_data.load_tracks()
+        shared_cache.resize(self.position_data)
+        self.use_tracks()
+        self.particle_changed()
+
+    def load_position(self, folder):
+        # Shared position state, reloaded if tracks.csv or data.h5 changed on disk (e.g. re-tracking)
+        data_dir = os.path.join(self.output_path, folder)
+        data = shared_cache.acquire(('position', data_dir), lambda: PositionData(data_dir), PositionData.is_current)
+        if self.position_data is not None:
+            shared_cache.release(self.position_data)
+        return data
+
+    def refresh_tracks(self):
+        # Apply edits made by other sessions or worker processes since the position was loaded
+        if self.position_data is None:
+            return
+        if not self.position_data.data_is_current():
+            self.reload_position()
+            return
+        with shared_cache.dataset_lock(self.position_data):
+            self.position_data.refresh()
+        # Another session may have done the reload, the generation tells whether these tracks are old
+        if self.position_data.generation != self.tracks_generation:
+            self.use_tracks()
+            if self.particle is not None and self.particle in self.particle_indices:
+                self.particle_enabled = bool(self.track_summary.loc[self.particle, 'enabled'])
+
+    def reload_position(self):
+        # data.h5 was rewritten: get the position again from the shared cache, which replaces the
+        # stale entry, and keep the frame if it still exists
+        self.position_data = self.load_position(self.position[1][1])
+        self.file = self.position_data.file
+        self.frame_min = self.file.attrs['frame_min']
+        self.frame_max = self.file.attrs['frame_max']
+        self.frame = min(max(self.frame, self.frame_min), self.frame_max)
+        self.outline_cache.clear()
+        self.use_tracks()
+        if self.particle is not None and self.particle in self.particle_indices:
+            self.particle_enabled = bool(self.track_summary.loc[self.particle, 'enabled'])
+
+    def render_ticket(self, kind):
+        # Number a render request, it is superseded once a newer request of the same kind arrives
+        with self.tickets_lock:
+            ticket = self.render_tickets.get(kind, 0) + 1
+            self.render_tickets[kind] = ticket
+        return ticket
+
+    def is_latest(self, kind, ticket):
+        return self.render_tickets.get(kind) == ticket
+
+    def state(self):
+        # Navigation state, JSON serializable so it can be kept in the Django session
+        state = {
+            'nd2_path': self.nd2_path,
+            'output_path': self.output_path,
+            'init_type': self.init_type,
+            'contrast': [[c, lower, upper] for c, (lower, upper) in sorted(self.contrast_limits.items())],
+            'position': None,
+        }
+        if self.position is not None and self.position_data is not None and self.particle is not None:
+            state.update({
+                'position': int(self.position[1][0]),
+                'particle': self.particle_index(),
+                'frame': int(self.frame),
+                'channel': int(self.channel),
+                'x': int(self.x),
+                'y': int(self.y),
+            })
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        viewer = cls(state['nd2_path'], state['output_path'], state['init_type'])
+        viewer.restore_state(state)
+        return viewer
+
+    def restore_state(self, state):
+        # Move to the navigation state saved by state(), possibly by another worker process
+        self.contrast_limits = {int(c): (int(lower), int(upper)) for c, lower, upper in state['contrast']}
+        if state['position'] is None or self.position is None:
+            return
 
+        options = [o for o in self.position_options if o[1][0] == state['position']]
+        if len(options) == 0:
+            return
+        if options[0] != self.position or self.position_data is None:
+            self.position = options[0]
+            self.position_changed()
+        else:
+            self.refresh_tracks()
+
+        if state['particle'] < self.all_particles_len and state['particle'] != self.particle_index():
+            self.particle = self.all_particles[state['particle']]
+            self.particle_changed()
+        self.frame = state['frame']
+        self.channel = state['channel']
+        self.x = state['x']
+        self.y = state['y']
+
+    def use_tracks(self):
+        # Point the viewer at the tracks and per-particle arrays of the current position
+        data = self.position_data
+        self.tracks_generation = data.generation
+        self.all_tracks = data.tracks
+        self.all_particles = data.particles
+        self.all_particles_len = len(data.particles)
+        self.particle_indices = data.particle_indices
+        self.brightness_x, self.brightness_y = data.brightness_x, data.brightness_y
+        self.area_x, self.area_y = data.area_x, data.area_y
+        # Per-particle statistics for sorted/filtered navigation, sort orders are cached per statistic
+        self.track_summary = data.track_summary
+        self.summary_particle_index = data.summary_particle_index
+        self.summary_orders = data.summary_orders
+        self.update_tracks_version()
+
+    def summary_order(self, sort=None, descending=False):
+        # Rows of the track summary in navigation order, tracking order if no statistic is given
+        key = (sort, descending)
+        if key not in self.summary_orders:
+            if sort is None:
+                order = np.argsort(self.summary_particle_index, kind='stable')
+            elif sort in self.track_summary.columns and sort != 'enabled':
+                order = np.argsort(self.track_summary[sort].values, kind='stable')
+                if descending:
+                    order = order[::-1]
+            else:
+                raise ValueError(f'Unknown statistic: {sort}')
+            self.summary_orders[key] = order
+        return self.summary_orders[key]
+
+    def particle_list(self, sort=None, descending=False, enabled=None, limit=None):
+        # Summary rows of the matching particles in navigation order
+        order = self.summary_order(sort, descending)
+        if enabled is not None:
+            order = order[self.track_summary['enabled'].values[order] == enabled]
+        if limit is not None:
+            order = order[:limit]
+        return self.track_summary.iloc[order].assign(index=self.summary_particle_index[order])
+
+    def next_particle(self, sort=None, descending=False, enabled=None, step=1, current=None):
+        # Particle index of the next (step=1) or previous (step=-1) matching particle after current, wrapping around
+        if current is None:
+            current = self.particle_index()
+        order = self.summary_order(sort, descending)
+        matches = np.arange(len(order))
+        if enabled is not None:
+            matches = matches[self.track_summary['enabled'].values[order] == enabled]
+        if len(matches) == 0:
+            return None
+        current = np.flatnonzero(self.summary_particle_index[order] == current)[0]
+        if step > 0:
+            i = np.searchsorted(matches, current, side='right')
+            row = matches[i % len(matches)]
+        else:
+            i = np.searchsorted(matches, current, side='left') - 1
+            row = matches[i]
+        return int(self.summary_particle_index[order[row]])
+
+    def cleanup(self):
+        # Called when the session expired or the viewer is replaced
+        if self.position_data is not None:
+            shared_cache.release(self.position_data)
+            self.position_data = None
+            self.file = None
+        with self.nd2_lock:
+            if self._nd2 is not None:
+                shared_cache.release(self._nd2)
+                self._nd2 = None
+
+
+    def position_index(self):
+        return self.position_options.index(self.position)
 
     def particle_index(self):
         # print(f'Index current particle {self.all_particles.index(self.particle)}')
-        return self.all_particles.index(self.particle)
+        return self.particle_indices[self.particle]
 
     def particle_changed(self):
         def is_enabled(value):
@@ -372,12 +833,8 @@ class CellViewer:
         self.x = int(self.particle_tracks['x'].values.mean()) - self.image_size
         self.y = int(self.particle_tracks['y'].values.mean()) - self.image_size
 
-        self.x = max(0,min(self.nd2.metadata['height'] - 2*self.image_size, self.x))
-        self.y = max(0,min(self.nd2.metadata['width'] - 2*self.image_size, self.y))
-
-        self.get_channel_image()
-        self.draw_outlines()
-        self.update_image()
+        self.x = max(0,min(self.metadata['height'] - 2*self.image_size, self.x))
+        self.y = max(0,min(self.metadata['width'] - 2*self.image_size, self.y))
 
     def particle_dropdown_changed(self, change):
         if change['new'] is not self.particle:
@@ -412,17 +869,13 @@ class CellViewer:
 
     def frame_changed(self):
         self.update_cursors()
-        self.get_channel_image()
-        self.draw_outlines()
-        self.update_image()
+        self.render()
 
     def channel_changed(self):
-        self.get_channel_image()
-        self.update_image()
+        self.render()
 
     def max_pixel_value_changed(self):
-        self.get_channel_image()
-        self.update_image()
+        self.render()
 
     def channel_slider_changed(self, change):
         if change['new'] is not self.channel:
@@ -434,116 +887,211 @@ class CellViewer:
             self.particle_enabled = change['new']
             self.particle_enabled_changed()
 
-    def adjust_image(self, image, max_value):
-        img = image.copy().astype(np.float64)
-        img[img >= max_value] = np.iinfo(np.uint16).max
-        img[img < max_value] /= max_value
-        img[img < max_value] *= np.iinfo(np.uint16).max
-        return img
-
-    def get_channel_image(self):
-        img = self.nd2.get_frame_2D(v=int(self.position[0]),c=self.channel,t=self.frame)[self.x:self.x+2*self.image_size,self.y:self.y+2*self.image_size]
+    def get_contrast(self, channel):
+        # User limits if set, otherwise the defaults (brightfield channel 0 spans a wider range)
+        if channel in self.contrast_limits:
+            return self.contrast_limits[channel]
+        if channel == 0:
+            return (0, 40000)
+        return (0, self.max_pixel_value)
 
-        # There seems to be an issue with the arguments. Apparently v should be the position, but it's not working.
-        # Instead, v seems to be the input for the frame.
+    def set_contrast(self, channel, lower, upper):
+        if not (0 <= lower < upper <= np.iinfo(np.uint16).max):
+            raise ValueError('Contrast limits must satisfy 0 <= lower < upper <= 65535')
+        self.contrast_limits[channel] = (int(lower), int(upper))
 
-        # img = self.nd2.get_frame_2D(v=0,c=self.channel,t=self.frame)[self.x:self.x+2*self.image_size,self.y:self.y+2*self.image_size]
-
-
-        pixel_val = self.max_pixel_value
-        if self.channel == 0:
-            pixel_val = 40000
-        adjusted = self.adjust_image(img,pixel_val)
-        self.channel_image = cv2.cvtColor(cv2.convertScaleAbs(adjusted, alpha=1./256., beta=-.49999),cv2.COLOR_GRAY2RGB)
-
-    def update_image(self):
-        img = self.combine_images(self.outline_image,self.channel_image,self.outline_mask)
-        _, img_enc = cv2.imencode('.jpg', img)
-        # self.image.value = img_enc.tobytes()
+    def render(self):
+        # Image of the current view with outlines, kept for the legacy Flask app
+        self.display_image = self.view_image(self.view())
 
     def return_image(self):
-        img = self.combine_images(self.outline_image,self.channel_image,self.outline_mask)
-        return numpy_to_b64_string(img)
-        # _, img_enc = cv2.imencode('.jpg', img)
-        # self.image.value = img_enc.tobytes()
-
-    def get_outline(self, img):
-        f64_img = img.astype(np.float64)
-        filter_img = cv2.filter2D(src=f64_img, ddepth=-1,kernel=self.outline_kernel) / self.outline_kernel.sum()
-        filter_img[filter_img == f64_img] = 0
-
-        mask = (f64_img != filter_img) & (filter_img > 0)
-        filter_img[mask] = img[mask]
-
-        return filter_img.astype(img.dtype)
-
-    def combine_images(self,a,b,m):
-        mask = cv2.cvtColor(m,cv2.COLOR_GRAY2RGB)
-        inv_mask = cv2.bitwise_not(mask)
-
-        ma = cv2.bitwise_and(a,mask)
-        mb = cv2.bitwise_and(b,inv_mask)
-
-        return cv2.add(ma,mb)
-
-    def get_particle_label(self):
-        tracks = self.all_tracks[(self.all_tracks['frame'] == self.frame) & (self.all_tracks['particle'] == self.particle)]
-        if len(tracks) == 0:
-            return None
-        return int(tracks.iloc[0]['label'])
-
-    def draw_outlines(self):
-        if self.frame < self.frame_min or self.frame > self.frame_max:
-            self.outline_mask = np.zeros((self.image_size*2,self.image_size*2),dtype=np.uint8)
-            self.outline_image = np.zeros((self.image_size*2,self.image_size*2,3),dtype=np.uint8)
-            return
-        all_labels = self.file['labels'][self.frame-self.frame_min] [self.x:self.x+2*self.image_size,self.y:self.y+2*self.image_size]
-
-        outlines = self.get_outline(all_labels)
-
-        image_shape = (self.channel_image.shape[0],self.channel_image.shape[1],3)
-        overlay = np.zeros(image_shape,dtype=np.uint8)
-
-        o = np.zeros(image_shape,dtype=np.uint8)
-
-        frame_tracks = self.all_tracks[self.all_tracks['frame'] == self.frame]
-
-        true_values = [1, '1', '1.0', 1.0, True, 'True', 'true', 'TRUE']
-
-        # Convert true_values to lowercase strings
-        true_values_lower = [str(v).lower() for v in true_values]
-
-        enabled_condition = ~frame_tracks['enabled'].astype(str).str.lower().isin(true_values_lower)
-
-        # Get unique labels for disabled tracks
-        enabled_labels = frame_tracks[~enabled_condition]['label'].unique()
-
-        # enabled_labels = frame_tracks[frame_tracks['enabled'] == True]['label'].unique()
-        tracked_labels = frame_tracks['label'].unique()
-
-        # all tracked cells
-        o = cv2.rectangle(o, (0,0), (image_shape[0],image_shape[1]), (255,0,0), -1) # Red
-        m1 = np.isin(outlines, tracked_labels).astype(np.uint8)*255
-        overlay = self.combine_images(o,overlay,m1)
-
-        # enabled cells
-        o = cv2.rectangle(o, (0,0), (image_shape[0],image_shape[1]), (0,255,0), -1) # Green
-        m2 = np.isin(outlines, enabled_labels).astype(np.uint8)*255
-        overlay = self.combine_images(o,overlay,m2)
-
-        # Selected cell
-        label = self.get_particle_label()
-        if label is not None:
-            if self.particle_enabled == True:
-                o = cv2.rectangle(o, (0,0), (image_shape[0],image_shape[1]), (0,0,255), -1) # Dark Blue
+        self.render()
+        return numpy_to_b64_string(self.display_image)
+
+    def render_image(self, fmt='jpeg', overlay=True):
+        # Encoded image of the current position, channel, frame and crop
+        return self.render_view(self.view(), fmt, overlay)
+
+    def view(self):
+        # Address of the current image, see render_view
+        lower, upper = self.get_contrast(self.channel)
+        return {
+            'position': self.position_index(),
+            'channel': int(self.channel),
+            'frame': int(self.frame),
+            'x': int(self.x),
+            'y': int(self.y),
+            'lower': lower,
+            'upper': upper,
+            'particle': self.particle_index() if self.particle is not None else None,
+        }
+
+    def render_view(self, view, fmt='jpeg', overlay=True):
+        """
+        Encoded image addressed by view: position index, channel, frame, crop origin x and y, contrast
+        limits lower and upper and, for outlines, the index of the selected particle. The viewer is not
+        moved, so the image only depends on the view.
+        """
+        image = self.view_image(view, overlay)
+        _, encoded = cv2.imencode(IMAGE_FORMATS[fmt][0], cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+        return encoded.tobytes()
+
+    def view_image(self, view, overlay=True):
+        # RGB image of a view, see render_view
+        x, y, size = view['x'], view['y'], 2 * self.image_size
+        with shared_cache.dataset_lock(self.nd2):
+            img = self.nd2.get_frame_2D(v=int(self.position_options[view['position']][0]), c=view['channel'],
+                                        t=view['frame'])[x:x+size, y:y+size]
+        # Map uint16 -> uint8 through a cached 65,536 entry table, no float temporaries
+        lut = uint16_to_uint8_lut(view['lower'], view['upper'])
+        image = cv2.cvtColor(np.take(lut, img), cv2.COLOR_GRAY2RGB)
+
+        if overlay:
+            with self.position_dataset(view['position']) as data:
+                frame_min, frame_max = data.file.attrs['frame_min'], data.file.attrs['frame_max']
+                if frame_min <= view['frame'] <= frame_max:
+                    outlines = self.outline_crop(data, view['frame'] - frame_min, x, y)
+                    colors = self.outline_colors(data, view['frame'], view.get('particle'), outlines)
+                    image = np.where(colors[..., 3:] > 0, colors[..., :3], image)
+        return image
+
+    @contextmanager
+    def position_dataset(self, position):
+        # PositionData of a position index, held by a reference of its own: renders outside the viewer
+        # lock (prefetch) keep the file open even if the viewer moves on and releases the position
+        data_dir = os.path.join(self.output_path, self.position_options[position][1][1])
+        data = shared_cache.acquire(('position', data_dir), lambda: PositionData(data_dir), PositionData.is_current)
+        try:
+            with shared_cache.dataset_lock(data):
+                data.refresh()
+            yield data
+        finally:
+            shared_cache.release(data)
+
+    def outline_colors(self, data, frame, particle, outlines):
+        """
+        RGBA colours of an outline crop, gathered through the OutlineLut of the frame with the particle
+        (an index into the position's particles, or None) selected
+        """
+        particle = data.particles[particle] if particle is not None and 0 <= particle < len(data.particles) else None
+        key = (data.data_dir, frame)
+        with shared_cache.dataset_lock(data):
+            with self.outline_luts_lock:
+                lut = self.outline_luts.get(key)
+                if lut is None or lut.tracks is not data.tracks:
+                    # New frame, or the tracks were reloaded
+                    lut = OutlineLut(data.tracks, frame, (self.OUTLINE_TRACKED, self.OUTLINE_ENABLED,
+                                                          self.OUTLINE_SELECTED, self.OUTLINE_SELECTED_DISABLED))
+                    self.outline_luts[key] = lut
+                    if len(self.outline_luts) > self.outline_luts_size:
+                        self.outline_luts.popitem(last=False)
+                self.outline_luts.move_to_end(key)
+                lut.sync(data.generation)
+                lut.select(particle)
+                return lut.table[outlines]
+
+    def image_params(self):
+        # Everything that addresses the current image, the client builds image URLs from this
+        return {
+            'position': self.position_index(),
+            'channel': self.channel,
+            'frame': int(self.frame),
+            'x': self.x,
+            'y': self.y,
+            'particle': self.particle_index(),
+            'rev': self.tracks_version,
+            'contrast': [self.get_contrast(c) for c in range(self.channel_max + 1)],
+        }
+
+    def outline_crop(self, data, frame_index, x, y):
+        # Outlines of a crop of a position's frame
+        size = 2 * self.image_size
+        if 'outlines' in data.file:
+            return data.file['outlines'][frame_index, x:x+size, y:y+size]
+
+        # Older data.h5 files have no precomputed outlines, compute them once per crop
+        key = (data.data_dir, data.data_signature, frame_index, x, y)
+        if key in self.outline_cache:
+            self.outline_cache.move_to_end(key)
+            return self.outline_cache[key]
+        labels = data.file['labels'][frame_index, x:x+size, y:y+size]
+        outlines = label_outlines(labels)
+        self.outline_cache[key] = outlines
+        if len(self.outline_cache) > self.outline_cache_size:
+            self.outline_cache.popitem(last=False)
+        return outlines
+
+    def outline_polygons(self, position, frame, x, y):
+        """
+        Tracked cells of a frame's crop with origin x, y as polygons, points are (column, row) in crop
+        pixels. Like render_view, independent of the viewer's current position and frame.
+        """
+        with self.position_dataset(position) as data:
+            return self.position_outline_polygons(data, frame, x, y)
+
+    def position_outline_polygons(self, data, frame, x, y):
+        frame_min, frame_max = data.file.attrs['frame_min'], data.file.attrs['frame_max']
+        if frame < frame_min or frame > frame_max:
+            return {}
+        frame_index = frame - frame_min
+        label_index = data.label_index
+        if label_index.available:
+            # Masks come from the cells' runs, the labels image is not read
+            height = min(2 * self.image_size, int(data.file.attrs['height']) - x)
+            width = min(2 * self.image_size, int(data.file.attrs['width']) - y)
+        else:
+            labels = data.file['labels'][frame_index, x:x+2*self.image_size, y:y+2*self.image_size]
+            height, width = labels.shape
+
+        with shared_cache.dataset_lock(data):
+            frame_tracks = data.tracks[data.tracks['frame'] == frame]
+            particle_indices = data.particle_indices
+        enabled = enabled_mask(frame_tracks['enabled'])
+
+        cells = {}
+        rows = zip(frame_tracks['label'].values, frame_tracks['particle'].values, enabled,
+                   frame_tracks['bbox_x1'].values, frame_tracks['bbox_x2'].values,
+                   frame_tracks['bbox_y1'].values, frame_tracks['bbox_y2'].values)
+        for label, particle, particle_enabled, x1, x2, y1, y2 in rows:
+            # Only look at the part of the bounding box inside the crop
+            r0, r1 = max(int(x1) - x, 0), min(int(x2) - x + 1, height)
+            c0, c1 = max(int(y1) - y, 0), min(int(y2) - y + 1, width)
+            if r0 >= r1 or c0 >= c1:
+                continue
+            if label_index.available:
+                runs = label_index.cell_runs(frame_index, label)
+                mask = runs_mask(runs, r0 + x, r1 + x, c0 + y, c1 + y).astype(np.uint8)
             else:
-                o = cv2.rectangle(o, (0,0), (image_shape[0],image_shape[1]), (0,140,255), -1)
-            m3 = (outlines == label).astype(np.uint8)*255
-
-            overlay = self.combine_images(o,overlay,m3)
-
-        self.outline_image = overlay #self.combine_images(overlay,self.image_data,m1)
-        self.outline_mask = m1
+                mask = (labels[r0:r1, c0:c1] == label).astype(np.uint8)
+            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            if len(contours) == 0:
+                continue
+            cells[str(int(label))] = {
+                'particle': particle_indices[particle],
+                'enabled': bool(particle_enabled),
+                'polygons': [(c.reshape(-1, 2) + (c0, r0)).ravel().tolist() for c in contours],
+            }
+        return cells
+
+    def particle_at(self, position, frame, row, col):
+        """
+        Index of the particle whose cell covers a pixel, in the position (index into position_options)
+        and frame the client shows, row and col are frame coordinates. Independent of the viewer's
+        current position and frame, which the browser cache may have left behind.
+        None if the pixel is background, the cell is not tracked or the frame is out of range.
+        """
+        with self.position_dataset(position) as data:
+            frame_min, frame_max = data.file.attrs['frame_min'], data.file.attrs['frame_max']
+            if frame < frame_min or frame > frame_max:
+                return None
+            label = data.label_index.label_at(frame - frame_min, row, col)
+            if label == 0:
+                return None
+            with shared_cache.dataset_lock(data):
+                tracks = data.tracks[(data.tracks['frame'] == frame) & (data.tracks['label'] == label)]
+                if len(tracks) == 0:
+                    return None
+                return data.particle_indices[tracks['particle'].values[0]]
 
     def handle_keydown(self, event):
         if event['key'] in self.key_down and self.key_down[event['key']] == True:
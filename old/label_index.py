@@ -0,0 +1,186 @@
+"""
+Per-cell access to the label images in data.h5 without reading whole frames.
+
+segment_positions stores every frame's labels twice: as the 'labels' image and as row runs, one
+(row, column, length) entry per horizontal stretch of a label, grouped by label. 'label_index'
+holds one row per cell with its bounding box and the range of its runs, 'label_index_offsets'
+the range of each frame's cells in 'label_index'. Getting one cell's runs reads the frame's index
+rows (40 bytes per cell, kept for a few frames) and that cell's runs, not the frame's labels or
+the runs of the other cells.
+
+Bounding boxes follow numpy slicing: rows row0 to row1 - 1 and columns col0 to col1 - 1.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+INDEX_DTYPE = np.dtype([('label', np.uint16), ('row0', np.int32), ('row1', np.int32), ('col0', np.int32),
+                        ('col1', np.int32), ('run_offset', np.int64), ('run_count', np.int32)])
+
+
+def label_runs(labels):
+    """
+    Row runs of the labels of a frame, grouped by label
+
+    Parameters:
+    labels (np.ndarray): Label image, 0 is background
+
+    Returns:
+    tuple: (index, runs), index is an INDEX_DTYPE array sorted by label with run_offset counted from
+    the first run of the frame, runs an int32 array of (row, column, length)
+    """
+    height, width = labels.shape
+    flat = labels.ravel()
+    # A run starts where the label changes and at the start of every row
+    starts = np.ones(flat.size, dtype=bool)
+    starts[1:] = flat[1:] != flat[:-1]
+    starts[::width] = True
+    starts = np.flatnonzero(starts)
+    lengths = np.diff(np.append(starts, flat.size))
+    values = flat[starts]
+
+    cell = values > 0
+    starts, lengths, values = starts[cell], lengths[cell], values[cell]
+    # Stable, so the runs of a label stay in raster order
+    order = np.argsort(values, kind='stable')
+    starts, lengths, values = starts[order], lengths[order], values[order]
+    rows, cols = np.divmod(starts, width)
+    runs = np.column_stack([rows, cols, lengths]).astype(np.int32)
+
+    index = np.zeros(0, dtype=INDEX_DTYPE)
+    if len(values):
+        label_values, first, counts = np.unique(values, return_index=True, return_counts=True)
+        index = np.zeros(len(label_values), dtype=INDEX_DTYPE)
+        index['label'] = label_values
+        index['row0'] = rows[first]
+        index['row1'] = rows[first + counts - 1] + 1
+        index['col0'] = np.minimum.reduceat(cols, first)
+        index['col1'] = np.maximum.reduceat(cols + lengths, first)
+        index['run_offset'] = first
+        index['run_count'] = counts
+    return index, runs
+
+
+def runs_mask(runs, row0, row1, col0, col1):
+    """
+    Boolean mask of runs within the box rows row0:row1 and columns col0:col1, runs outside are clipped
+    """
+    mask = np.zeros((max(row1 - row0, 0), max(col1 - col0, 0)), dtype=bool)
+    runs = runs[(runs[:, 0] >= row0) & (runs[:, 0] < row1)]
+    if len(runs) == 0 or mask.size == 0:
+        return mask
+    lengths = runs[:, 2].astype(np.intp)
+    # Pixel i of run j is at column col_j + i
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    rows = np.repeat(runs[:, 0], lengths) - row0
+    cols = np.repeat(runs[:, 1], lengths) + within - col0
+    inside = (cols >= 0) & (cols < mask.shape[1])
+    mask[rows[inside], cols[inside]] = True
+    return mask
+
+
+class LabelIndexWriter:
+    """
+    Appends the label index of each frame to data.h5 during segmentation
+
+    Parameters:
+    file_handle (h5py.File): data.h5 opened for writing
+    num_frames (int): Number of frames of the 'labels' dataset
+    """
+
+    def __init__(self, file_handle, num_frames):
+        self.index = file_handle.create_dataset('label_index', (0,), dtype=INDEX_DTYPE, maxshape=(None,), chunks=(4096,))
+        self.runs = file_handle.create_dataset('label_runs', (0, 3), dtype=np.int32, maxshape=(None, 3),
+                                               chunks=(16384, 3))
+        self.offsets = file_handle.create_dataset('label_index_offsets', data=np.zeros(num_frames + 1, dtype=np.int64))
+
+    def append(self, frame_index, labels):
+        """Store the runs of the labels of frame number frame_index, frames are appended in order"""
+        index, runs = label_runs(labels)
+        index['run_offset'] += self.runs.shape[0]
+        start = self.index.shape[0]
+        self.index.resize((start + len(index),))
+        self.index[start:] = index
+        run_start = self.runs.shape[0]
+        self.runs.resize((run_start + len(runs), 3))
+        self.runs[run_start:] = runs
+        self.offsets[frame_index + 1:] = start + len(index)
+
+
+class LabelIndex:
+    """
+    Cell runs and the label under a pixel from the label index of data.h5. Files written before
+    the index existed are served from the 'labels' dataset, a whole frame at a time.
+
+    Parameters:
+    file_handle (h5py.File): Open data.h5
+    max_frames (int): Frames whose index is kept in memory
+    """
+
+    def __init__(self, file_handle, max_frames=16):
+        self.file = file_handle
+        self.available = 'label_index' in file_handle
+        self.max_frames = max_frames
+        # frame index -> (index, runs), runs is None if they are read per cell from the file
+        self.frames = OrderedDict()
+        self.lock = threading.Lock()
+
+    def frame(self, frame_index):
+        """
+        Index of a frame, and for files without an index the runs computed from its labels
+
+        Returns:
+        tuple: (INDEX_DTYPE array sorted by label, runs array or None). With runs, run_offset counts
+        from the first run of the frame, without them from the start of 'label_runs'.
+        """
+        with self.lock:
+            cached = self.frames.get(frame_index)
+            if cached is not None:
+                self.frames.move_to_end(frame_index)
+                return cached
+
+        if self.available:
+            start, stop = self.file['label_index_offsets'][frame_index:frame_index + 2]
+            cached = (self.file['label_index'][start:stop], None)
+        else:
+            cached = label_runs(self.file['labels'][frame_index])
+
+        with self.lock:
+            self.frames[frame_index] = cached
+            if len(self.frames) > self.max_frames:
+                self.frames.popitem(last=False)
+        return cached
+
+    def cell(self, frame_index, label):
+        """Index entry of a label in a frame, None if the frame has no such label"""
+        index, _ = self.frame(frame_index)
+        i = np.searchsorted(index['label'], label)
+        if i == len(index) or index['label'][i] != label:
+            return None
+        return index[i]
+
+    def _runs(self, frame_index, entry):
+        _, runs = self.frame(frame_index)
+        start, stop = int(entry['run_offset']), int(entry['run_offset'] + entry['run_count'])
+        if runs is None:
+            return self.file['label_runs'][start:stop]
+        return runs[start:stop]
+
+    def cell_runs(self, frame_index, label):
+        """(row, column, length) runs of a label, empty if the frame has no such label"""
+        entry = self.cell(frame_index, label)
+        if entry is None:
+            return np.zeros((0, 3), dtype=np.int32)
+        return self._runs(frame_index, entry)
+
+    def label_at(self, frame_index, row, col):
+        """Label at a pixel of a frame, 0 for background"""
+        index, _ = self.frame(frame_index)
+        candidates = index[(index['row0'] <= row) & (row < index['row1']) & (index['col0'] <= col) & (col < index['col1'])]
+        for entry in candidates:
+            cell_runs = self._runs(frame_index, entry)
+            hit = (cell_runs[:, 0] == row) & (cell_runs[:, 1] <= col) & (col < cell_runs[:, 1] + cell_runs[:, 2])
+            if hit.any():
+                return int(entry['label'])
+        return 0
@@ -0,0 +1,88 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import closing
+
+# Metadata fields the viewer and analysis pages need
+METADATA_KEYS = ['fields_of_view', 'channels', 'frames', 'num_frames', 'width', 'height', 'pixel_microns']
+
+
+def _jsonable(value):
+    if isinstance(value, (range, tuple)):
+        return list(value)
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+class ND2MetadataCache:
+    """
+    Metadata of ND2 files, stored in a SQLite file keyed by path, size and modification time.
+
+    Parsing the metadata of a large ND2 file on a network share takes seconds, sessions opening
+    a file seen before read it from here and open the file only when pixels are needed. Without
+    a path the metadata is only kept in memory.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        # (path, size, mtime_ns) -> metadata, read within this process
+        self.memory = {}
+        self.lock = threading.Lock()
+
+    def get(self, nd2_path, read):
+        """
+        Metadata of an ND2 file, read with read() if not cached for its current size and mtime
+
+        Parameters:
+        nd2_path (str): Path to ND2 file
+        read (callable): Returns the metadata dict of the open file, e.g. ND2Reader(...).metadata
+
+        Returns:
+        dict: The fields of METADATA_KEYS
+        """
+        st = os.stat(nd2_path)
+        key = (os.path.abspath(nd2_path), st.st_size, st.st_mtime_ns)
+        with self.lock:
+            metadata = self.memory.get(key)
+        if metadata is None:
+            metadata = self._load(key)
+        if metadata is None:
+            parsed = read()
+            metadata = {name: _jsonable(parsed[name]) for name in METADATA_KEYS if name in parsed}
+            self._store(key, metadata)
+        with self.lock:
+            self.memory[key] = metadata
+        return metadata
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.execute('CREATE TABLE IF NOT EXISTS nd2_metadata '
+                           '(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, metadata TEXT)')
+        return connection
+
+    def _load(self, key):
+        if self.path is None:
+            return None
+        try:
+            with closing(self._connect()) as connection:
+                row = connection.execute('SELECT metadata FROM nd2_metadata WHERE path = ? AND size = ? AND mtime_ns = ?',
+                                         key).fetchone()
+        except sqlite3.Error:
+            return None
+        return json.loads(row[0]) if row else None
+
+    def _store(self, key, metadata):
+        if self.path is None:
+            return
+        try:
+            with closing(self._connect()) as connection, connection:
+                connection.execute('INSERT OR REPLACE INTO nd2_metadata VALUES (?, ?, ?, ?)',
+                                   (*key, json.dumps(metadata)))
+        except sqlite3.Error as e:
+            # The cache only saves time, the metadata was read anyway
+            print(f'Could not store ND2 metadata: {e}')
+
+
+metadata_cache = ND2MetadataCache()
@@ -0,0 +1,173 @@
+import multiprocessing
+import queue
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import pyama_util
+import pipeline_metrics
+
+# Order in which a position flows through the steps
+PIPELINE_STEPS = ['segmentation', 'tracking', 'square_rois', 'export']
+
+
+def run_pipeline(nd2_path: str, out_dir: str, pos: list, seg_channel: int, fl_channels: list,
+                 frame_min: int = None, frame_max: int = None, chunk_size: int = None,
+                 expand: int = 0, micron_size: float = None, mins: float = 1.0,
+                 force: bool = False, queue_size: int = 1, should_stop=None, tile_size: int = None) -> dict:
+    """
+    Run segmentation, tracking, square ROIs and export with each position flowing through the steps
+    on its own. Every step runs in its own process, connected to the next by a bounded queue, so
+    position N is tracked and exported while position N+1 is segmented.
+
+    Parameters:
+    nd2_path (str): Path to ND2 file
+    out_dir (str): Output directory path
+    pos (list): List of position numbers
+    seg_channel (int): Segmentation channel index
+    fl_channels (list): List of fluorescence channel indices
+    frame_min (int): Minimum frame number
+    frame_max (int): Maximum frame number
+    chunk_size (int): HDF5 chunk side length, see segment_positions
+    expand (int): Expansion factor for labels during tracking
+    micron_size (float): Size of the square ROIs in microns, None skips the square ROI step
+    mins (float): Minutes per frame for the export
+    force (bool): Also run steps whose inputs and parameters are unchanged, see stage_manifest.py
+    queue_size (int): Positions a step may finish ahead of the next one
+    should_stop (callable): Checked before each position is started, True stops feeding positions
+    tile_size (int): Segment frames in tiles of this size, see segment_positions
+
+    Returns:
+    dict: Step name -> list of positions it completed
+    """
+    steps = [step for step in PIPELINE_STEPS if step != 'square_rois' or micron_size is not None]
+    params = {
+        'segmentation': {'nd2_path': nd2_path, 'out_dir': out_dir, 'seg_channel': seg_channel, 'fl_channels': fl_channels,
+                         'frame_min': frame_min, 'frame_max': frame_max, 'chunk_size': chunk_size, 'force': force,
+                         'tile_size': tile_size},
+        'tracking': {'out_dir': out_dir, 'expand': expand, 'force': force},
+        'square_rois': {'out_dir': out_dir, 'micron_size': micron_size, 'force': force},
+        'export': {'out_dir': out_dir, 'mins': mins, 'force': force},
+    }
+
+    context = multiprocessing.get_context('spawn')
+    # Input queue of every step, the last step has no output
+    queues = [context.Queue(maxsize=queue_size) for _ in steps] + [None]
+    events = context.Queue()
+    workers = [
+        context.Process(target=_step_worker, args=(step, params[step], queues[i], queues[i + 1], events),
+                        name=f'pipeline-{step}', daemon=True)
+        for i, step in enumerate(steps)
+    ]
+
+    completed = {step: [] for step in steps}
+    previous_handler = None
+    if threading.current_thread() is threading.main_thread():
+        # Terminating this process must not leave the step processes running
+        previous_handler = signal.signal(signal.SIGTERM, _exit_on_signal)
+    try:
+        for worker in workers:
+            worker.start()
+        feeder = threading.Thread(target=_feed, args=(list(pos), queues[0], should_stop), daemon=True)
+        feeder.start()
+
+        running = len(workers)
+        while running > 0:
+            try:
+                kind, *data = events.get(timeout=1.0)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    print('Pipeline steps exited unexpectedly')
+                    break
+                continue
+            if kind == 'log':
+                sys.stdout.write(data[0])
+            elif kind == 'progress':
+                for listener in pipeline_metrics.progress_listeners:
+                    listener(data[0])
+            elif kind == 'done':
+                step, position, seconds = data
+                completed[step].append(position)
+                print(f'Position {position}: {step} done in {seconds:.1f} s')
+                # Also covers steps that were up to date and reported no progress
+                event = {'step': step, 'position': position, 'unit': 'position', 'done': 1, 'total': 1,
+                         'rate': None, 'eta': None}
+                for listener in pipeline_metrics.progress_listeners:
+                    listener(event)
+            elif kind == 'error':
+                step, position, message = data
+                print(f'Position {position}: {step} failed, skipping the remaining steps\n{message}')
+            elif kind == 'exit':
+                running -= 1
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+        if previous_handler is not None:
+            signal.signal(signal.SIGTERM, previous_handler)
+    return completed
+
+
+def _exit_on_signal(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def _feed(positions, inbox, should_stop):
+    for position in positions:
+        if should_stop is not None and should_stop():
+            break
+        inbox.put(position)
+    inbox.put(None)
+
+
+class _EventWriter:
+    """Forwards the output of a step process to the pipeline process"""
+
+    def __init__(self, events):
+        self.events = events
+
+    def write(self, text):
+        if text:
+            self.events.put(('log', text))
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def _run_step(step, position, params):
+    if step == 'segmentation':
+        pyama_util.segment_positions(params['nd2_path'], params['out_dir'], [position], params['seg_channel'],
+                                     params['fl_channels'], frame_min=params['frame_min'],
+                                     frame_max=params['frame_max'], chunk_size=params['chunk_size'],
+                                     force=params['force'], tile_size=params['tile_size'])
+    elif step == 'tracking':
+        pyama_util.tracking_pyama(params['out_dir'], [position], expand=params['expand'], force=params['force'])
+    elif step == 'square_rois':
+        pyama_util.square_roi(params['out_dir'], [position], params['micron_size'], force=params['force'])
+    elif step == 'export':
+        pyama_util.csv_output(params['out_dir'], [position], params['mins'], force=params['force'])
+
+
+def _step_worker(step, params, inbox, outbox, events):
+    sys.stdout = sys.stderr = _EventWriter(events)
+    pipeline_metrics.add_progress_listener(lambda event: events.put(('progress', event)))
+    while True:
+        position = inbox.get()
+        if position is None:
+            break
+        start = time.perf_counter()
+        try:
+            _run_step(step, position, params)
+        except Exception:
+            events.put(('error', step, position, traceback.format_exc()))
+            continue
+        events.put(('done', step, position, time.perf_counter() - start))
+        if outbox is not None:
+            outbox.put(position)
+    if outbox is not None:
+        outbox.put(None)
+    events.put(('exit', step))
@@ -0,0 +1,257 @@
+import fcntl
+import itertools
+import json
+import os
+import pathlib
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Per-position timings of the pipeline steps, next to data.h5
+METRICS_FILE = 'metrics.json'
+# Locked around every read-modify-write of metrics.json and manifest.json, see metadata_lock
+METADATA_LOCK = 'metadata.lock'
+
+# Called with every progress event, see StageMetrics.progress
+progress_listeners = []
+
+
+def add_progress_listener(listener):
+    progress_listeners.append(listener)
+
+
+def remove_progress_listener(listener):
+    if listener in progress_listeners:
+        progress_listeners.remove(listener)
+
+
+@contextmanager
+def metadata_lock(pos_path):
+    """
+    Exclusive lock of the per-position step records (metrics.json, manifest.json), shared by
+    threads and processes on the same machine. Separate from pyama_util.tracks_lock, which is not
+    reentrant and may be held by the step writing its record.
+
+    Parameters:
+    pos_path (pathlib.Path): Path to position directory
+    """
+    with open(pathlib.Path(pos_path).joinpath(METADATA_LOCK).absolute(), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_json_atomic(path, data):
+    """Replace a JSON file, readers never see a partially written file"""
+    path = pathlib.Path(path)
+    tmp_path = path.with_name(f'{path.name}.{uuid.uuid4().hex}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def peak_memory():
+    """
+    Peak resident memory of this process since it started in bytes, None where unknown
+    """
+    if peak_memory_tracker.available:
+        # ru_maxrss is reset along with the high water mark
+        return peak_memory_tracker.process_peak()
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def _high_water_mark():
+    # Peak resident memory since the last reset (VmHWM) in bytes, Linux only
+    with open('/proc/self/status') as f:
+        return int(re.search(r'VmHWM:\s+(\d+) kB', f.read()).group(1)) * 1024
+
+
+class PeakMemory:
+    """
+    Peak resident memory over intervals of this process, e.g. one stage of a step. ru_maxrss never
+    decreases, so on Linux the kernel's high water mark is reset at the start of every interval
+    (writing 5 to /proc/self/clear_refs); the peak seen up to a reset is first added to the intervals
+    still open, so nested and concurrent intervals keep their own peaks. Elsewhere peaks are None.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open = {}
+        self.ids = itertools.count()
+        # Peak of the process up to the last reset
+        self.reset_peak = 0
+        try:
+            self._reset()
+            self.available = True
+        except (OSError, AttributeError):
+            self.available = False
+
+    def _reset(self):
+        peak = _high_water_mark()
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        self.reset_peak = max(self.reset_peak, peak)
+        return _high_water_mark()
+
+    def process_peak(self):
+        with self.lock:
+            return max(self.reset_peak, _high_water_mark())
+
+    def start(self):
+        """Start an interval, returns the id to pass to stop"""
+        if not self.available:
+            return None
+        with self.lock:
+            peak = _high_water_mark()
+            for key in self.open:
+                self.open[key] = max(self.open[key], peak)
+            key = next(self.ids)
+            self.open[key] = self._reset()
+            return key
+
+    def stop(self, key):
+        """Peak of an interval in bytes, None where unknown"""
+        if key is None:
+            return None
+        with self.lock:
+            return max(self.open.pop(key), _high_water_mark())
+
+
+peak_memory_tracker = PeakMemory()
+
+
+class StageMetrics:
+    """
+    Timers, counters and progress of one pipeline step (e.g. segmentation) on one position.
+
+    Stages within the step are timed with `with metrics.timer('nd2_read'):`, wall and CPU time
+    add up over repeated calls, peak_memory is the highest over the calls. write() stores the
+    result under the step in metrics.json.
+    """
+
+    def __init__(self, step, pos, pos_path):
+        self.step = step
+        self.pos = pos
+        self.pos_path = pathlib.Path(pos_path)
+        self.stages = {}
+        self.counters = {}
+        self.total = None
+        self.unit = 'frame'
+        self.started = time.time()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self.progress_start = self.wall_start
+        self.memory = peak_memory_tracker.start()
+        self.peak_memory = None
+
+    @contextmanager
+    def timer(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        memory = peak_memory_tracker.start()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'wall_time': 0.0, 'cpu_time': 0.0, 'calls': 0, 'peak_memory': None})
+            stage['wall_time'] += time.perf_counter() - wall
+            stage['cpu_time'] += time.process_time() - cpu
+            stage['calls'] += 1
+            peak = peak_memory_tracker.stop(memory)
+            if peak is not None:
+                stage['peak_memory'] = max(stage['peak_memory'] or 0, peak)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def start_progress(self, total, unit='frame'):
+        self.total = total
+        self.unit = unit
+        self.progress_start = time.perf_counter()
+
+    def progress(self, done, message=None):
+        """
+        Report that done of the total units are processed, printed and passed to the progress listeners
+
+        Parameters:
+        done (int): Units processed so far
+        message (str): Printed with the progress, e.g. per-frame results
+        """
+        elapsed = time.perf_counter() - self.progress_start
+        rate = done / elapsed if elapsed > 0 else None
+        eta = (self.total - done) / rate if rate and self.total is not None else None
+        event = {
+            'step': self.step,
+            'position': self.pos,
+            'unit': self.unit,
+            'done': done,
+            'total': self.total,
+            'rate': rate,
+            'eta': eta,
+        }
+        text = f'{self.unit.capitalize()} {done}/{self.total}'
+        if rate is not None:
+            text += f' ({rate:.2f}/s'
+            text += f', ETA {eta:.0f} s)' if eta is not None else ')'
+        print(f'{message} [{text}]' if message else text)
+        for listener in progress_listeners:
+            listener(event)
+
+    def summary(self):
+        """
+        Timings of the step, called when it ends. peak_memory is the peak of the step (None where
+        unknown), process_peak_memory that of the process since it started, including earlier steps.
+        """
+        if self.memory is not None:
+            self.peak_memory = peak_memory_tracker.stop(self.memory)
+            self.memory = None
+        wall_time = time.perf_counter() - self.wall_start
+        return {
+            'position': self.pos,
+            'started': self.started,
+            'wall_time': wall_time,
+            'cpu_time': time.process_time() - self.cpu_start,
+            'peak_memory': self.peak_memory,
+            'process_peak_memory': peak_memory(),
+            'throughput': self.total / wall_time if self.total and wall_time > 0 else None,
+            'unit': self.unit,
+            'stages': self.stages,
+            'counters': self.counters,
+        }
+
+    def write(self):
+        """Store the summary under the step in metrics.json of the position, keeping other steps"""
+        summary = self.summary()
+        with metadata_lock(self.pos_path):
+            metrics = read_metrics(self.pos_path)
+            metrics[self.step] = summary
+            write_json_atomic(self.pos_path.joinpath(METRICS_FILE), metrics)
+
+
+def read_metrics(pos_path):
+    """
+    Metrics of the pipeline steps run on a position
+
+    Parameters:
+    pos_path (pathlib.Path): Path to position directory
+
+    Returns:
+    dict: Step name -> summary, empty if none were recorded
+    """
+    path = pathlib.Path(pos_path).joinpath(METRICS_FILE)
+    if not path.is_file():
+        return {}
+    with open(path) as f:
+        return json.load(f)
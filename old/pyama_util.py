@@ -8,6 +8,10 @@ import cv2
 import pandas as pd
 import re
 import math
+import io
+import fcntl
+import uuid
+from contextlib import contextmanager
 
 
 # import matplotlib.pyplot as plt
@@ -17,11 +21,37 @@ import pathlib
 import scipy.ndimage as smg
 from nd2reader import ND2Reader
 
+from pipeline_metrics import StageMetrics
+from label_index import LabelIndexWriter
+from stage_manifest import step_is_current, record_step
+
 STRUCT3 = np.ones((3,3), dtype=np.bool_)
 STRUCT5 = np.ones((5,5), dtype=np.bool_)
 STRUCT5[[0,0,-1,-1], [0,-1,0,-1]] = False
 
-@nb.njit
+# Enable/disable edits are appended here and folded into tracks.csv later
+TRACKS_JOURNAL = 'tracks_journal.csv'
+TRACKS_JOURNAL_COMPACTING = 'tracks_journal.compacting.csv'
+# Per-particle statistics, written after tracking
+TRACK_SUMMARY = 'track_summary.csv'
+# Locked around every read-modify-write of tracks.csv, see tracks_lock
+TRACKS_LOCK = 'tracks.lock'
+
+# Comparison operators usable in curation rules
+CURATION_OPERATORS = {
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal,
+    '==': np.equal,
+    '!=': np.not_equal,
+}
+# Applied right after tracking
+DEFAULT_CURATION_RULES = [{'stat': 'area_max', 'op': '>', 'value': 10000}]
+
+OUTLINE_KERNEL = np.array([[0,0,1,0,0],[0,1,1,1,0],[1,1,0,1,1],[0,1,1,1,0],[0,0,1,0,0]], dtype=np.uint8)
+
+@nb.njit(cache=True, nogil=True)
 def window_std(img: np.ndarray) -> float:
     """
     Calculate unnormed variance of 'img'
@@ -36,19 +66,18 @@ def window_std(img: np.ndarray) -> float:
     """
     return np.sum((img - np.mean(img))**2)
 
-@nb.njit
-def generic_filter(img: np.ndarray, fun: callable, size: int = 3, reflect: bool = False) -> np.ndarray:
+@nb.njit(cache=True, nogil=True)
+def pad_image(img: np.ndarray, size: int = 3, reflect: bool = False) -> np.ndarray:
     """
-    Apply filter to image.
+    Copy of an image with borders of size // 2 pixels for filtering with a size x size kernel
 
     Parameters:
-    img (np.ndarray): The image to be filtered
-    fun (callable): The filter function to be applied, must accept subimage of 'img' as only argument and return a scalar. "Fun" stands for function and callable should stand for function in Python
+    img (np.ndarray): The image to be padded
     size (int): The size (side length) of the kernel. Must be an odd integer
-    reflect (bool): Switch for border mode: True for 'reflect', False for 'mirror'. Reflect and Mirror should be filling the borders of the img.
+    reflect (bool): Switch for border mode: True for 'reflect', False for 'mirror'
 
     Returns:
-    np.ndarray: Filtered image as a np.float64 array with same shape as 'img'
+    np.ndarray: Padded image as a np.float64 array
 
     Raises:
     ValueError: If 'size' is not an odd integer
@@ -58,7 +87,6 @@ def generic_filter(img: np.ndarray, fun: callable, size: int = 3, reflect: bool
     height, width = img.shape
     s2 = size // 2
 
-    # Set up temporary image for correct border handling
     img_temp = np.empty((height+2*s2, width+2*s2), dtype=np.float64)
     img_temp[s2:-s2, s2:-s2] = img
     if reflect:
@@ -71,50 +99,159 @@ def generic_filter(img: np.ndarray, fun: callable, size: int = 3, reflect: bool
         img_temp[-s2:, s2:-s2] = img[-2:-s2-2:-1, :]
         img_temp[:, :s2] = img_temp[:, 2*s2:s2:-1]
         img_temp[:, -s2:] = img_temp[:, -s2-2:-2*s2-2:-1]
+    return img_temp
+
+@nb.njit
+def generic_filter(img: np.ndarray, fun: callable, size: int = 3, reflect: bool = False) -> np.ndarray:
+    """
+    Apply filter to image.
+    Not cached on disk: numba ties code compiled for a function argument to that function object.
+
+    Parameters:
+    img (np.ndarray): The image to be filtered
+    fun (callable): The filter function to be applied, must accept subimage of 'img' as only argument and return a scalar. "Fun" stands for function and callable should stand for function in Python
+    size (int): The size (side length) of the kernel. Must be an odd integer
+    reflect (bool): Switch for border mode: True for 'reflect', False for 'mirror'. Reflect and Mirror should be filling the borders of the img.
+
+    Returns:
+    np.ndarray: Filtered image as a np.float64 array with same shape as 'img'
+
+    Raises:
+    ValueError: If 'size' is not an odd integer
+    """
+    height, width = img.shape
+    img_temp = pad_image(img, size, reflect)
 
     # Create and populate result image
     filtered_img = np.empty_like(img, dtype=np.float64)
     for y in range(height):
         for x in range(width):
-            filtered_img[y, x] = fun(img_temp[y:y+2*s2+1, x:x+2*s2+1])
+            filtered_img[y, x] = fun(img_temp[y:y+size, x:x+size])
 
     return filtered_img
 
+@nb.njit(cache=True, nogil=True)
+def std_filter(img: np.ndarray, size: int = 3, reflect: bool = False) -> np.ndarray:
+    """
+    generic_filter with window_std, compiled once and cached on disk
 
-def binarize_frame(img: np.ndarray, mask_size: int = 3) -> np.ndarray:
+    Parameters:
+    img (np.ndarray): The image to be filtered
+    size (int): The size (side length) of the kernel. Must be an odd integer
+    reflect (bool): Switch for border mode: True for 'reflect', False for 'mirror'
+
+    Returns:
+    np.ndarray: Unnormed variance around every pixel as a np.float64 array with same shape as 'img'
     """
-    Coarse segmentation of phase-contrast image frame
-    Refer to OpenCV tutorials for more information on binarization/thresholding techniques.
+    height, width = img.shape
+    img_temp = pad_image(img, size, reflect)
+
+    filtered_img = np.empty_like(img, dtype=np.float64)
+    for y in range(height):
+        for x in range(width):
+            filtered_img[y, x] = window_std(img_temp[y:y+size, x:x+size])
+
+    return filtered_img
+
+def compile_kernels():
+    """
+    Compile the numba kernels of the segmentation for the image types it sees, later processes
+    load them from the on-disk cache (see manage.py warmup)
+    """
+    for dtype in (np.uint16, np.float64):
+        img = np.zeros((8, 8), dtype=dtype)
+        std_filter(img, 3)
+        binarize_frame(img)
+
+
+def std_log_map(img: np.ndarray, mask_size: int = 3) -> np.ndarray:
+    """
+    Logarithmic standard deviation at each pixel, the expensive first step of binarize_frame
 
     Parameters:
-    img (np.ndarray): The image to be binarized
-    mask_size (int): The size of the mask to be used in the binarization process (mask refers to kernel size in image processing)
+    img (np.ndarray): Phase-contrast image frame
+    mask_size (int): Side length of the std filter window
 
     Returns:
-    np.ndarray: Binarized image of frame
+    np.ndarray: Log standard deviation map
     """
-    # Get logarithmic standard deviation at each pixel
-    std_log = generic_filter(img, window_std, size=mask_size)
+    std_log = std_filter(img, size=mask_size)
     std_log[std_log>0] = (np.log(std_log[std_log>0]) - np.log(mask_size**2 - 1)) / 2
+    return std_log
 
-    # Get width of histogram modulus
+def std_log_background(std_log: np.ndarray) -> tuple:
+    """
+    Position and width of the background peak of the std_log_map histogram
+
+    Parameters:
+    std_log (np.ndarray): Log standard deviation map
+
+    Returns:
+    tuple: (histogram mode, standard deviation of the values up to the mode)
+    """
     counts, edges = np.histogram(std_log, bins=200)
     bins = (edges[:-1] + edges[1:]) / 2
     hist_max = bins[np.argmax(counts)]
     sigma = np.std(std_log[std_log <= hist_max])
+    return hist_max, sigma
 
-    # Apply histogram-based threshold
-    img_bin = std_log >= hist_max + 3 * sigma
+def clean_binary(img_bin: np.ndarray) -> np.ndarray:
+    """
+    Remove noise from a thresholded std_log_map
+
+    Parameters:
+    img_bin (np.ndarray): Thresholded image
 
-    # Remove noise
+    Returns:
+    np.ndarray: Binarized image of frame
+    """
     img_bin = smg.binary_dilation(img_bin, structure=STRUCT3)
     img_bin = smg.binary_fill_holes(img_bin)
     img_bin &= smg.binary_opening(img_bin, iterations=2, structure=STRUCT5)
     img_bin = smg.binary_erosion(img_bin, border_value=1)
-
     return img_bin
 
-def csv_output(out_dir: str, pos: list, mins: float, use_square_rois: bool = True) -> None:
+def binarize_frame(img: np.ndarray, mask_size: int = 3, threshold: float = 3) -> np.ndarray:
+    """
+    Coarse segmentation of phase-contrast image frame
+    Refer to OpenCV tutorials for more information on binarization/thresholding techniques.
+
+    Parameters:
+    img (np.ndarray): The image to be binarized
+    mask_size (int): The size of the mask to be used in the binarization process (mask refers to kernel size in image processing)
+    threshold (float): Pixels more than this many background standard deviations above the
+        background peak of the log std histogram are foreground
+
+    Returns:
+    np.ndarray: Binarized image of frame
+    """
+    # Get logarithmic standard deviation at each pixel
+    std_log = std_log_map(img, mask_size)
+
+    # Get width of histogram modulus
+    hist_max, sigma = std_log_background(std_log)
+
+    # Apply histogram-based threshold and remove noise
+    return clean_binary(std_log >= hist_max + threshold * sigma)
+
+def label_outlines(labels: np.ndarray) -> np.ndarray:
+    """
+    Outlines of a label image.
+    A pixel belongs to the outline of its label if any pixel in the diamond shaped OUTLINE_KERNEL
+    neighbourhood has a different label. Uses integer min/max filters instead of a float mean filter.
+
+    Parameters:
+    labels (np.ndarray): Label image (uint16)
+
+    Returns:
+    np.ndarray: Image with the label value on outline pixels and 0 elsewhere, same dtype as 'labels'
+    """
+    eroded = cv2.erode(labels, OUTLINE_KERNEL, borderType=cv2.BORDER_REFLECT_101)
+    dilated = cv2.dilate(labels, OUTLINE_KERNEL, borderType=cv2.BORDER_REFLECT_101)
+    outlines = np.where((eroded != labels) | (dilated != labels), labels, 0)
+    return outlines.astype(labels.dtype, copy=False)
+
+def csv_output(out_dir: str, pos: list, mins: float, use_square_rois: bool = True, force: bool = False) -> None:
     """
     Generate CSV output for tracked positions
 
@@ -123,13 +260,19 @@ def csv_output(out_dir: str, pos: list, mins: float, use_square_rois: bool = Tru
     pos (list): List of positions to process
     mins (float): Minutes per frame
     use_square_rois (bool): Whether to use square ROIs
+    force (bool): Export positions whose tracks and parameters are unchanged since the last export
 
     Returns:
     None
     """
     folders = get_tracked_folders(out_dir,pos)
     for folder in folders:
+        params = {'mins': mins, 'use_square_rois': use_square_rois}
+        if not force and step_is_current(folder[1], 'export', params):
+            print("Position " + str(folder[0]) + ":", "Export is up to date")
+            continue
         csv_output_position(folder[0],folder[1],mins,use_square_rois)
+        record_step(folder[1], 'export', params)
 
 def csv_output_position(pos: int, pos_path: pathlib.Path, mins: float, use_square_rois: bool) -> None:
     """
@@ -144,12 +287,13 @@ def csv_output_position(pos: int, pos_path: pathlib.Path, mins: float, use_squar
     Returns:
     None
     """
-    tracks_path = pos_path.joinpath('tracks.csv')
-    tracks = pd.read_csv(tracks_path.absolute(),index_col=0)
+    metrics = StageMetrics('export', pos, pos_path)
+    with metrics.timer('csv_read'):
+        tracks = read_tracks(pos_path)
 
     data_path = pos_path.joinpath('data.h5')
 
-    with h5py.File(data_path.absolute(), "r") as data:
+    with metrics.timer('hdf5_read'), h5py.File(data_path.absolute(), "r") as data:
         frames = range(data.attrs['frame_min'],data.attrs['frame_max']+1)
         fl_channel_names = data.attrs['fl_channel_names']
 
@@ -159,24 +303,35 @@ def csv_output_position(pos: int, pos_path: pathlib.Path, mins: float, use_squar
     particles.sort()
 
     print("Starting Data Export for position:",str(pos))
+    # One sheet for the area and one per fluorescence channel
+    metrics.start_progress(len(fl_channel_names) + 1, unit='sheet')
+    metrics.count('particles', len(particles))
 
     with pd.ExcelWriter(excel_path.absolute()) as writer:
-        if use_square_rois == True and 'square_area' in tracks:
-            area = csv_get_table(particles,tracks,frames,mins,'square_area')
-        else:
-            area = csv_get_table(particles,tracks,frames,mins,'area')
-        area.to_excel(writer, sheet_name='Area', index=False)
+        with metrics.timer('tables'):
+            if use_square_rois == True and 'square_area' in tracks:
+                area = csv_get_table(particles,tracks,frames,mins,'square_area')
+            else:
+                area = csv_get_table(particles,tracks,frames,mins,'area')
+        with metrics.timer('excel_write'):
+            area.to_excel(writer, sheet_name='Area', index=False)
+        metrics.progress(1)
 
         for i in range(len(fl_channel_names)):
             col_name = 'brightness_' + str(i)
-            if use_square_rois == True and 'square_' + col_name in tracks:
-                brightness = csv_get_table(particles,tracks,frames,mins,'square_' + col_name)
-            else:
-                brightness = csv_get_table(particles,tracks,frames,mins,col_name)
-            brightness.to_excel(writer, sheet_name=fl_channel_names[i], index=False)
-
-            table_to_image(pos_path,particles,brightness,fl_channel_names[i])
-
+            with metrics.timer('tables'):
+                if use_square_rois == True and 'square_' + col_name in tracks:
+                    brightness = csv_get_table(particles,tracks,frames,mins,'square_' + col_name)
+                else:
+                    brightness = csv_get_table(particles,tracks,frames,mins,col_name)
+            with metrics.timer('excel_write'):
+                brightness.to_excel(writer, sheet_name=fl_channel_names[i], index=False)
+
+            with metrics.timer('plots'):
+                table_to_image(pos_path,particles,brightness,fl_channel_names[i])
+            metrics.progress(i + 2)
+
+    metrics.write()
     print('Done')
 
 def table_to_image(pos_path: pathlib.Path, particles: list, table: pd.DataFrame, name: str) -> None:
@@ -251,7 +406,7 @@ def csv_get_table(particles: list, tracks: pd.DataFrame, frames: list, mins: flo
     return pd.DataFrame(data)
 
 
-def square_roi(out_dir: str, pos: list, micron_size: float) -> None:
+def square_roi(out_dir: str, pos: list, micron_size: float, force: bool = False) -> None:
     """
     Post-processing step where the micron_size defines the length of the squares.
     Apply square ROI to tracked positions
@@ -260,6 +415,7 @@ def square_roi(out_dir: str, pos: list, micron_size: float) -> None:
     out_dir (str): Output directory path
     pos (list): List of positions to process
     micron_size (float): Size of ROI in microns
+    force (bool): Process positions whose tracks and size are unchanged since the last run
 
     Returns:
     None
@@ -267,7 +423,12 @@ def square_roi(out_dir: str, pos: list, micron_size: float) -> None:
     folders = get_tracked_folders(out_dir,pos)
     print(folders)
     for folder in folders:
+        params = {'micron_size': micron_size}
+        if not force and step_is_current(folder[1], 'square_rois', params):
+            print("Position " + str(folder[0]) + ":", "Square ROIs are up to date")
+            continue
         square_roi_position(folder[0],folder[1],micron_size)
+        record_step(folder[1], 'square_rois', params)
 
 def square_roi_position(pos: int, pos_path: pathlib.Path, micron_size: float) -> None:
     """
@@ -282,58 +443,68 @@ def square_roi_position(pos: int, pos_path: pathlib.Path, micron_size: float) ->
     Returns:
     None
     """
-    tracks_path = pos_path.joinpath('tracks.csv')
-    tracks = pd.read_csv(tracks_path.absolute(),index_col=0)
+    metrics = StageMetrics('square_rois', pos, pos_path)
+    # Locked until tracks.csv is written, edits compacted meanwhile would be overwritten
+    with tracks_lock(pos_path):
+        with metrics.timer('csv_read'):
+            tracks = read_tracks(pos_path)
 
-    data_path = pos_path.joinpath('data.h5')
-    data = h5py.File(data_path.absolute(), "r")
+        data_path = pos_path.joinpath('data.h5')
+        data = h5py.File(data_path.absolute(), "r")
 
-    size = math.ceil(micron_size / data.attrs['pixel_microns'])
+        size = math.ceil(micron_size / data.attrs['pixel_microns'])
 
-    width,height = data.attrs['width'],data.attrs['height']
+        width,height = data.attrs['width'],data.attrs['height']
 
-    print("Starting Square ROIs for position:",str(pos))
+        print("Starting Square ROIs for position:",str(pos))
 
-    for frame in sorted(tracks['frame'].unique()):
-        frame_data_index = frame-data.attrs['frame_min']
-        print("Frame",str(int(frame)))
+        frames = sorted(tracks['frame'].unique())
+        metrics.start_progress(len(frames))
+        for frame_number, frame in enumerate(frames):
+            frame_data_index = frame-data.attrs['frame_min']
 
-        # t = tracks[(tracks['frame'] == frame) & (tracks['enabled'] == True)]
-        true_values = [1, '1', '1.0', 1.0, True, 'True', 'true', 'TRUE']
+            # t = tracks[(tracks['frame'] == frame) & (tracks['enabled'] == True)]
+            true_values = [1, '1', '1.0', 1.0, True, 'True', 'true', 'TRUE']
 
-        # Convert true_values to lowercase strings
-        true_values_lower = [str(v).lower() for v in true_values]
+            # Convert true_values to lowercase strings
+            true_values_lower = [str(v).lower() for v in true_values]
 
-        # Create the enabled condition:
-        # 1. Convert the enabled column to string
-        # 2. Convert all values to lowercase
-        # 3. Check if they're in our true_values list
-        enabled_condition = tracks['enabled'].astype(str).str.lower().isin(true_values_lower)
+            # Create the enabled condition:
+            # 1. Convert the enabled column to string
+            # 2. Convert all values to lowercase
+            # 3. Check if they're in our true_values list
+            enabled_condition = tracks['enabled'].astype(str).str.lower().isin(true_values_lower)
 
-        # Apply both conditions to filter the dataframe
-        t = tracks[
-            (tracks['frame'] == frame) & (enabled_condition)]
+            # Apply both conditions to filter the dataframe
+            t = tracks[
+                (tracks['frame'] == frame) & (enabled_condition)]
 
 
-        for index, record in t.iterrows():
+            for index, record in t.iterrows():
 
-            x = int((record['bbox_x1'] + record['bbox_x2']) // 2)
-            y = int((record['bbox_y1'] + record['bbox_y2']) // 2)
+                x = int((record['bbox_x1'] + record['bbox_x2']) // 2)
+                y = int((record['bbox_y1'] + record['bbox_y2']) // 2)
 
-            x1 = max(0,x - size)
-            y1 = max(0,y - size)
+                x1 = max(0,x - size)
+                y1 = max(0,y - size)
 
-            x2 = min(height-1,x + size)
-            y2 = min(width-1,y +  size)
+                x2 = min(height-1,x + size)
+                y2 = min(width-1,y +  size)
 
-            tracks.loc[(tracks['frame'] == frame) & (tracks['particle'] == record['particle']), 'square_area'] = (x2-x1) * (y2-y1)
-            for i in range(len(data.attrs['fl_channels'])):
+                tracks.loc[(tracks['frame'] == frame) & (tracks['particle'] == record['particle']), 'square_area'] = (x2-x1) * (y2-y1)
+                for i in range(len(data.attrs['fl_channels'])):
 
-                im_slice = data['fluorescence'][int(frame_data_index),i][x1:x2,y1:y2]
-                tracks.loc[(tracks['frame'] == frame) & (tracks['particle'] == record['particle']), 'square_brightness_' + str(i)] = im_slice.sum()
+                    with metrics.timer('hdf5_read'):
+                        im_slice = data['fluorescence'][int(frame_data_index), i, x1:x2, y1:y2]
+                    tracks.loc[(tracks['frame'] == frame) & (tracks['particle'] == record['particle']), 'square_brightness_' + str(i)] = im_slice.sum()
+                metrics.count('rois')
 
-    data.close()
-    tracks.to_csv(tracks_path.absolute())
+            metrics.progress(frame_number + 1, message=f"Frame {int(frame)}")
+
+        data.close()
+        with metrics.timer('csv_write'):
+            write_tracks(pos_path, tracks, keep_summary=True)
+    metrics.write()
     print("Done")
 
 
@@ -500,7 +671,353 @@ def get_tracked_folders(out_dir: str, pos: list) -> list:
         folders.append(folder)
     return folders
 
-def tracking_pyama(out_dir: str, pos: list, expand: int = 0) -> None:
+def read_tracks(pos_path: pathlib.Path) -> pd.DataFrame:
+    """
+    Read tracks.csv of a position with the pending enable/disable edits of the journal applied
+
+    Parameters:
+    pos_path (pathlib.Path): Path to position directory
+
+    Returns:
+    pd.DataFrame: Tracks as they are after all edits
+    """
+    tracks = pd.read_csv(pos_path.joinpath('tracks.csv').absolute(), index_col=0)
+    return apply_tracks_journal(tracks, read_tracks_journal(pos_path))
+
+@contextmanager
+def tracks_lock(pos_path: pathlib.Path):
+    """
+    Exclusive lock of the tracks of a position, shared by threads, web workers and job processes
+    on the same machine. Held from reading tracks.csv and its journal until the new tracks.csv
+    is written, so concurrent writers cannot drop each other's changes. Not reentrant.
+
+    Parameters:
+    pos_path (pathlib.Path): Path to position directory
+    """
+    with open(pos_path.joinpath(TRACKS_LOCK).absolute(), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def write_tracks(pos_path: pathlib.Path, tracks: pd.DataFrame, keep_summary: bool = False) -> None:
+    """
+    Atomically replace tracks.csv of a position, readers never see a partially written file.
+    Callers that read the tracks first hold tracks_lock.
+
+    Parameters:
+    pos_path (pathlib.Path): Path to position directory
+    tracks (pd.DataFrame): Tracks to write
+    keep_summary (bool): Particles and their statistics are unchanged, keep a valid track_summary.csv valid
+    """
+    tracks_path = pos_path.joinpath('tracks.csv')
+    # Unique, writers of other positions or an unlocked first write may run at the same time
+    tmp_path = pos_path.joinpath(f'tracks.csv.{uuid.uuid4().hex}.tmp')
+    summary_path = pos_path.joinpath(TRACK_SUMMARY)
+    keep_summary = keep_summary and summary_path.is_file() and tracks_path.is_file() and \
+        summary_path.stat().st_mtime_ns >= tracks_path.stat().st_mtime_ns
+    tracks.to_csv(tmp_path.absolute())
+    os.replace(tmp_path, tracks_path)
+    if keep_summary:
+        summary_path.touch()
+
+def read_tracks_journal(pos_path: pathlib.Path) -> pd.DataFrame:
+    """
+    Read the pending enable/disable edits of a position, oldest first
+
+    Parameters:
+    pos_path (pathlib.Path): Path to position directory
+
+    Returns:
+    pd.DataFrame: Edits with columns 'particle' and 'enabled'
+    """
+    edits = []
+    # Edits being compacted are older than the ones in the live journal
+    for name in (TRACKS_JOURNAL_COMPACTING, TRACKS_JOURNAL):
+        path = pos_path.joinpath(name)
+        if path.is_file() and path.stat().st_size > 0:
+            edits.append(pd.read_csv(path.absolute(), header=None, names=['particle', 'enabled']))
+    if len(edits) == 0:
+        return pd.DataFrame(columns=['particle', 'enabled'])
+    return pd.concat(edits, ignore_index=True)
+
+def read_tracks_journal_tail(pos_path: pathlib.Path, offset: int) -> tuple:
+    """
+    Read the edits appended to the journal of a position after a byte offset, complete lines only
+
+    Parameters:
+    pos_path (pathlib.Path): Path to position directory
+    offset (int): Byte offset up to which the journal has been read
+
+    Returns:
+    tuple: Edits with columns 'particle' and 'enabled', offset after the last complete line
+    """
+    try:
+        with open(pos_path.joinpath(TRACKS_JOURNAL).absolute(), 'rb') as journal:
+            journal.seek(offset)
+            data = journal.read()
+    except FileNotFoundError:
+        data = b''
+    end = data.rfind(b'\n') + 1
+    if end == 0:
+        return pd.DataFrame(columns=['particle', 'enabled']), offset
+    edits = pd.read_csv(io.BytesIO(data[:end]), header=None, names=['particle', 'enabled'])
+    return edits, offset + end
+
+def apply_tracks_journal(tracks: pd.DataFrame, edits: pd.DataFrame) -> pd.DataFrame:
+    """
+    Apply enable/disable edits to tracks, the last edit of each particle wins
+
+    Parameters:
+    tracks (pd.DataFrame): Tracks to update in place
+    edits (pd.DataFrame): Edits with columns 'particle' and 'enabled'
+
+    Returns:
+    pd.DataFrame: The updated tracks
+    """
+    if len(edits) == 0:
+        return tracks
+    last = edits.drop_duplicates('particle', keep='last').set_index('particle')['enabled']
+    # The column may be boolean (fresh tracking) while edits are stored as 1/0
+    tracks['enabled'] = tracks['enabled'].astype(object)
+    mask = tracks['particle'].isin(last.index)
+    tracks.loc[mask, 'enabled'] = tracks.loc[mask, 'particle'].map(last).values
+    return tracks
+
+def append_tracks_journal(pos_path: pathlib.Path, particle, enabled: int) -> None:
+    """
+    Record an enable/disable edit of a particle without rewriting tracks.csv
+
+    Parameters:
+    pos_path (pathlib.Path): Path to position directory
+    particle: Particle ID
+    enabled (int): 1 if enabled, 0 if disabled
+    """
+    with open(pos_path.joinpath(TRACKS_JOURNAL).absolute(), 'a') as journal:
+        journal.write(f'{particle},{int(enabled)}\n')
+
+def compact_tracks_journal(pos_path: pathlib.Path) -> None:
+    """
+    Fold the journal of a position into tracks.csv.
+    The journal is first moved aside so new edits can be appended meanwhile,
+    read_tracks applies the moved edits until tracks.csv has been replaced.
+
+    Parameters:
+    pos_path (pathlib.Path): Path to position directory
+    """
+    with tracks_lock(pos_path):
+        compact_tracks_journal_locked(pos_path)
+
+def compact_tracks_journal_locked(pos_path: pathlib.Path) -> None:
+    """
+    compact_tracks_journal for callers already holding tracks_lock
+
+    Parameters:
+    pos_path (pathlib.Path): Path to position directory
+    """
+    journal_path = pos_path.joinpath(TRACKS_JOURNAL)
+    compacting_path = pos_path.joinpath(TRACKS_JOURNAL_COMPACTING)
+
+    # A leftover file from an interrupted compaction is folded in first
+    if not compacting_path.is_file():
+        if not journal_path.is_file():
+            return
+        os.replace(journal_path, compacting_path)
+
+    tracks = pd.read_csv(pos_path.joinpath('tracks.csv').absolute(), index_col=0)
+    edits = pd.read_csv(compacting_path.absolute(), header=None, names=['particle', 'enabled'])
+    write_tracks(pos_path, apply_tracks_journal(tracks, edits), keep_summary=True)
+    compacting_path.unlink()
+
+def discard_tracks_journal(pos_path: pathlib.Path) -> None:
+    """
+    Drop pending edits of a position, used when tracks.csv is regenerated. Callers hold tracks_lock.
+
+    Parameters:
+    pos_path (pathlib.Path): Path to position directory
+    """
+    for name in (TRACKS_JOURNAL, TRACKS_JOURNAL_COMPACTING):
+        path = pos_path.joinpath(name)
+        if path.is_file():
+            path.unlink()
+
+def enabled_mask(values: pd.Series) -> np.ndarray:
+    """
+    Boolean array of an 'enabled' column, which may hold 1/0, True/False or their string forms
+
+    Parameters:
+    values (pd.Series): Enabled column
+
+    Returns:
+    np.ndarray: True where the particle is enabled
+    """
+    true_values = [1, '1', '1.0', 1.0, True, 'True', 'true', 'TRUE']
+    true_values_lower = [str(v).lower() for v in true_values]
+    return values.astype(str).str.lower().isin(true_values_lower).values
+
+def track_summary(tracks: pd.DataFrame, width: int, height: int) -> pd.DataFrame:
+    """
+    Per-particle statistics of a position, one row per particle indexed by particle ID.
+    Columns: length, frame_first, frame_last, area_min/max/mean, x_mean, y_mean,
+    brightness_<i>_min/max/mean/range, border_distance (closest approach of the
+    bounding box to the image border in pixels) and enabled.
+
+    Parameters:
+    tracks (pd.DataFrame): Tracks of the position
+    width (int): Image width
+    height (int): Image height
+
+    Returns:
+    pd.DataFrame: Summary table
+    """
+    tracks = tracks.assign(
+        enabled=enabled_mask(tracks['enabled']),
+        border_distance=np.minimum.reduce([
+            tracks['bbox_x1'].values, tracks['bbox_y1'].values,
+            height - 1 - tracks['bbox_x2'].values, width - 1 - tracks['bbox_y2'].values]))
+    grouped = tracks.groupby('particle')
+
+    summary = pd.DataFrame({
+        'length': grouped['frame'].count(),
+        'frame_first': grouped['frame'].min(),
+        'frame_last': grouped['frame'].max(),
+        'area_min': grouped['area'].min(),
+        'area_max': grouped['area'].max(),
+        'area_mean': grouped['area'].mean(),
+        'x_mean': grouped['x'].mean(),
+        'y_mean': grouped['y'].mean(),
+    })
+    brightness_cols = sorted(c for c in tracks.columns if re.fullmatch(r'brightness_\d+', c))
+    for col in brightness_cols:
+        summary[col + '_min'] = grouped[col].min()
+        summary[col + '_max'] = grouped[col].max()
+        summary[col + '_mean'] = grouped[col].mean()
+        summary[col + '_range'] = summary[col + '_max'] - summary[col + '_min']
+    summary['border_distance'] = grouped['border_distance'].min()
+    summary['enabled'] = grouped['enabled'].first()
+    return summary
+
+def write_track_summary(pos_path: pathlib.Path, summary: pd.DataFrame) -> None:
+    """
+    Cache the track summary of a position in track_summary.csv.
+    The enabled column is left out, it changes with every edit and is taken from the tracks when loading.
+
+    Parameters:
+    pos_path (pathlib.Path): Path to position directory
+    summary (pd.DataFrame): Summary table from track_summary
+    """
+    summary.drop(columns='enabled').to_csv(pos_path.joinpath(TRACK_SUMMARY).absolute())
+
+def load_track_summary(pos_path: pathlib.Path, tracks: pd.DataFrame, width: int, height: int) -> pd.DataFrame:
+    """
+    Track summary of a position, read from track_summary.csv unless tracks.csv is newer.
+    The enabled column always reflects the given tracks.
+
+    Parameters:
+    pos_path (pathlib.Path): Path to position directory
+    tracks (pd.DataFrame): Tracks of the position, with the journal applied
+    width (int): Image width
+    height (int): Image height
+
+    Returns:
+    pd.DataFrame: Summary table indexed by particle ID
+    """
+    summary_path = pos_path.joinpath(TRACK_SUMMARY)
+    tracks_path = pos_path.joinpath('tracks.csv')
+    if summary_path.is_file() and summary_path.stat().st_mtime_ns >= tracks_path.stat().st_mtime_ns:
+        summary = pd.read_csv(summary_path.absolute(), index_col=0)
+        summary['enabled'] = pd.Series(enabled_mask(tracks['enabled']), index=tracks.index) \
+            .groupby(tracks['particle']).first().reindex(summary.index, fill_value=False)
+    else:
+        summary = track_summary(tracks, width, height)
+        write_track_summary(pos_path, summary)
+    return summary
+
+def curation_mask(summary: pd.DataFrame, rules: list) -> np.ndarray:
+    """
+    Evaluate curation rules over a track summary. A particle matches if it satisfies all rules.
+    Each rule is a dict {'stat': column of the summary, 'op': one of CURATION_OPERATORS, 'value': number}.
+
+    Parameters:
+    summary (pd.DataFrame): Summary table from track_summary
+    rules (list): List of rules
+
+    Returns:
+    np.ndarray: True for every particle (row of the summary) matched by the rules
+    """
+    mask = np.ones(len(summary), dtype=bool)
+    for rule in rules:
+        if rule['stat'] not in summary.columns or rule['stat'] == 'enabled':
+            raise ValueError(f"Unknown statistic: {rule['stat']}")
+        if rule['op'] not in CURATION_OPERATORS:
+            raise ValueError(f"Unknown operator: {rule['op']}")
+        mask &= CURATION_OPERATORS[rule['op']](summary[rule['stat']].values, float(rule['value']))
+    return mask
+
+def curate_position(pos: int, pos_path: pathlib.Path, rules: list, enabled: bool, apply: bool) -> dict:
+    """
+    Count, and optionally set, the particles of a position matched by curation rules
+
+    Parameters:
+    pos (int): Position number
+    pos_path (pathlib.Path): Path to position directory
+    rules (list): Curation rules, see curation_mask
+    enabled (bool): Enabled flag the matched particles get
+    apply (bool): Write the flags, otherwise only count
+
+    Returns:
+    dict: Number of particles, matched particles and particles whose flag changes
+    """
+    with h5py.File(pos_path.joinpath('data.h5').absolute(), "r") as data:
+        width, height = data.attrs['width'], data.attrs['height']
+
+    if not apply:
+        tracks = read_tracks(pos_path)
+        summary = load_track_summary(pos_path, tracks, width, height)
+        return curation_result(pos, summary, curation_mask(summary, rules), enabled)
+
+    with tracks_lock(pos_path):
+        # Fold pending viewer edits in first, so they are not applied on top of the rule afterwards
+        compact_tracks_journal_locked(pos_path)
+        tracks = read_tracks(pos_path)
+        summary = load_track_summary(pos_path, tracks, width, height)
+        mask = curation_mask(summary, rules)
+        result = curation_result(pos, summary, mask, enabled)
+        if result['changed'] > 0:
+            matched = np.isin(tracks['particle'].values, summary.index.values[mask])
+            tracks['enabled'] = np.where(matched, enabled, enabled_mask(tracks['enabled']))
+            write_tracks(pos_path, tracks, keep_summary=True)
+    return result
+
+def curation_result(pos: int, summary: pd.DataFrame, mask: np.ndarray, enabled: bool) -> dict:
+    """Counts reported by curate_position"""
+    return {
+        'position': pos,
+        'particles': len(summary),
+        'matched': int(mask.sum()),
+        'changed': int((mask & (summary['enabled'].values != enabled)).sum()),
+    }
+
+def curate_positions(out_dir: str, pos: list, rules: list, enabled: bool = False, apply: bool = False) -> list:
+    """
+    Enable or disable particles across positions by rules over their track statistics.
+    Without apply only the affected counts are returned, as a preview.
+
+    Parameters:
+    out_dir (str): Output directory path
+    pos (list): List of position numbers
+    rules (list): Curation rules, see curation_mask
+    enabled (bool): Enabled flag the matched particles get
+    apply (bool): Write the flags, otherwise only count
+
+    Returns:
+    list: Counts per position, see curate_position
+    """
+    folders = get_tracked_folders(out_dir, pos)
+    return [curate_position(folder[0], folder[1], rules, enabled, apply) for folder in folders]
+
+def tracking_pyama(out_dir: str, pos: list, expand: int = 0, force: bool = False) -> None:
     """
     Perform Pyama tracking on specified positions and saves them into the output directory
 
@@ -508,13 +1025,20 @@ def tracking_pyama(out_dir: str, pos: list, expand: int = 0) -> None:
     out_dir (str): Output directory path
     pos (list): List of position numbers
     expand (int): Expansion factor for labels
+    force (bool): Track positions whose segmentation and parameters are unchanged since the last tracking.
+        Tracking again discards enable/disable edits.
 
     Returns:
     None
     """
     folders = get_tracking_folders(out_dir,pos)
     for folder in folders:
+        params = {'expand': expand}
+        if not force and step_is_current(folder[1], 'tracking', params):
+            print("Position " + str(folder[0]) + ":", "Tracking is up to date")
+            continue
         track_position_pyama(folder[0],folder[1],expand)
+        record_step(folder[1], 'tracking', params)
 
 def track_position_pyama(pos: int, pos_path: pathlib.Path, expand: int) -> None:
     """
@@ -531,14 +1055,17 @@ def track_position_pyama(pos: int, pos_path: pathlib.Path, expand: int) -> None:
     Returns:
     None
     """
+    metrics = StageMetrics('tracking', pos, pos_path)
     features_path = pos_path.joinpath('features.csv')
-    features = pd.read_csv(features_path.absolute(),index_col=0)
+    with metrics.timer('csv_read'):
+        features = pd.read_csv(features_path.absolute(),index_col=0)
 
     data_path = pos_path.joinpath('data.h5')
     data = h5py.File(data_path.absolute(), "r")
     data_labels = data['labels']
 
     min_track_length = data.attrs['frame_max']-data.attrs['frame_min']+1
+    width, height = data.attrs['width'], data.attrs['height']
 
     tracks = []
 
@@ -546,8 +1073,8 @@ def track_position_pyama(pos: int, pos_path: pathlib.Path, expand: int) -> None:
     frames.sort()
 
     print("Starting Pyama Tracking for position " + str(pos))
-    for frame in frames:
-        print("Frame " + str(frame))
+    metrics.start_progress(len(frames))
+    for frame_number, frame in enumerate(frames):
         frame_data_index = frame-data.attrs['frame_min']
         frame_features = features[features['frame'] == frame]
         if len(tracks) == 0:
@@ -556,13 +1083,15 @@ def track_position_pyama(pos: int, pos_path: pathlib.Path, expand: int) -> None:
         else:
             matched_labels = []
 
-            frame_labels = data_labels[frame_data_index]
-            prev_labels = data_labels[frame_data_index-1]
+            with metrics.timer('hdf5_read'):
+                frame_labels = data_labels[frame_data_index]
+                prev_labels = data_labels[frame_data_index-1]
 
             # Add optional label expansion here
             if expand > 0:
-                frame_labels = sk.segmentation.expand_labels(frame_labels,expand)
-                prev_labels = sk.segmentation.expand_labels(prev_labels,expand)
+                with metrics.timer('expand_labels'):
+                    frame_labels = sk.segmentation.expand_labels(frame_labels,expand)
+                    prev_labels = sk.segmentation.expand_labels(prev_labels,expand)
 
             # Add frames left to check if len(track) + frames_left < min_frames
             remove_indices = []
@@ -625,6 +1154,8 @@ def track_position_pyama(pos: int, pos_path: pathlib.Path, expand: int) -> None:
             for index, row in unmatched_rows.iterrows():
                 tracks.append([row])
 
+        metrics.progress(frame_number + 1, message=f"Frame {frame}")
+
     data.close()
 
     result_data = []
@@ -644,13 +1175,20 @@ def track_position_pyama(pos: int, pos_path: pathlib.Path, expand: int) -> None:
         particle_id += 1
 
     tracks = pd.DataFrame(result_data)
-
-    # Find large particles and disable
-    large_particles = tracks[tracks['area'] > 10000]['particle'].unique()
-    tracks.loc[np.isin(tracks['particle'], large_particles), 'enabled'] = False
-
-    tracks_path = pos_path.joinpath('tracks.csv')
-    tracks.to_csv(tracks_path.absolute())
+    metrics.count('particles', particle_id)
+
+    # Disable particles matched by the default rules (e.g. too large)
+    with metrics.timer('summary'):
+        summary = track_summary(tracks, width, height)
+        rejected = summary.index.values[curation_mask(summary, DEFAULT_CURATION_RULES)]
+        tracks.loc[np.isin(tracks['particle'], rejected), 'enabled'] = False
+
+    # Particle ids changed, edits made on the previous tracks no longer apply
+    with metrics.timer('csv_write'), tracks_lock(pos_path):
+        discard_tracks_journal(pos_path)
+        write_tracks(pos_path, tracks)
+        write_track_summary(pos_path, summary)
+    metrics.write()
     print("Done")
 
 
@@ -692,7 +1230,7 @@ def pyama_segmentation(img: np.ndarray) -> np.ndarray:
     # convert binary mask to labels (1,2,3,...)
     return sk.measure.label(binary_segmentation, connectivity=1)
 
-def segment_positions(nd2_path: str, out_dir: str, pos: list, seg_channel: int, fl_channels: list, frame_min: int = None, frame_max: int = None, bg_corr: bool = True) -> None:
+def segment_positions(nd2_path: str, out_dir: str, pos: list, seg_channel: int, fl_channels: list, frame_min: int = None, frame_max: int = None, bg_corr: bool = True, chunk_size: int = None, force: bool = False, tile_size: int = None) -> None:
     """
     Segment positions from an ND2 file
 
@@ -705,6 +1243,13 @@ def segment_positions(nd2_path: str, out_dir: str, pos: list, seg_channel: int,
     frame_min (int): Minimum frame number
     frame_max (int): Maximum frame number
     bg_corr (bool): Whether to perform background correction
+    chunk_size (int): Side length of the square HDF5 chunks for 'labels' and 'fluorescence'.
+        None stores one chunk per frame. Tiles (e.g. 256) let the viewer read crops without decompressing whole frames.
+    force (bool): Segment positions whose ND2 file and parameters are unchanged since the last segmentation
+    tile_size (int): Segment frames in tiles of this side length in parallel (see tiled_segmentation.py), for
+        frames too large to segment at once. The labels are the same. None segments whole frames.
+        Only binarization, labeling and outlines are tiled, background correction, features and the
+        label index use whole frames; tiled_segmentation.py gives the resulting memory per pixel.
 
     Returns:
     None
@@ -716,6 +1261,9 @@ def segment_positions(nd2_path: str, out_dir: str, pos: list, seg_channel: int,
     fl_channels = list(set(fl_channels))
     pos = list(set(pos)) # remove duplicates
 
+    if tile_size:
+        from tiled_segmentation import binarize_frame_tiled, label_frame_tiled, label_outlines_tiled
+
     nd2 = ND2Reader(nd2_path)
 
     if seg_channel < 0 or seg_channel > len(nd2.metadata['channels']) - 1:
@@ -779,6 +1327,11 @@ def segment_positions(nd2_path: str, out_dir: str, pos: list, seg_channel: int,
 
     width, height, num_frames = nd2.metadata['width'], nd2.metadata['height'], len(frames)
 
+    if chunk_size:
+        chunk_shape = (min(chunk_size, height), min(chunk_size, width))
+    else:
+        chunk_shape = (height, width)
+
     print('Segmentation Channel: ' + nd2.metadata['channels'][seg_channel])
     print('Fluorescence Channels: ' + ', '.join(fl_channel_names))
 
@@ -787,14 +1340,26 @@ def segment_positions(nd2_path: str, out_dir: str, pos: list, seg_channel: int,
         pos_dir = pathlib.Path(out_dir).joinpath(f'XY{str(pos).zfill(padding)}')
         pos_dir.mkdir(parents=True, exist_ok=True)
 
+        params = {'seg_channel': seg_channel, 'fl_channels': fl_channels, 'frame_min': frame_min, 'frame_max': frame_max,
+                  'bg_corr': bg_corr, 'chunk_size': chunk_size}
+        if not force and step_is_current(pos_dir, 'segmentation', params, [nd2_path]):
+            print(f"Position {pos}: Segmentation is up to date")
+            continue
+
+        metrics = StageMetrics('segmentation', pos, pos_dir)
+        metrics.start_progress(num_frames)
+
         file_path = pos_dir.joinpath('data.h5')
 
         feature_keys = ['x', 'y'] + [f'brightness_{i}' for i in range(len(fl_channels))] + ['area', 'frame', 'label', 'bbox_x1', 'bbox_x2', 'bbox_y1', 'bbox_y2']
         feature_data = {key: [] for key in feature_keys}
 
         with h5py.File(file_path.absolute(), "w") as file_handle:
-            data_labels = file_handle.create_dataset('labels', (num_frames, height, width), dtype=np.uint16, chunks=(1, height, width))
-            data_fl = file_handle.create_dataset('fluorescence', (num_frames, len(fl_channels), height, width), dtype=np.float64, chunks=(1, 1, height, width))
+            data_labels = file_handle.create_dataset('labels', (num_frames, height, width), dtype=np.uint16, chunks=(1,) + chunk_shape)
+            data_outlines = file_handle.create_dataset('outlines', (num_frames, height, width), dtype=np.uint16, chunks=(1,) + chunk_shape)
+            data_fl = file_handle.create_dataset('fluorescence', (num_frames, len(fl_channels), height, width), dtype=np.float64, chunks=(1, 1) + chunk_shape)
+            # Row runs of every cell, for reading single cells without whole frames (see label_index.py)
+            label_index = LabelIndexWriter(file_handle, num_frames)
 
             file_handle.attrs['frame_min'] = frame_min
             file_handle.attrs['frame_max'] = frame_max
@@ -806,49 +1371,74 @@ def segment_positions(nd2_path: str, out_dir: str, pos: list, seg_channel: int,
             file_handle.attrs['pixel_microns'] = nd2.metadata['pixel_microns']
 
             for index, frame in enumerate(frames):
-                frame_image = nd2.get_frame_2D(t=frame, c=seg_channel, v=pos)
-                binary_segmentation = binarize_frame(frame_image)
-
-                sk.morphology.remove_small_objects(binary_segmentation, min_size=1000, out=binary_segmentation)
-                label_segmentation = sk.measure.label(binary_segmentation, connectivity=1)
+                with metrics.timer('nd2_read'):
+                    frame_image = nd2.get_frame_2D(t=frame, c=seg_channel, v=pos)
+                if tile_size:
+                    with metrics.timer('binarize'):
+                        binary_segmentation = binarize_frame_tiled(frame_image, tile_size=tile_size)
+                    with metrics.timer('label'):
+                        label_segmentation = label_frame_tiled(binary_segmentation, 1000, tile_size=tile_size)
+                else:
+                    with metrics.timer('binarize'):
+                        binary_segmentation = binarize_frame(frame_image)
+
+                    with metrics.timer('label'):
+                        sk.morphology.remove_small_objects(binary_segmentation, min_size=1000, out=binary_segmentation)
+                        label_segmentation = sk.measure.label(binary_segmentation, connectivity=1)
 
                 frame_fl_images = []
                 for c in fl_channels:
-                    frame_fl_image = nd2.get_frame_2D(t=frame, c=c, v=pos)
+                    with metrics.timer('nd2_read'):
+                        frame_fl_image = nd2.get_frame_2D(t=frame, c=c, v=pos)
                     if bg_corr:
-                        frame_fl_image = background_correction(frame_fl_image, label_segmentation, 5, 5, 0.5)
+                        with metrics.timer('background_correction'):
+                            frame_fl_image = background_correction(frame_fl_image, label_segmentation, 5, 5, 0.5)
                     frame_fl_images.append(frame_fl_image)
 
-                props = sk.measure.regionprops(label_segmentation)
-                print(f"Frame {frame}: {len(props)} features")
-
-                for prop in props:
-                    if prop.bbox[0] == 0 or prop.bbox[1] == 0 or prop.bbox[2] == height or prop.bbox[3] == width:
-                        label_segmentation[label_segmentation == prop.label] = 0
-                        continue
-
-                    x, y = prop.centroid
-                    feature_data['x'].append(x)
-                    feature_data['y'].append(y)
-
+                with metrics.timer('features'):
+                    props = sk.measure.regionprops(label_segmentation)
+
+                    for prop in props:
+                        if prop.bbox[0] == 0 or prop.bbox[1] == 0 or prop.bbox[2] == height or prop.bbox[3] == width:
+                            label_segmentation[label_segmentation == prop.label] = 0
+                            continue
+
+                        x, y = prop.centroid
+                        feature_data['x'].append(x)
+                        feature_data['y'].append(y)
+
+                        for i, fl_image in enumerate(frame_fl_images):
+                            feature_data[f'brightness_{i}'].append(fl_image[tuple(prop.coords.T)].sum())
+
+                        feature_data['area'].append(prop.area)
+                        feature_data['frame'].append(frame)
+                        feature_data['label'].append(prop.label)
+                        feature_data['bbox_x1'].append(prop.bbox[0])
+                        feature_data['bbox_y1'].append(prop.bbox[1])
+                        feature_data['bbox_x2'].append(prop.bbox[2] - 1)
+                        feature_data['bbox_y2'].append(prop.bbox[3] - 1)
+
+                with metrics.timer('outlines'):
+                    if tile_size:
+                        outlines = label_outlines_tiled(label_segmentation.astype(np.uint16), tile_size=tile_size)
+                    else:
+                        outlines = label_outlines(label_segmentation.astype(np.uint16))
+                with metrics.timer('hdf5_write'):
+                    data_labels[index, :, :] = label_segmentation
+                    data_outlines[index, :, :] = outlines
+                    label_index.append(index, label_segmentation)
                     for i, fl_image in enumerate(frame_fl_images):
-                        feature_data[f'brightness_{i}'].append(fl_image[tuple(prop.coords.T)].sum())
-
-                    feature_data['area'].append(prop.area)
-                    feature_data['frame'].append(frame)
-                    feature_data['label'].append(prop.label)
-                    feature_data['bbox_x1'].append(prop.bbox[0])
-                    feature_data['bbox_y1'].append(prop.bbox[1])
-                    feature_data['bbox_x2'].append(prop.bbox[2] - 1)
-                    feature_data['bbox_y2'].append(prop.bbox[3] - 1)
+                        data_fl[index, i, :, :] = fl_image
 
-                data_labels[index, :, :] = label_segmentation
-                for i, fl_image in enumerate(frame_fl_images):
-                    data_fl[index, i, :, :] = fl_image
+                metrics.progress(index + 1, message=f"Frame {frame}: {len(props)} features")
 
         features_path = pos_dir.joinpath('features.csv')
         features = pd.DataFrame(feature_data)
-        features.to_csv(features_path.absolute())
+        metrics.count('features', len(features))
+        with metrics.timer('csv_write'):
+            features.to_csv(features_path.absolute())
+        metrics.write()
+        record_step(pos_dir, 'segmentation', params, [nd2_path])
 
     print("Done")
 
@@ -0,0 +1,262 @@
+import base64
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import skimage as sk
+
+import pyama_util
+
+# Parameters of segment_positions: objects smaller than MIN_SIZE pixels of the full resolution
+# frame are removed, THRESHOLD and MASK_SIZE are those of binarize_frame
+MIN_SIZE = 1000
+THRESHOLD = 3
+MASK_SIZE = 3
+# Percentiles of the cell areas reported by a sweep
+AREA_PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def downsample(image, scale):
+    """
+    Mean of scale x scale pixel blocks, rows and columns that do not fill a block are dropped
+
+    Parameters:
+    image (np.ndarray): Frame
+    scale (int): Block side length
+
+    Returns:
+    np.ndarray: Downsampled frame as float64
+    """
+    height, width = image.shape[0] // scale * scale, image.shape[1] // scale * scale
+    return image[:height, :width].reshape(height // scale, scale, width // scale, scale).mean(axis=(1, 3))
+
+
+def scaled_min_size(min_size, scale):
+    # Minimum object size in pixels of a frame downsampled by scale
+    return max(1, round(min_size / scale**2))
+
+
+def cell_areas(labels):
+    """
+    Areas of the labels that do not touch the frame border, the cells kept by segment_positions
+
+    Parameters:
+    labels (np.ndarray): Label image
+
+    Returns:
+    np.ndarray: Areas in pixels, in label order
+    """
+    areas = np.bincount(labels.ravel())
+    border = np.unique(np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]]))
+    areas[border] = 0
+    areas[0] = 0
+    return areas[areas > 0]
+
+
+class SegmentationPreview:
+    """
+    Segmentation of single frames for checking the parameters of a new experiment, without running
+    segment_positions over the position. Frames read from the ND2 file, their std-log maps, the cell
+    areas of every threshold and finished previews are kept, least recently used first out, so
+    looking at the same frame again or sweeping more parameters over it is quick.
+    """
+
+    def __init__(self, max_frames=8, max_previews=32, max_std_logs=8, max_areas=1024):
+        self.max_frames = max_frames
+        self.max_previews = max_previews
+        self.max_std_logs = max_std_logs
+        self.max_areas = max_areas
+        self.frames = OrderedDict()
+        self.previews = OrderedDict()
+        self.std_logs = OrderedDict()
+        self.areas = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get(self, cache, key):
+        with self.lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+            return value
+
+    def _put(self, cache, key, value, limit):
+        with self.lock:
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > limit:
+                cache.popitem(last=False)
+
+    def frame(self, read_frame, key, scale):
+        """
+        Frame read with read_frame() and downsampled by scale, cached under key and scale
+        """
+        frame = self._get(self.frames, (key, scale))
+        if frame is not None:
+            return frame
+        full = self._get(self.frames, (key, 1))
+        if full is None:
+            full = np.asarray(read_frame())
+            self._put(self.frames, (key, 1), full, self.max_frames)
+        if scale == 1:
+            return full
+        frame = downsample(full, scale)
+        self._put(self.frames, (key, scale), frame, self.max_frames)
+        return frame
+
+    def std_log(self, read_frame, key, scale, mask_size):
+        """
+        std_log_map of the frame and the position and width of its background peak, the part of
+        binarize_frame shared by all thresholds
+
+        Returns:
+        tuple: (std-log map, histogram mode, background standard deviation)
+        """
+        cached = self._get(self.std_logs, (key, scale, mask_size))
+        if cached is not None:
+            return cached
+        std_log = pyama_util.std_log_map(self.frame(read_frame, key, scale), mask_size)
+        cached = (std_log,) + pyama_util.std_log_background(std_log)
+        self._put(self.std_logs, (key, scale, mask_size), cached, self.max_std_logs)
+        return cached
+
+    def binarize(self, read_frame, key, scale, mask_size, threshold, std_log=None):
+        """
+        binarize_frame(frame, mask_size, threshold) from the std-log map, std_log is the result of
+        the std_log method if the caller holds it already
+        """
+        std_log, hist_max, sigma = std_log or self.std_log(read_frame, key, scale, mask_size)
+        return pyama_util.clean_binary(std_log >= hist_max + threshold * sigma)
+
+    def cell_areas(self, read_frame, key, scale, mask_size, threshold, std_log=None):
+        """
+        Areas of all cells of the frame in full resolution pixels, before small objects are removed.
+        Removing objects smaller than min_size leaves the others unchanged, so every minimum size
+        is a cut of these areas.
+        """
+        areas = self._get(self.areas, (key, scale, mask_size, threshold))
+        if areas is not None:
+            return areas
+        binary = self.binarize(read_frame, key, scale, mask_size, threshold, std_log)
+        areas = cell_areas(sk.measure.label(binary, connectivity=1)) * scale**2
+        self._put(self.areas, (key, scale, mask_size, threshold), areas, self.max_areas)
+        return areas
+
+    def preview(self, read_frame, key, scale=1, mask_size=MASK_SIZE, threshold=THRESHOLD, min_size=MIN_SIZE):
+        """
+        Segment a frame as segment_positions does
+
+        Parameters:
+        read_frame (callable): Returns the frame of the segmentation channel
+        key (tuple): Identifies the frame, e.g. (nd2 path, position, frame, channel)
+        scale (int): Downsampling factor, previews of large frames are faster but coarser
+        mask_size (int): Side length of the std filter window of binarize_frame
+        threshold (float): Threshold of binarize_frame in background standard deviations
+        min_size (int): Objects smaller than this many full resolution pixels are removed
+
+        Returns:
+        dict: Cell count, mean cell area in full resolution pixels, seconds taken, whether the
+        preview was cached, and the frame with the label outlines as a base64 JPEG
+        """
+        preview_key = (key, scale, mask_size, threshold, min_size)
+        cached = self._get(self.previews, preview_key)
+        if cached is not None:
+            return dict(cached, cached=True, seconds=0.0)
+
+        start = time.perf_counter()
+        frame = self.frame(read_frame, key, scale)
+        labels = sk.measure.label(self.binarize(read_frame, key, scale, mask_size, threshold), connectivity=1)
+        # Small objects and cells cut by the frame border are dropped, as in segment_positions
+        areas = np.bincount(labels.ravel())
+        dropped = areas < scaled_min_size(min_size, scale)
+        dropped[np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]])] = True
+        dropped[0] = True
+        labels[dropped[labels]] = 0
+        areas = areas[~dropped] * scale**2
+        count = int(areas.size)
+
+        result = {
+            'count': count,
+            'mean_area': float(areas.mean()) if count else 0.0,
+            'width': int(frame.shape[1]),
+            'height': int(frame.shape[0]),
+            'image': base64.b64encode(self.render(frame, labels)).decode('ascii'),
+        }
+        self._put(self.previews, preview_key, result, self.max_previews)
+        return dict(result, cached=False, seconds=time.perf_counter() - start)
+
+    def sweep(self, read_frames, scale=1, mask_sizes=(MASK_SIZE,), thresholds=(THRESHOLD,), min_sizes=(MIN_SIZE,),
+              workers=None):
+        """
+        Segment frames with every combination of binarize_frame parameters and minimum object size.
+        The std-log map and its histogram are computed once per frame and mask size, the thresholded
+        mask and its labels once per threshold, the minimum sizes only filter the cell areas.
+        Frames are processed in parallel.
+
+        Parameters:
+        read_frames (dict): Frame key -> callable returning the frame, see preview
+        scale (int): Downsampling factor
+        mask_sizes (list): Std filter window side lengths
+        thresholds (list): Thresholds in background standard deviations
+        min_sizes (list): Minimum object sizes in full resolution pixels
+        workers (int): Threads, the number of CPUs by default
+
+        Returns:
+        dict: 'settings', one entry per parameter combination with the cell count per frame, the
+        total count, the mean area and the AREA_PERCENTILES of the areas over all frames, and 'seconds'
+        """
+        start = time.perf_counter()
+
+        def frame_areas(item):
+            key, read_frame = item
+            areas = {}
+            for mask_size in mask_sizes:
+                # Held by the task for all thresholds, the std_logs cache has fewer entries than a
+                # sweep may have frames and would evict it while other frames run
+                std_log = None
+                for threshold in thresholds:
+                    if std_log is None and self._get(self.areas, (key, scale, mask_size, threshold)) is None:
+                        std_log = self.std_log(read_frame, key, scale, mask_size)
+                    areas[mask_size, threshold] = self.cell_areas(read_frame, key, scale, mask_size, threshold,
+                                                                  std_log)
+            return areas
+
+        with ThreadPoolExecutor(workers or min(len(read_frames), os.cpu_count())) as pool:
+            areas = list(pool.map(frame_areas, read_frames.items()))
+
+        settings = []
+        for mask_size in mask_sizes:
+            for threshold in thresholds:
+                for min_size in min_sizes:
+                    # Areas are compared in downsampled pixels, as in preview
+                    limit = scaled_min_size(min_size, scale) * scale**2
+                    kept = [frame[(mask_size, threshold)] for frame in areas]
+                    kept = [values[values >= limit] for values in kept]
+                    every = np.concatenate(kept)
+                    settings.append({
+                        'mask_size': mask_size,
+                        'threshold': threshold,
+                        'min_size': min_size,
+                        'counts': [int(values.size) for values in kept],
+                        'count': int(every.size),
+                        'mean_area': float(every.mean()) if every.size else 0.0,
+                        'area_percentiles': ([float(value) for value in np.percentile(every, AREA_PERCENTILES)]
+                                             if every.size else []),
+                    })
+        return {'settings': settings, 'seconds': time.perf_counter() - start}
+
+    @staticmethod
+    def render(frame, labels):
+        """JPEG of the frame, contrast stretched between the 1st and 99.5th percentile, with red label outlines"""
+        lower, upper = np.percentile(frame, (1, 99.5))
+        gray = np.clip((frame - lower) * (255 / max(upper - lower, 1e-9)), 0, 255).astype(np.uint8)
+        image = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+        image[pyama_util.label_outlines(labels.astype(np.uint16)) > 0] = (0, 0, 255)
+        _, encoded = cv2.imencode('.jpg', image)
+        return encoded.tobytes()
+
+
+preview_cache = SegmentationPreview()
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import pathlib
+
+from pipeline_metrics import metadata_lock, write_json_atomic
+
+# Per-position record of the pipeline steps run, next to data.h5
+MANIFEST_FILE = 'manifest.json'
+
+# Enable edits not yet folded into tracks.csv, read along with it (see pyama_util.read_tracks)
+TRACKS_JOURNAL_FILES = ['tracks_journal.csv', 'tracks_journal.compacting.csv']
+# Files of the position folder each step reads, the ND2 file of segmentation is passed separately
+STEP_INPUTS = {
+    'segmentation': [],
+    'tracking': ['features.csv', 'data.h5'],
+    'square_rois': ['tracks.csv', 'data.h5'] + TRACKS_JOURNAL_FILES,
+    'export': ['tracks.csv', 'data.h5'] + TRACKS_JOURNAL_FILES,
+}
+# Files a step produces, a step whose outputs are missing is never up to date
+STEP_OUTPUTS = {
+    'segmentation': ['data.h5', 'features.csv'],
+    'tracking': ['tracks.csv'],
+    'square_rois': ['tracks.csv'],
+    'export': ['output.xlsx'],
+}
+
+# Modules the pipeline steps run, next to this file
+PIPELINE_MODULES = ['pyama_util.py', 'tiled_segmentation.py', 'label_index.py', 'pipeline_metrics.py',
+                    'stage_manifest.py']
+
+_code_version = None
+
+
+def code_version():
+    """
+    Hash of the pipeline code, results of other code versions are not reused
+    """
+    global _code_version
+    if _code_version is None:
+        digest = hashlib.sha256()
+        for name in PIPELINE_MODULES:
+            digest.update(pathlib.Path(__file__).with_name(name).read_bytes())
+        _code_version = digest.hexdigest()[:16]
+    return _code_version
+
+
+def file_fingerprint(path):
+    """
+    Size and modification time of a file, None if it does not exist
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _jsonable(params):
+    # Parameters as they read back from the manifest (numpy scalars, tuples)
+    return json.loads(json.dumps(params, default=lambda o: o.item() if hasattr(o, 'item') else str(o)))
+
+
+def step_record(pos_path, step, params, extra_inputs=()):
+    """
+    What a run of the step depends on: parameters, code version and the fingerprints of its inputs
+
+    Parameters:
+    pos_path (pathlib.Path): Path to position directory
+    step (str): Pipeline step, one of STEP_INPUTS
+    params (dict): Parameters of the step that change its results
+    extra_inputs (list): Input files outside the position folder, e.g. the ND2 file
+
+    Returns:
+    dict: The record
+    """
+    pos_path = pathlib.Path(pos_path)
+    inputs = {name: file_fingerprint(pos_path.joinpath(name)) for name in STEP_INPUTS[step]}
+    for path in extra_inputs:
+        inputs[str(path)] = file_fingerprint(path)
+    return {'params': _jsonable(params), 'code': code_version(), 'inputs': inputs}
+
+
+def read_manifest(pos_path):
+    path = pathlib.Path(pos_path).joinpath(MANIFEST_FILE)
+    if not path.is_file():
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def step_is_current(pos_path, step, params, extra_inputs=()):
+    """
+    Whether the last run of the step used the same parameters, code and inputs, so running it again
+    would produce the same results
+
+    Parameters:
+    pos_path (pathlib.Path): Path to position directory
+    step (str): Pipeline step
+    params (dict): Parameters of the step that change its results
+    extra_inputs (list): Input files outside the position folder
+
+    Returns:
+    bool: True if the step can be skipped
+    """
+    pos_path = pathlib.Path(pos_path)
+    if not all(pos_path.joinpath(name).is_file() for name in STEP_OUTPUTS[step]):
+        return False
+    return read_manifest(pos_path).get(step) == step_record(pos_path, step, params, extra_inputs)
+
+
+def record_step(pos_path, step, params, extra_inputs=()):
+    """
+    Store the record of a finished step. Inputs are fingerprinted after the run, steps that rewrite
+    their input (square ROIs add columns to tracks.csv) then match the file they left behind.
+
+    Parameters:
+    pos_path (pathlib.Path): Path to position directory
+    step (str): Pipeline step
+    params (dict): Parameters of the step that change its results
+    extra_inputs (list): Input files outside the position folder
+    """
+    pos_path = pathlib.Path(pos_path)
+    record = step_record(pos_path, step, params, extra_inputs)
+    # Steps of a position may finish at the same time in the pipeline's step processes
+    with metadata_lock(pos_path):
+        manifest = read_manifest(pos_path)
+        manifest[step] = record
+        write_json_atomic(pos_path.joinpath(MANIFEST_FILE), manifest)
@@ -0,0 +1,346 @@
+"""
+Tiled segmentation of frames too large to process at once, e.g. stitched large-area scans.
+
+The float64 work of binarize_frame runs on overlapping tiles in parallel. Tiles carry a halo
+wide enough for the local filters, so their cores match the whole-frame result. The histogram
+threshold is computed from per-tile histograms over the global value range; the background
+width is summed per tile instead of by np.std over the frame, so it can differ in the last bits
+and a pixel lying exactly at the cutoff could come out differently (core/tests.py compares the
+labels on a synthetic frame with seams through cells and holes). Hole filling,
+small object removal and labeling are connected-component operations: components are found per
+tile and merged across the tile seams. Labels are numbered in raster order as skimage does, so
+the labels equal those of pyama_segmentation.
+
+Binarization, labeling and label_outlines keep a few tiles of temporaries, the full frame is only
+held as booleans, as the int32 label image and as the uint16 outlines. The std-log map goes to a
+temporary file between passes.
+
+The other passes of segment_positions still run on whole frames: background correction,
+regionprops features and the label index runs. Per pixel, a tiled segment_positions frame holds
+about 11 + 2F bytes for F fluorescence channels (uint16 frame, mask, int32 and uint16 labels,
+outlines, uint16 fluorescence frames) plus 8 bytes while a fluorescence frame is converted for
+writing. With background correction the fluorescence frames are float64 (11 + 8F bytes) and the
+spline background model needs about 32 bytes more while a channel is corrected.
+"""
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.ndimage as smg
+
+from pyama_util import OUTLINE_KERNEL, STRUCT3, STRUCT5, label_outlines, std_log_map
+
+# Cross shaped structure, the 4-connectivity of binary_fill_holes, remove_small_objects and
+# sk.measure.label(connectivity=1)
+CROSS = smg.generate_binary_structure(2, 1)
+# Halo of the morphology after hole filling: opening with two erosions and two dilations by
+# STRUCT5 (radius 2 each), then an erosion by CROSS (radius 1)
+MORPHOLOGY_HALO = 9
+# Radius of the outline neighbourhood of label_outlines
+OUTLINE_HALO = OUTLINE_KERNEL.shape[0] // 2
+
+
+def tile_grid(height, width, tile_size):
+    """
+    Tiles covering a frame
+
+    Parameters:
+    height (int): Frame height
+    width (int): Frame width
+    tile_size (int): Side length of the tiles, the last row and column may be smaller
+
+    Returns:
+    list: Tiles as (y0, y1, x0, x1), in rows of tiles
+    """
+    return [(y0, min(y0 + tile_size, height), x0, min(x0 + tile_size, width))
+            for y0 in range(0, height, tile_size) for x0 in range(0, width, tile_size)]
+
+
+def _with_halo(tile, halo, height, width):
+    # Tile grown by halo pixels, clipped to the frame, and the slices of the tile within it
+    y0, y1, x0, x1 = tile
+    hy0, hy1, hx0, hx1 = max(0, y0 - halo), min(height, y1 + halo), max(0, x0 - halo), min(width, x1 + halo)
+    return (slice(hy0, hy1), slice(hx0, hx1)), (slice(y0 - hy0, y1 - hy0), slice(x0 - hx0, x1 - hx0))
+
+
+def _tiled_local(func, image, out, tiles, halo, pool):
+    """Apply a local operation of radius halo tile by tile, func maps an image to one of the same shape"""
+    height, width = image.shape
+
+    def run(tile):
+        outer, inner = _with_halo(tile, halo, height, width)
+        y0, y1, x0, x1 = tile
+        out[y0:y1, x0:x1] = func(image[outer])[inner]
+
+    list(pool.map(run, tiles))
+    return out
+
+
+def binarize_frame_tiled(img, mask_size=3, tile_size=1024, workers=None, threshold=3):
+    """
+    binarize_frame on overlapping tiles processed in parallel
+
+    Parameters:
+    img (np.ndarray): The image to be binarized
+    mask_size (int): Side length of the std filter window, see binarize_frame
+    tile_size (int): Side length of the tiles
+    workers (int): Threads, the number of CPUs by default
+    threshold (float): Threshold in background standard deviations, see binarize_frame
+
+    Returns:
+    np.ndarray: Binarized image of frame, equal to binarize_frame(img, mask_size, threshold)
+    """
+    height, width = img.shape
+    tiles = tile_grid(height, width, tile_size)
+    with ThreadPoolExecutor(workers or os.cpu_count()) as pool, tempfile.TemporaryFile() as tmp:
+        std_log = np.memmap(tmp, dtype=np.float64, mode='w+', shape=(height, width))
+
+        # Logarithmic standard deviation at each pixel, windows reach mask_size // 2 into the halo
+        _tiled_local(lambda image: std_log_map(image, mask_size), img, std_log, tiles, mask_size // 2, pool)
+
+        # Histogram over the value range of the whole frame, the bins are those of np.histogram(std_log)
+        def tile_range(tile):
+            y0, y1, x0, x1 = tile
+            values = std_log[y0:y1, x0:x1]
+            return values.min(), values.max()
+
+        ranges = list(pool.map(tile_range, tiles))
+        value_range = (min(r[0] for r in ranges), max(r[1] for r in ranges))
+
+        def tile_histogram(tile):
+            y0, y1, x0, x1 = tile
+            return np.histogram(std_log[y0:y1, x0:x1], bins=200, range=value_range)
+
+        histograms = list(pool.map(tile_histogram, tiles))
+        counts = np.sum([h[0] for h in histograms], axis=0)
+        edges = histograms[0][1]
+        bins = (edges[:-1] + edges[1:]) / 2
+        hist_max = bins[np.argmax(counts)]
+
+        # Standard deviation of the values up to the histogram mode, two passes like np.std
+        def tile_sum(tile):
+            y0, y1, x0, x1 = tile
+            values = std_log[y0:y1, x0:x1]
+            values = values[values <= hist_max]
+            return values.size, values.sum()
+
+        sums = list(pool.map(tile_sum, tiles))
+        n = sum(s[0] for s in sums)
+        mean = sum(s[1] for s in sums) / n
+
+        def tile_squares(tile):
+            y0, y1, x0, x1 = tile
+            values = std_log[y0:y1, x0:x1]
+            return np.sum((values[values <= hist_max] - mean) ** 2)
+
+        sigma = np.sqrt(sum(pool.map(tile_squares, tiles)) / n)
+        cutoff = hist_max + threshold * sigma
+
+        img_bin = np.empty((height, width), dtype=bool)
+        _tiled_local(lambda values: smg.binary_dilation(values >= cutoff, structure=STRUCT3),
+                     std_log, img_bin, tiles, 1, pool)
+        del std_log
+
+        img_bin = fill_holes_tiled(img_bin, tiles, pool)
+
+        def remove_noise(mask):
+            mask = mask & smg.binary_opening(mask, iterations=2, structure=STRUCT5)
+            return smg.binary_erosion(mask, border_value=1)
+
+        return _tiled_local(remove_noise, img_bin, np.empty_like(img_bin), tiles, MORPHOLOGY_HALO, pool)
+
+
+class _TiledComponents:
+    """
+    Connected components (4-connectivity) of a boolean frame, found per tile and merged across
+    the seams between tiles. Component ids are tile offset + label within the tile.
+    """
+
+    def __init__(self, mask, tiles, pool):
+        self.mask = mask
+        self.tiles = tiles
+        height, width = mask.shape
+        results = list(pool.map(self._scan, tiles))
+        self.offsets = np.cumsum([0] + [r['count'] for r in results])
+        total = int(self.offsets[-1])
+
+        # Component sizes, first pixel in raster order and whether it touches the frame border
+        self.sizes = np.zeros(total + 1, dtype=np.int64)
+        self.first = np.full(total + 1, height * width, dtype=np.int64)
+        self.border = np.zeros(total + 1, dtype=bool)
+        for offset, r in zip(self.offsets, results):
+            ids = np.arange(1, r['count'] + 1) + offset
+            self.sizes[ids] = r['sizes']
+            self.first[ids] = r['first']
+            self.border[ids] = r['border']
+
+        # Merge components meeting at tile seams
+        parent = np.arange(total + 1)
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        # Tile index by the corner of the tile
+        index = {(tile[0], tile[2]): i for i, tile in enumerate(tiles)}
+        for i, (y0, y1, x0, x1) in enumerate(tiles):
+            for corner, mine, theirs in (((y1, x0), 'bottom', 'top'), ((y0, x1), 'right', 'left')):
+                j = index.get(corner)
+                if j is None:
+                    continue
+                a, b = results[i][mine], results[j][theirs]
+                touching = (a > 0) & (b > 0)
+                pairs = np.stack([a[touching] + self.offsets[i], b[touching] + self.offsets[j]], axis=1)
+                for u, v in np.unique(pairs, axis=0):
+                    ru, rv = find(u), find(v)
+                    if ru != rv:
+                        parent[max(ru, rv)] = min(ru, rv)
+        # Point every component at its root
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        self.roots = parent
+
+        # Attributes of the merged components, indexed by root
+        self.root_sizes = np.bincount(self.roots, weights=self.sizes, minlength=total + 1).astype(np.int64)
+        self.root_first = np.full(total + 1, height * width, dtype=np.int64)
+        np.minimum.at(self.root_first, self.roots, self.first)
+        self.root_border = np.zeros(total + 1, dtype=bool)
+        np.logical_or.at(self.root_border, self.roots, self.border)
+
+    def label_tile(self, tile):
+        y0, y1, x0, x1 = tile
+        labels, count = smg.label(self.mask[y0:y1, x0:x1], structure=CROSS)
+        return labels, count
+
+    def _scan(self, tile):
+        y0, y1, x0, x1 = tile
+        height, width = self.mask.shape
+        labels, count = self.label_tile(tile)
+        ids, first = np.unique(labels.ravel(), return_index=True)
+        # First pixel of every label in frame raster order, label 0 sorts first
+        first_global = (y0 + first // (x1 - x0)) * width + x0 + first % (x1 - x0)
+        border = np.zeros(count + 1, dtype=bool)
+        for edge, at_border in ((labels[0], y0 == 0), (labels[-1], y1 == height),
+                                (labels[:, 0], x0 == 0), (labels[:, -1], x1 == width)):
+            if at_border:
+                border[edge] = True
+        return {
+            'count': count,
+            'sizes': np.bincount(labels.ravel(), minlength=count + 1)[1:],
+            'first': first_global[ids > 0],
+            'border': border[1:],
+            'top': labels[0].copy(), 'bottom': labels[-1].copy(),
+            'left': labels[:, 0].copy(), 'right': labels[:, -1].copy(),
+        }
+
+    def tile_ids(self, tile_index, labels):
+        """Merged component (root) of every pixel of a tile labeled by label_tile, 0 for background"""
+        offset = self.offsets[tile_index]
+        count = self.offsets[tile_index + 1] - offset
+        lut = np.zeros(count + 1, dtype=np.int64)
+        lut[1:] = self.roots[offset + 1:offset + count + 1]
+        return lut[labels]
+
+
+def fill_holes_tiled(mask, tiles, pool):
+    """
+    binary_fill_holes by tiles: background components not connected to the frame border are holes
+
+    Parameters:
+    mask (np.ndarray): Boolean frame
+    tiles (list): Tiles from tile_grid
+    pool (Executor): Runs the tiles
+
+    Returns:
+    np.ndarray: The mask with holes filled
+    """
+    background = _TiledComponents(~mask, tiles, pool)
+    hole = ~background.root_border
+    hole[0] = False
+    out = mask.copy()
+
+    def fill(item):
+        index, tile = item
+        y0, y1, x0, x1 = tile
+        labels, _ = background.label_tile(tile)
+        out[y0:y1, x0:x1] |= hole[background.tile_ids(index, labels)]
+
+    list(pool.map(fill, enumerate(tiles)))
+    return out
+
+
+def label_frame_tiled(mask, min_size=1000, tile_size=1024, workers=None):
+    """
+    remove_small_objects and sk.measure.label (connectivity=1) by tiles
+
+    Parameters:
+    mask (np.ndarray): Boolean frame
+    min_size (int): Smallest object size kept
+    tile_size (int): Side length of the tiles
+    workers (int): Threads, the number of CPUs by default
+
+    Returns:
+    np.ndarray: Labels numbered in raster order of their first pixel, as int32
+    """
+    tiles = tile_grid(*mask.shape, tile_size)
+    out = np.zeros(mask.shape, dtype=np.int32)
+    with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+        components = _TiledComponents(mask, tiles, pool)
+        # Final label of every root: kept components numbered by their first pixel
+        kept = np.flatnonzero((components.roots == np.arange(components.roots.size)) &
+                              (components.root_sizes >= min_size))
+        kept = kept[kept > 0]
+        kept = kept[np.argsort(components.root_first[kept], kind='stable')]
+        final = np.zeros(components.roots.size, dtype=np.int32)
+        final[kept] = np.arange(1, kept.size + 1)
+
+        def relabel(item):
+            index, tile = item
+            y0, y1, x0, x1 = tile
+            labels, _ = components.label_tile(tile)
+            out[y0:y1, x0:x1] = final[components.tile_ids(index, labels)]
+
+        list(pool.map(relabel, enumerate(tiles)))
+    return out
+
+
+def label_outlines_tiled(labels, tile_size=1024, workers=None):
+    """
+    label_outlines on overlapping tiles processed in parallel
+
+    Parameters:
+    labels (np.ndarray): Label image (uint16)
+    tile_size (int): Side length of the tiles
+    workers (int): Threads, the number of CPUs by default
+
+    Returns:
+    np.ndarray: Outlines, equal to label_outlines(labels)
+    """
+    tiles = tile_grid(*labels.shape, tile_size)
+    with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+        return _tiled_local(label_outlines, labels, np.empty_like(labels), tiles, OUTLINE_HALO, pool)
+
+
+def segment_frame_tiled(img, tile_size=1024, workers=None, min_size=1000, mask_size=3, threshold=3):
+    """
+    pyama_segmentation by tiles processed in parallel
+
+    Parameters:
+    img (np.ndarray): Input image
+    tile_size (int): Side length of the tiles
+    workers (int): Threads, the number of CPUs by default
+    min_size (int): Smallest object size kept
+    mask_size (int): Side length of the std filter window, see binarize_frame
+    threshold (float): Threshold in background standard deviations, see binarize_frame
+
+    Returns:
+    np.ndarray: Labeled segmentation of the image, equal to pyama_segmentation(img) for the default parameters
+    """
+    mask = binarize_frame_tiled(img, mask_size, tile_size=tile_size, workers=workers, threshold=threshold)
+    return label_frame_tiled(mask, min_size, tile_size=tile_size, workers=workers)
@@ -1,4 +1,5 @@
 import cv2
+import functools
 import numpy as np
 import tifffile
 from io import BytesIO
@@ -16,6 +17,42 @@ def read_tiff(file_path, channel=0):
 
     return tif_data
 
+@functools.lru_cache(maxsize=64)
+def uint16_to_uint8_lut(lower_bound, upper_bound):
+    '''
+    Lookup table mapping 16-bit values to 8-bit, cached per bounds.
+
+    Parameters
+    ----------
+    lower_bound: int
+        values up to `lower_bound` are mapped to 0
+    upper_bound: int
+        values from `upper_bound` on are mapped to 255
+
+    Returns
+    -------
+    numpy.ndarray[uint8]
+        read-only table with 65,536 entries
+    '''
+    if not(0 <= lower_bound < 2**16):
+        raise ValueError(
+            '"lower_bound" must be in the range [0, 65535]')
+    if not(0 <= upper_bound < 2**16):
+        raise ValueError(
+            '"upper_bound" must be in the range [0, 65535]')
+    if lower_bound >= upper_bound:
+        raise ValueError(
+            '"lower_bound" must be smaller than "upper_bound"')
+    lut = np.concatenate([
+        np.zeros(lower_bound, dtype=np.uint8),
+        np.linspace(0, 255, upper_bound - lower_bound).astype(np.uint8),
+        np.full(2**16 - upper_bound, 255, dtype=np.uint8)
+    ])
+    # Shared between callers through the cache, so it must not be modified
+    lut.flags.writeable = False
+    return lut
+
+
 def map_uint16_to_uint8(img, lower_bound=None, upper_bound=None):
     '''
     Map a 16-bit image trough a lookup table to convert it to 8-bit.
@@ -37,25 +74,12 @@ def map_uint16_to_uint8(img, lower_bound=None, upper_bound=None):
     -------
     numpy.ndarray[uint8]
     '''
-    if not(0 <= lower_bound < 2**16) and lower_bound is not None:
-        raise ValueError(
-            '"lower_bound" must be in the range [0, 65535]')
-    if not(0 <= upper_bound < 2**16) and upper_bound is not None:
-        raise ValueError(
-            '"upper_bound" must be in the range [0, 65535]')
     if lower_bound is None:
         lower_bound = np.min(img)
     if upper_bound is None:
         upper_bound = np.max(img)
-    if lower_bound >= upper_bound:
-        raise ValueError(
-            '"lower_bound" must be smaller than "upper_bound"')
-    lut = np.concatenate([
-        np.zeros(lower_bound, dtype=np.uint16),
-        np.linspace(0, 255, upper_bound - lower_bound).astype(np.uint16),
-        np.ones(2**16 - upper_bound, dtype=np.uint16) * 255
-    ])
-    return lut[img].astype(np.uint8)
+    lut = uint16_to_uint8_lut(int(lower_bound), int(upper_bound))
+    return np.take(lut, img)
 
 
 def get_channel_image(tiff_data, channel):
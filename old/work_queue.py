@@ -0,0 +1,225 @@
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+# Seconds without a heartbeat after which a claim is taken over by another worker
+STALE_AFTER = 600
+
+
+class Claim:
+    """
+    A task claimed by this worker. The claim file is touched in the background until the claim
+    is completed, failed or released, so other workers can tell it from the claim of a crashed one.
+    It is touched through its open descriptor, so the heartbeat reaches the file wherever another
+    worker checking for a stale claim has moved it.
+    """
+
+    def __init__(self, queue, task, path, fd):
+        self.queue = queue
+        self.task = task
+        self.path = path
+        self.fd = fd
+        self.inode = os.fstat(fd).st_ino
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self._beat, name=f'claim-{task}', daemon=True)
+        self.heartbeat.start()
+
+    def _beat(self):
+        while not self.stopped.wait(self.queue.stale_after / 4):
+            try:
+                os.utime(self.fd)
+            except OSError as e:
+                # E.g. a network filesystem hiccup, keep beating: a claim taken over meanwhile shows in owned()
+                print(f'Heartbeat of claim {self.task} failed: {e}')
+
+    def owned(self):
+        """
+        False if the claim file is gone or is another worker's claim. That only happens if the
+        heartbeat stalled for stale_after seconds, the task may then be running twice at the same time.
+        """
+        try:
+            return os.stat(self.path).st_ino == self.inode
+        except FileNotFoundError:
+            return False
+
+    def _finish(self, suffix, record):
+        self.stopped.set()
+        self.heartbeat.join()
+        if suffix is not None:
+            self.queue._write(self.queue.path(self.task, suffix), record)
+        # Never remove the claim of a worker that took the task over
+        if self.owned():
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        os.close(self.fd)
+
+    def complete(self, result=None):
+        self._finish('.done', {'owner': self.queue.owner, 'finished': time.time(), 'result': result})
+
+    def fail(self, message):
+        self._finish('.failed', {'owner': self.queue.owner, 'finished': time.time(), 'message': message})
+
+    def release(self):
+        self._finish(None, None)
+
+
+class WorkQueue:
+    """
+    Queue of named tasks shared by worker processes through a directory, e.g. on the network
+    filesystem of a cluster. No broker is involved:
+
+    - <task>.claim is created exclusively by the worker running the task and touched while it runs
+    - <task>.done or <task>.failed record the outcome
+    - claims not touched for stale_after seconds belong to crashed workers and are taken over
+
+    Every worker lists the same tasks and claims the ones that are neither finished nor claimed.
+    """
+
+    def __init__(self, directory, stale_after=STALE_AFTER, owner=None):
+        self.directory = directory
+        self.stale_after = stale_after
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}'
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, task, suffix):
+        return os.path.join(self.directory, task + suffix)
+
+    def _write(self, path, record):
+        # Written under a unique name and renamed, readers never see a partial file
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+
+    def state(self, task):
+        """'done', 'failed', 'claimed' or 'pending'"""
+        for state in ('done', 'failed'):
+            if os.path.exists(self.path(task, '.' + state)):
+                return state
+        return 'claimed' if os.path.exists(self.path(task, '.claim')) else 'pending'
+
+    def read(self, task, suffix):
+        try:
+            with open(self.path(task, suffix)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def claim(self, task, retry_failed=False):
+        """
+        Claim a task unless it is finished or claimed by a live worker
+
+        Parameters:
+        task (str): Task name, usable as a file name
+        retry_failed (bool): Also claim tasks that failed before
+
+        Returns:
+        Claim: The claim, None if the task is not available
+        """
+        state = self.state(task)
+        if state == 'done' or (state == 'failed' and not retry_failed):
+            return None
+        path = self.path(task, '.claim')
+        if state == 'claimed' and not self._take_over(path):
+            return None
+        try:
+            # Exclusive creation is atomic on local filesystems and NFSv3 and later
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        # Kept open by the claim for its heartbeat
+        os.write(fd, json.dumps({'owner': self.owner, 'claimed': time.time()}).encode())
+        # Finished by another worker between the check and the claim
+        finished = os.path.exists(self.path(task, '.done'))
+        if not finished and os.path.exists(self.path(task, '.failed')):
+            finished = not retry_failed
+            if retry_failed:
+                os.unlink(self.path(task, '.failed'))
+        if finished:
+            os.unlink(path)
+            os.close(fd)
+            return None
+        return Claim(self, task, path, fd)
+
+    def _take_over(self, path):
+        """Remove a stale claim, True if the task may be claimed now"""
+        try:
+            if time.time() - os.stat(path).st_mtime < self.stale_after:
+                return False
+        except FileNotFoundError:
+            return True
+        # A single rename to a name of this worker's own: of several workers noticing the stale
+        # claim only one moves it, and the file moved is the one checked below
+        stale_path = f'{path}.{uuid.uuid4().hex}.stale'
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return True
+        if time.time() - os.stat(stale_path).st_mtime < self.stale_after:
+            # Touched since the check, or a new claim made after another worker removed the stale
+            # one: its owner is alive. Linked back only if the task has not been claimed meanwhile,
+            # a link never replaces an existing claim as a rename would.
+            try:
+                os.link(stale_path, path)
+            except FileExistsError:
+                pass
+            os.unlink(stale_path)
+            return False
+        print(f'Taking over stale claim of {os.path.basename(path)}: {self._describe(stale_path)}')
+        os.unlink(stale_path)
+        return True
+
+    @staticmethod
+    def _describe(path):
+        try:
+            with open(path) as f:
+                return json.load(f).get('owner', 'unknown owner')
+        except (OSError, ValueError):
+            return 'unknown owner'
+
+    def run(self, tasks, handler, retry_failed=False, wait=True, poll_interval=30.0):
+        """
+        Run handler(task) for every task this worker claims, until all tasks are finished
+
+        Parameters:
+        tasks (list): Task names, in the order they are tried
+        handler (callable): Runs a task, its return value is stored in <task>.done, an exception marks it failed
+        retry_failed (bool): Run tasks that failed in an earlier run again
+        wait (bool): Wait for tasks claimed by other workers, to take them over if the workers crash
+        poll_interval (float): Seconds between passes while waiting
+
+        Returns:
+        dict: Task -> 'done' or 'failed' for the tasks run by this worker
+        """
+        outcomes = {}
+        retry = retry_failed
+        while True:
+            for task in tasks:
+                claim = self.claim(task, retry_failed=retry and task not in outcomes)
+                if claim is None:
+                    continue
+                try:
+                    result = handler(task)
+                except KeyboardInterrupt:
+                    claim.release()
+                    raise
+                except Exception:
+                    message = traceback.format_exc()
+                    print(message)
+                    claim.fail(message)
+                    outcomes[task] = 'failed'
+                else:
+                    claim.complete(result)
+                    outcomes[task] = 'done'
+            pending = [task for task in tasks if self.state(task) in ('claimed', 'pending')]
+            if not pending or not wait:
+                return outcomes
+            # Failed tasks are retried once per run, not again after every pass
+            retry = False
+            time.sleep(poll_interval)
@@ -9,17 +9,46 @@ let pendingUpdate = false;
 let debounceTimeout = null;
 const DEBOUNCE_DELAY = 300;
 
+// Current image address (position, channel, frame, crop, contrast, tracks revision)
+// as returned by the server. Images are fetched as plain GETs so the browser can cache them.
+const imageParamsElement = document.getElementById("image_params");
+let imageParams = imageParamsElement
+  ? JSON.parse(imageParamsElement.textContent)
+  : null;
+
 // Set up event listeners for slider changes
 positionSlider.addEventListener("input", debouncedUpdateImageAndPlot);
 channelSlider.addEventListener("input", updateImage);
 timeframeSlider.addEventListener("input", updateImage);
 particleSlider.addEventListener("input", debouncedUpdateImageAndPlot);
+// Move the selection highlight right away, the crop follows with the server response
+particleSlider.addEventListener("input", drawOutlines);
 const particleEnabledCheckbox = document.getElementById("particle_enabled");
 
 particleEnabledCheckbox.addEventListener("change", function () {
   updateParticleEnabled(this.checked);
 });
 
+const contrastLowerInput = document.getElementById("contrast_lower");
+const contrastUpperInput = document.getElementById("contrast_upper");
+if (contrastLowerInput && contrastUpperInput) {
+  contrastLowerInput.addEventListener("change", updateContrast);
+  contrastUpperInput.addEventListener("change", updateContrast);
+}
+
+/**
+ * Takes the image address of a server response but keeps the channel and frame
+ * of the sliders, a response to an older request must not move the image back
+ * @param {Object} params - image_params of the response
+ */
+function acceptImageParams(params) {
+  imageParams = {
+    ...params,
+    channel: parseInt(channelSlider.value),
+    frame: parseInt(timeframeSlider.value),
+  };
+}
+
 function debouncedUpdateImageAndPlot() {
   clearTimeout(debounceTimeout);
   debounceTimeout = setTimeout(() => {
@@ -35,6 +64,10 @@ function debouncedUpdateImageAndPlot() {
  * Updates both the image and brightness plot
  */
 function updateImageAndPlot() {
+  if (streamReady) {
+    streamNavigate();
+    return;
+  }
   if (updateInProgress) {
     pendingUpdate = true;
     return;
@@ -50,7 +83,7 @@ function updateImageAndPlot() {
     particle: document.getElementById("particle_slider").value,
   };
 
-  fetch("/update_image", {
+  fetch("/api/update_image/", {
     method: "POST",
     headers: {
       "Content-Type": "application/x-www-form-urlencoded",
@@ -59,7 +92,13 @@ function updateImageAndPlot() {
   })
     .then((response) => response.json())
     .then((data) => {
-      updateImageDisplay(data.channel_image);
+      // A newer update from this page overtook it on the server
+      if (data.superseded) {
+        return;
+      }
+      acceptImageParams(data.image_params);
+      showImage();
+      updateContrastDisplay(imageParams.contrast[imageParams.channel]);
       if (data.brightness_plot) {
         Plotly.react(
           "brightness-plot",
@@ -89,17 +128,88 @@ function updateImageAndPlot() {
 }
 
 /**
- * Fetches and updates the image based on current slider values
+ * Shows the image for the current slider values.
+ * Channel and frame changes only need a new image URL, position and
+ * particle changes also update plots and the crop on the server.
+ * With the viewer stream open all changes go through it instead.
  */
 function updateImage() {
-  const params = {
-    position: document.getElementById("position_slider").value,
-    channel: document.getElementById("channel_slider").value,
-    frame: document.getElementById("timeframe_slider").value,
-    particle: document.getElementById("particle_slider").value,
+  if (streamReady) {
+    streamNavigate();
+    return;
+  }
+  const position = parseInt(document.getElementById("position_slider").value);
+  const particle = parseInt(document.getElementById("particle_slider").value);
+  if (
+    !imageParams ||
+    position !== imageParams.position ||
+    particle !== imageParams.particle
+  ) {
+    debouncedUpdateImageAndPlot();
+    return;
+  }
+
+  imageParams.channel = parseInt(
+    document.getElementById("channel_slider").value,
+  );
+  imageParams.frame = parseInt(
+    document.getElementById("timeframe_slider").value,
+  );
+  scheduleShowImage();
+  updateContrastDisplay(imageParams.contrast[imageParams.channel]);
+}
+
+let showImageScheduled = false;
+
+/**
+ * Shows the image once per animation frame however many slider events arrive,
+ * so scrubbing requests only the frames that can actually be displayed
+ */
+function scheduleShowImage() {
+  if (showImageScheduled) {
+    return;
+  }
+  showImageScheduled = true;
+  requestAnimationFrame(() => {
+    showImageScheduled = false;
+    showImage();
+  });
+}
+
+/**
+ * Builds the binary image URL, in the same parameter order as the server
+ * so that both produce identical cache keys
+ * @param {Object} params - Image parameters as returned by the server
+ * @param {boolean} overlay - Whether outlines are burned into the image
+ * @returns {string} Image URL
+ */
+function buildImageUrl(params, overlay = true) {
+  const [lower, upper] = params.contrast[params.channel];
+  const query = {
+    x: params.x,
+    y: params.y,
+    lower: lower,
+    upper: upper,
   };
+  // Raw images do not depend on selection or tracks, so they stay cached across edits
+  if (overlay) {
+    query.particle = params.particle;
+    query.rev = params.rev;
+  }
+  query.overlay = overlay ? 1 : 0;
+  return (
+    `/api/image/${params.position}/${params.channel}/${params.frame}/?` +
+    new URLSearchParams(query).toString()
+  );
+}
 
-  fetchImageUpdate("/update_image", params);
+/**
+ * Shows the image addressed by imageParams. With vector outlines the raw image
+ * is loaded and the outlines are drawn on the canvas above it.
+ */
+function showImage() {
+  updateImageDisplay(buildImageUrl(imageParams, !VECTOR_OUTLINES));
+  loadOutlines(imageParams);
 }
 
 function showLoadingIndicator() {
@@ -111,7 +221,10 @@ function hideLoadingIndicator() {
 }
 
 function updateParticleEnabled(enabled) {
-  fetch("/update_particle_enabled", {
+  if (VECTOR_OUTLINES) {
+    setOutlineEnabled(parseInt(particleSlider.value), enabled);
+  }
+  fetch("/api/update_particle_enabled/", {
     method: "POST",
     headers: {
       "Content-Type": "application/json",
@@ -122,20 +235,59 @@ function updateParticleEnabled(enabled) {
   })
     .then((response) => response.json())
     .then((data) => {
-      if (data.channel_image) {
-        updateImageDisplay(data.channel_image);
+      if (data.image_params) {
+        // The raw image is unchanged, only overlay URLs carry the new revision
+        acceptImageParams(data.image_params);
+        if (!VECTOR_OUTLINES) {
+          updateImageDisplay(buildImageUrl(imageParams, true));
+        }
       }
-      if (data.brightness_plot) {
-        Plotly.react(
-          "brightness-plot",
-          JSON.parse(data.brightness_plot).data,
-          JSON.parse(data.brightness_plot).layout,
-        );
+      if (data.plot_style) {
+        restylePlot(data.plot_style);
+      }
+    })
+    .catch((error) => console.error("Error:", error));
+}
+
+/**
+ * Sends the contrast limits of the current channel and shows the remapped image
+ */
+function updateContrast() {
+  fetch("/api/update_contrast/", {
+    method: "POST",
+    headers: {
+      "Content-Type": "application/json",
+    },
+    body: JSON.stringify({
+      channel: document.getElementById("channel_slider").value,
+      lower: contrastLowerInput.value,
+      upper: contrastUpperInput.value,
+    }),
+  })
+    .then((response) => response.json())
+    .then((data) => {
+      if (data.error) {
+        alert(data.error);
+        return;
       }
+      acceptImageParams(data.image_params);
+      showImage();
+      updateContrastDisplay(imageParams.contrast[imageParams.channel]);
     })
     .catch((error) => console.error("Error:", error));
 }
 
+/**
+ * Shows the contrast limits returned by the server
+ * @param {Array} contrast - [lower, upper] limits of the current channel
+ */
+function updateContrastDisplay(contrast) {
+  if (contrast && contrastLowerInput && contrastUpperInput) {
+    contrastLowerInput.value = contrast[0];
+    contrastUpperInput.value = contrast[1];
+  }
+}
+
 /* *
  * Helper functions to update slider value displays
  */
@@ -175,57 +327,13 @@ function createRequestBody(params) {
 }
 
 /* *
- * Fetches image updates from the server and updates the display
- * @param {string} url - API endpoint
- * @param {Object} params - Request parameters
+ * Points the image element at a binary image URL
+ * @param {string} url - Image URL, revisited URLs are served from the browser cache
  */
-function fetchImageUpdate(url, params) {
-  const requestBody = createRequestBody(params);
-  fetch(url, {
-    method: "POST",
-    headers: {
-      "Content-Type": "application/x-www-form-urlencoded",
-    },
-    body: requestBody,
-  })
-    .then((response) => response.json())
-    .then((data) => {
-      updateImageDisplay(data.channel_image);
-      if (data.all_particles_len !== undefined) {
-        const particleSlider = document.getElementById("particle_slider");
-        particleSlider.max = data.all_particles_len;
-      }
-      if (data.brightness_plot) {
-        Plotly.react(
-          "brightness-plot",
-          JSON.parse(data.brightness_plot).data,
-          JSON.parse(data.brightness_plot).layout,
-        );
-      }
-      // Update checkbox state based on disabled particles
-      //
-      if (data.disabled_particles !== undefined) {
-        particleEnabledCheckbox.checked = !data.disabled_particles.includes(
-          parseInt(params.particle), // Convert to integer since it might be a string
-        );
-      }
-
-      // if (
-      //   data.current_particle !== undefined &&
-      //   data.disabled_particles !== undefined
-      // ) {
-      //   particleEnabledCheckbox.checked = !data.disabled_particles.includes(
-      //     data.current_particle - 1,
-      //   );
-      // }
-    });
+function updateImageDisplay(url) {
+  document.getElementById("channel_image").src = url;
 }
 
-/* *
- * Updates the image element with new base64 encoded image data
- * @param {string} base64Image - Base64 encoded image data
- */
-function updateImageDisplay(base64Image) {
-  const imgSrc = `data:image/jpeg;base64,${base64Image}`;
-  document.getElementById("channel_image").src = imgSrc;
+if (imageParams) {
+  showImage();
 }
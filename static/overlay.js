@@ -0,0 +1,139 @@
+/**
+ * overlay.js
+ * Draws cell outlines as vector polygons on a canvas layered over the raw image,
+ * so selecting a cell or toggling its enabled state needs no server image work.
+ */
+
+// Set to false to request images with outlines burned in by the server instead
+const VECTOR_OUTLINES = true;
+
+const COLOR_TRACKED = "rgb(255, 0, 0)";
+const COLOR_ENABLED = "rgb(0, 255, 0)";
+const COLOR_SELECTED = "rgb(0, 0, 255)";
+const COLOR_SELECTED_DISABLED = "rgb(0, 140, 255)";
+
+const outlineCanvas = document.getElementById("outline_canvas");
+let outlineData = null;
+// Position and frame of outlineData, clicks select cells of the frame on screen
+let outlineParams = null;
+let outlineRequest = 0;
+let outlineAbort = null;
+
+/**
+ * Fetches the outline polygons for the image addressed by params and draws them.
+ * Responses of superseded requests are dropped.
+ * @param {Object} params - Image parameters as returned by the server
+ */
+function loadOutlines(params) {
+  if (!VECTOR_OUTLINES || !outlineCanvas) {
+    return;
+  }
+  const request = ++outlineRequest;
+  // The previous request is no longer needed
+  if (outlineAbort) {
+    outlineAbort.abort();
+  }
+  outlineAbort = new AbortController();
+  const query = new URLSearchParams({ x: params.x, y: params.y, rev: params.rev });
+  fetch(`/api/outlines/${params.position}/${params.frame}/?${query.toString()}`, {
+    signal: outlineAbort.signal,
+  })
+    // 204: superseded on the server by a newer request
+    .then((response) => (response.status === 204 ? null : response.json()))
+    .then((data) => {
+      if (request !== outlineRequest || !data || data.error) {
+        return;
+      }
+      outlineData = data;
+      outlineParams = { position: params.position, frame: params.frame };
+      drawOutlines();
+    })
+    .catch((error) => {
+      if (error.name !== "AbortError") {
+        console.error("Error:", error);
+      }
+    });
+}
+
+/**
+ * Redraws all outlines from the last loaded polygons and the current selection
+ */
+function drawOutlines() {
+  if (!outlineCanvas || !outlineData) {
+    return;
+  }
+  outlineCanvas.width = outlineData.width;
+  outlineCanvas.height = outlineData.height;
+  const ctx = outlineCanvas.getContext("2d");
+  ctx.clearRect(0, 0, outlineCanvas.width, outlineCanvas.height);
+  ctx.lineWidth = 2;
+
+  const selected = parseInt(document.getElementById("particle_slider").value);
+  // Draw the selected cell last so it stays on top
+  const cells = Object.values(outlineData.cells).sort(
+    (a, b) => (a.particle === selected) - (b.particle === selected),
+  );
+  cells.forEach((cell) => {
+    if (cell.particle === selected) {
+      ctx.strokeStyle = cell.enabled ? COLOR_SELECTED : COLOR_SELECTED_DISABLED;
+    } else {
+      ctx.strokeStyle = cell.enabled ? COLOR_ENABLED : COLOR_TRACKED;
+    }
+    ctx.beginPath();
+    cell.polygons.forEach((points) => {
+      ctx.moveTo(points[0] + 0.5, points[1] + 0.5);
+      for (let i = 2; i < points.length; i += 2) {
+        ctx.lineTo(points[i] + 0.5, points[i + 1] + 0.5);
+      }
+      ctx.closePath();
+    });
+    ctx.stroke();
+  });
+}
+
+/**
+ * Updates the enabled flag of a particle locally and redraws
+ * @param {number} particle - Particle index
+ * @param {boolean} enabled - New enabled state
+ */
+function setOutlineEnabled(particle, enabled) {
+  if (!outlineData) {
+    return;
+  }
+  Object.values(outlineData.cells).forEach((cell) => {
+    if (cell.particle === particle) {
+      cell.enabled = enabled;
+    }
+  });
+  drawOutlines();
+}
+
+/**
+ * Selects the particle under a click on the image, looked up in the label index on the server
+ * @param {MouseEvent} event - Click on the image stack
+ */
+function selectParticleAt(event) {
+  if (!outlineData) {
+    return;
+  }
+  // Crop pixel under the pointer, the image may be displayed scaled
+  const rect = event.currentTarget.getBoundingClientRect();
+  const row = outlineData.x + Math.floor(((event.clientY - rect.top) * outlineData.height) / rect.height);
+  const col = outlineData.y + Math.floor(((event.clientX - rect.left) * outlineData.width) / rect.width);
+  const query = new URLSearchParams({ row, col });
+  fetch(`/api/particles/at/${outlineParams.position}/${outlineParams.frame}/?${query.toString()}`)
+    .then((response) => response.json())
+    .then((data) => {
+      if (data.error) {
+        console.error("Error:", data.error);
+      } else if (data.index !== null) {
+        selectParticle(data.index);
+      }
+    })
+    .catch((error) => console.error("Error:", error));
+}
+
+const imageStack = document.getElementById("image_stack");
+if (imageStack && VECTOR_OUTLINES) {
+  imageStack.addEventListener("click", selectParticleAt);
+}
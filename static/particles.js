@@ -0,0 +1,115 @@
+/**
+ * particles.js
+ * Sorted and filtered particle navigation from the per-position track summary,
+ * e.g. stepping through disabled cells or listing the brightest ones.
+ */
+
+const particleSortSelect = document.getElementById("particle_sort");
+const particleOrderSelect = document.getElementById("particle_order");
+const particleFilterSelect = document.getElementById("particle_filter");
+const particleList = document.getElementById("particle_list");
+const PARTICLE_LIST_LIMIT = 50;
+
+/**
+ * Query parameters for the current sort and filter selection
+ * @returns {Object} Query parameters
+ */
+function particleQuery() {
+  return {
+    sort: particleSortSelect.value,
+    order: particleOrderSelect.value,
+    enabled: particleFilterSelect.value,
+  };
+}
+
+/**
+ * Moves the particle slider, which loads the image and plots of the particle
+ * @param {number} index - Particle index
+ */
+function selectParticle(index) {
+  updateSliderAndText(particleSlider, index);
+}
+
+/**
+ * Jumps to the next or previous particle matching the selection
+ * @param {number} step - 1 for next, -1 for previous
+ */
+function stepParticle(step) {
+  const query = new URLSearchParams({
+    ...particleQuery(),
+    step: step,
+    particle: particleSlider.value,
+  });
+  fetch(`/api/particles/next/?${query.toString()}`)
+    .then((response) => response.json())
+    .then((data) => {
+      if (data.error) {
+        console.error("Error:", data.error);
+      } else if (data.index !== null) {
+        selectParticle(data.index);
+      }
+    })
+    .catch((error) => console.error("Error:", error));
+}
+
+/**
+ * Lists the first particles matching the selection, clicking one selects it
+ */
+function listParticles() {
+  const query = new URLSearchParams({
+    ...particleQuery(),
+    limit: PARTICLE_LIST_LIMIT,
+  });
+  fetch(`/api/particles/?${query.toString()}`)
+    .then((response) => response.json())
+    .then((data) => {
+      if (data.error) {
+        console.error("Error:", data.error);
+        return;
+      }
+      particleList.innerHTML = "";
+      data.particles.forEach((particle) => {
+        const item = document.createElement("li");
+        item.textContent =
+          `Particle ${particle.index}` +
+          (particle.value !== null ? `: ${particle.value.toFixed(1)}` : "") +
+          (particle.enabled ? "" : " (disabled)");
+        item.addEventListener("click", () => selectParticle(particle.index));
+        particleList.appendChild(item);
+      });
+    })
+    .catch((error) => console.error("Error:", error));
+}
+
+/**
+ * Fills the sort dropdown with the statistics of the summary table
+ * @param {Array} columns - Summary statistics
+ */
+function updateSortOptions(columns) {
+  columns.forEach((column) => {
+    const option = document.createElement("option");
+    option.value = column;
+    option.textContent = column;
+    particleSortSelect.appendChild(option);
+  });
+}
+
+document
+  .getElementById("next_particle")
+  .addEventListener("click", () => stepParticle(1));
+document
+  .getElementById("previous_particle")
+  .addEventListener("click", () => stepParticle(-1));
+document
+  .getElementById("list_particles")
+  .addEventListener("click", listParticles);
+
+// Fill the sort dropdown with the available statistics
+fetch("/api/particles/?limit=0")
+  .then((response) => response.json())
+  .then((data) => {
+    if (data.columns) {
+      updateSortOptions(data.columns);
+    }
+  })
+  .catch((error) => console.error("Error:", error));
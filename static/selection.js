@@ -10,6 +10,9 @@
  * @param {string} selectFolderId - ID of select folder button
  * @param {string} fileListId - ID of file list container
  * @param {string} selectedItemId - ID of selected item display
+ * @param {string} searchId - ID of search input
+ * @param {string} moreId - ID of load more button
+ * @param {string} kind - "nd2" or "directory" to list only those entries, "" for all
  * @returns {Object} File browser controller object
  */
 function createFileBrowser(
@@ -18,75 +21,102 @@ function createFileBrowser(
   selectFolderId,
   fileListId,
   selectedItemId,
+  searchId,
+  moreId,
+  kind = "",
 ) {
   const currentPath = document.getElementById(currentPathId);
   const upDir = document.getElementById(upDirId);
   const selectFolder = document.getElementById(selectFolderId);
   const fileList = document.getElementById(fileListId);
   const selectedItem = document.getElementById(selectedItemId);
+  const search = document.getElementById(searchId);
+  const more = document.getElementById(moreId);
+
+  // Listing shown, pages are appended by "Load more"
+  let listing = { path: "/", query: "", page: 0, pages: 0 };
+  // Only the latest request updates the list
+  let requestId = 0;
 
   /**
-   * Loads and displays the contents of a directory
-   * @param {string} path - Path to load
+   * Appends a page of entries to the list
+   * @param {Array} items - Entries returned by /api/list_directory/
+   * @param {boolean} searching - Whether the entries are search results
    */
-  async function loadDirectory(path) {
+  function renderItems(items, searching) {
+    items.forEach((item) => {
+      const div = document.createElement("div");
+      div.className = "p-2 hover:bg-gray-100 cursor-pointer flex items-center";
+
+      const icon = document.createElement("span");
+      icon.className = "mr-2";
+      icon.textContent = item.isDirectory ? "📁" : "📄";
+      div.appendChild(icon);
+
+      const name = document.createElement("span");
+      // Search results come from anywhere below the folder
+      name.textContent = searching
+        ? item.path.slice(listing.path.replace(/\/$/, "").length + 1)
+        : item.name;
+      div.appendChild(name);
+
+      div.onclick = () => {
+        if (item.isDirectory) {
+          search.value = "";
+          loadDirectory(item.path);
+        } else {
+          selectedItem.textContent = `Selected File: ${item.path}`;
+        }
+      };
+      fileList.appendChild(div);
+    });
+  }
+
+  /**
+   * Loads a page of a directory listing or of search results below it
+   * @param {string} path - Directory to list
+   * @param {string} query - Name filter, searches below the directory
+   * @param {number} page - Page number, 1 replaces the list
+   */
+  async function loadPage(path, query, page) {
+    const id = ++requestId;
+    const params = new URLSearchParams({ path, page });
+    if (query) params.set("q", query);
+    if (kind) params.set("kind", kind);
     try {
-      const response = await fetch(
-        `/list_directory?path=${encodeURIComponent(path)}`,
-      );
+      const response = await fetch(`/api/list_directory/?${params}`);
       const data = await response.json();
+      if (id !== requestId) return;
 
       if (data.error) {
         console.error(data.error);
         return;
       }
 
+      listing = { path: data.path, query, page: data.page, pages: data.pages };
       currentPath.value = data.path;
-      fileList.innerHTML = "";
-
-      // Sort items alphabetically
-      data.items.sort((a, b) => {
-        // First, sort directories before files
-        if (a.isDirectory && !b.isDirectory) return -1;
-        if (!a.isDirectory && b.isDirectory) return 1;
-        // Then sort alphabetically by name
-        return a.name.localeCompare(b.name);
-      });
-
-      data.items.forEach((item) => {
-        const div = document.createElement("div");
-        div.className =
-          "p-2 hover:bg-gray-100 cursor-pointer flex items-center";
-
-        const icon = document.createElement("span");
-        icon.className = "mr-2";
-        icon.textContent = item.isDirectory ? "📁" : "📄";
-        div.appendChild(icon);
-
-        const name = document.createElement("span");
-        name.textContent = item.name;
-        div.appendChild(name);
-
-        div.onclick = () => {
-          const newPath =
-            data.path + (data.path.endsWith("/") ? "" : "/") + item.name;
-          if (item.isDirectory) {
-            loadDirectory(newPath);
-          } else {
-            selectedItem.textContent = `Selected File: ${newPath}`;
-          }
-        };
-        fileList.appendChild(div);
-      });
+      if (page === 1) fileList.innerHTML = "";
+      renderItems(data.items, Boolean(query));
+      more.style.display = data.page < data.pages ? "" : "none";
     } catch (error) {
       console.error("Error loading directory:", error);
     }
   }
 
+  /**
+   * Loads and displays the contents of a directory
+   * @param {string} path - Path to load
+   */
+  function loadDirectory(path) {
+    return loadPage(path, "", 1);
+  }
+
   // Handle navigation to parent directory
   upDir.onclick = () => {
     const parentPath =
-      currentPath.value.split("/").slice(0, -1).join("/") || "/";
+      currentPath.value.replace(/\/$/, "").split("/").slice(0, -1).join("/") ||
+      "/";
+    search.value = "";
     loadDirectory(parentPath);
   };
 
@@ -95,6 +125,18 @@ function createFileBrowser(
     selectedItem.textContent = `Selected Folder: ${currentPath.value}`;
   };
 
+  // Search below the current folder while typing
+  let searchTimer = null;
+  search.oninput = () => {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(
+      () => loadPage(listing.path, search.value.trim(), 1),
+      300,
+    );
+  };
+
+  more.onclick = () => loadPage(listing.path, listing.query, listing.page + 1);
+
   // Initial load
   loadDirectory("/");
 
@@ -108,6 +150,8 @@ const nd2Browser = createFileBrowser(
   "nd2SelectFolder",
   "nd2FileList",
   "nd2SelectedItem",
+  "nd2Search",
+  "nd2More",
 );
 const outBrowser = createFileBrowser(
   "outCurrentPath",
@@ -115,6 +159,9 @@ const outBrowser = createFileBrowser(
   "outSelectFolder",
   "outFileList",
   "outSelectedItem",
+  "outSearch",
+  "outMore",
+  "directory",
 );
 
 /**
@@ -0,0 +1,184 @@
+/**
+ * stream.js
+ * Navigates the viewer over one WebSocket instead of a request per change.
+ * The server renders only the newest navigation and pushes the neighbouring
+ * frames while the user is idle, those are shown without asking the server.
+ * Without a WebSocket server (e.g. manage.py runserver) the HTTP endpoints stay in use.
+ */
+
+const PREFETCH_CACHE_SIZE = 32;
+
+let streamSocket = null;
+let streamReady = false;
+let streamRequest = 0;
+let streamImageUrl = null;
+// Frames received from the stream, keyed by their image URL
+const streamFrames = new Map();
+
+function openStream() {
+  if (!("WebSocket" in window) || !imageParams) {
+    return;
+  }
+  const protocol = location.protocol === "https:" ? "wss" : "ws";
+  streamSocket = new WebSocket(`${protocol}://${location.host}/ws/viewer/`);
+  streamSocket.binaryType = "arraybuffer";
+  streamSocket.onopen = () => {
+    streamReady = true;
+  };
+  streamSocket.onclose = () => {
+    streamReady = false;
+  };
+  streamSocket.onmessage = (event) => {
+    if (typeof event.data === "string") {
+      handleStreamMessage(JSON.parse(event.data));
+    } else {
+      handleStreamFrame(event.data);
+    }
+  };
+}
+
+/**
+ * Sends the slider values to the server. A frame pushed earlier is shown right
+ * away, then the server only updates its state and sends no image.
+ */
+function streamNavigate() {
+  const params = {
+    ...imageParams,
+    position: parseInt(positionSlider.value),
+    channel: parseInt(channelSlider.value),
+    frame: parseInt(timeframeSlider.value),
+    particle: parseInt(particleSlider.value),
+  };
+  // The crop of another position or particle is only known after the server answers
+  const sameSelection =
+    params.position === imageParams.position &&
+    params.particle === imageParams.particle;
+  const overlay = !VECTOR_OUTLINES;
+  const cached = sameSelection
+    ? streamFrames.get(buildImageUrl(params, overlay))
+    : undefined;
+
+  if (sameSelection) {
+    imageParams = params;
+    loadOutlines(imageParams);
+    updateContrastDisplay(imageParams.contrast[imageParams.channel]);
+  }
+  if (cached) {
+    showStreamFrame(cached);
+    // The frame of the previous navigation is not needed anymore
+    streamSocket.send(JSON.stringify({ type: "cancel", id: streamRequest }));
+  }
+
+  const [lower, upper] = params.contrast[params.channel];
+  streamSocket.send(
+    JSON.stringify({
+      type: "navigate",
+      id: ++streamRequest,
+      position: params.position,
+      channel: params.channel,
+      frame: params.frame,
+      particle: params.particle,
+      lower: lower,
+      upper: upper,
+      overlay: overlay ? 1 : 0,
+      cached: Boolean(cached),
+    }),
+  );
+}
+
+function handleStreamMessage(message) {
+  if (message.id !== streamRequest) {
+    return;
+  }
+  if (message.type === "state") {
+    const selectionChanged =
+      message.image_params.position !== imageParams.position ||
+      message.image_params.particle !== imageParams.particle;
+    acceptImageParams(message.image_params);
+    if (selectionChanged) {
+      loadOutlines(imageParams);
+    }
+    particleSlider.max = message.all_particles_len;
+    particleEnabledCheckbox.checked = message.particle_enabled;
+    updateContrastDisplay(imageParams.contrast[imageParams.channel]);
+  } else if (message.type === "plot") {
+    const plot = JSON.parse(message.brightness_plot);
+    Plotly.react("brightness-plot", plot.data, plot.layout);
+  } else if (message.type === "plot_style") {
+    restylePlot(message);
+  } else if (message.type === "error") {
+    console.error("Error:", message.message);
+  }
+}
+
+/**
+ * Binary messages: 4 byte header length, JSON header, image bytes
+ * @param {ArrayBuffer} data - Message data
+ */
+function handleStreamFrame(data) {
+  const headerLength = new DataView(data).getUint32(0);
+  const header = JSON.parse(
+    new TextDecoder().decode(new Uint8Array(data, 4, headerLength)),
+  );
+  const blob = new Blob([new Uint8Array(data, 4 + headerLength)], {
+    type: header.content_type,
+  });
+  const key = buildImageUrl(header.params, Boolean(header.overlay));
+  streamFrames.delete(key);
+  streamFrames.set(key, blob);
+  if (streamFrames.size > PREFETCH_CACHE_SIZE) {
+    streamFrames.delete(streamFrames.keys().next().value);
+  }
+  if (header.type === "frame" && header.id === streamRequest) {
+    showStreamFrame(blob);
+  }
+}
+
+function showStreamFrame(blob) {
+  const previous = streamImageUrl;
+  streamImageUrl = URL.createObjectURL(blob);
+  updateImageDisplay(streamImageUrl);
+  if (previous) {
+    URL.revokeObjectURL(previous);
+  }
+}
+
+/**
+ * Restyles the brightness traces after a particle change, the traces
+ * themselves stay the same and the highlighted one is replaced in place
+ * @param {Object} style - Colors and opacities per trace, highlighted particle
+ */
+function restylePlot(style) {
+  const plot = document.getElementById("brightness-plot");
+  if (!plot.data) {
+    return;
+  }
+  const n = style.colors.length;
+  const traces = [...Array(n).keys()];
+  Plotly.restyle(
+    plot,
+    { "line.color": style.colors, opacity: style.opacities },
+    traces,
+  );
+  const highlight = style.highlight;
+  Plotly.restyle(
+    plot,
+    {
+      x: [plot.data[highlight].x],
+      y: [plot.data[highlight].y],
+      "line.color": style.colors[highlight],
+      opacity: style.opacities[highlight],
+      name: `Trace ${highlight} (Highlighted)`,
+    },
+    [n],
+  );
+}
+
+// Hidden pages do not need the frame they asked for
+document.addEventListener("visibilitychange", () => {
+  if (document.hidden && streamReady) {
+    streamSocket.send(JSON.stringify({ type: "cancel", id: streamRequest }));
+  }
+});
+
+openStream();